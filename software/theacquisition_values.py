@@ -33,4 +33,39 @@ acquisition_values = {
     "auto_adjust_offset": "Whether the DAC will remain static until next power cycle or re-adjusted whenever analog gain or other settings are changed. (0: static, 1: auto adjusted).",
     # SCA Data Acquisition
     "number_of_scas": "Sets the number of SCAs. **sca\{N\}_[lo|hi]** The SCA limit (low or high) for the requested SCA, N, specified as a bin number. N ranges from 0 to \"number_of_scas\" - 1.",
-}
\ No newline at end of file
+}
+
+# Memory an acquisition value lives in, i.e. the ACQ_MEM_CONSTANTS bit "apply" has to save after changing it.
+# Values without an entry (run control, readout settings) need no save.
+acquisition_value_memory = {
+    "clock_speed": "AV_MEM_FIPPI",
+    "energy_gap_time": "AV_MEM_PARSET",
+    "trigger_peak_time": "AV_MEM_PARSET",
+    "trigger_gap_time": "AV_MEM_PARSET",
+    "baseline_length": "AV_MEM_PARSET",
+    "trigger_threshold": "AV_MEM_PARSET",
+    "baseline_threshold": "AV_MEM_PARSET",
+    "energy_threshold": "AV_MEM_PARSET",
+    "peak_interval_offset": "AV_MEM_PARSET",
+    "peak_sample_offset": "AV_MEM_PARSET",
+    "max_width": "AV_MEM_PARSET",
+    "peak_mode": "AV_MEM_PARSET",
+    "peak_interval": "AV_MEM_PARSET",
+    "peak_sample": "AV_MEM_PARSET",
+    "gain_trim": "AV_MEM_PARSET",
+    "polarity": "AV_MEM_GENSET",
+    "preamp_value": "AV_MEM_GENSET",
+    "gain": "AV_MEM_GENSET",
+    "number_mca_channels": "AV_MEM_GENSET",
+    "mca_bin_width": "AV_MEM_GENSET",
+    "bytes_per_bin": "AV_MEM_GENSET",
+    "auto_adjust_offset": "AV_MEM_GLOB",
+    "number_of_scas": "AV_MEM_GENSET",
+}
+
+def isScaLimit(name: str) -> bool:
+    """True for the per-SCA limits sca{N}_lo / sca{N}_hi, which are not listed in acquisition_values."""
+    return name.startswith("sca") and name[-3:] in ("_lo", "_hi") and name[3:-3].isdigit()
+
+def isAcquisitionValue(name: str) -> bool:
+    return name in acquisition_values or isScaLimit(name)
@@ -0,0 +1,292 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Characteristic lines (keV) commonly seen with the tungsten tube and our brass/steel/lead samples
+KNOWN_LINES = {
+    "Cr Ka": 5.415,
+    "Fe Ka": 6.404,
+    "Fe Kb": 7.058,
+    "Ni Ka": 7.478,
+    "Cu Ka": 8.048,
+    "W La": 8.398,
+    "Zn Ka": 8.639,
+    "Cu Kb": 8.905,
+    "Zn Kb": 9.572,
+    "W Lb": 9.672,
+    "Pb La": 10.551,
+    "Pb Lb": 12.614,
+}
+
+def energyAxis(nbins: int, binWidth: float, offset: float = 0.0) -> np.ndarray:
+    """Energy in keV of the center of every bin, for a <binWidth> in eV (mca_bin_width) and <offset> in keV."""
+    return offset + (np.arange(nbins) + 0.5) * binWidth / 1000.0
+
+def fitCalibration(peakBins, energies, order: int = 1) -> np.ndarray:
+    """Fits energy = polynomial(bin) to matched peak positions and line energies (keV).
+
+    Returns the polynomial coefficients, highest order first (as np.polyval expects).
+    """
+    return np.polyfit(np.asarray(peakBins, dtype=float), np.asarray(energies, dtype=float), order)
+
+def calibratedAxis(coefficients, nbins: int) -> np.ndarray:
+    """Energy in keV of every bin for calibration <coefficients>."""
+    return np.polyval(coefficients, np.arange(nbins, dtype=float))
+
+def gaussianKernel(sigma: float, second: bool = False) -> np.ndarray:
+    """Normalized gaussian smoothing kernel, or with <second> the zero-sum negative second derivative used for peak search."""
+
+    half = int(np.ceil(4 * sigma))
+    x = np.arange(-half, half + 1, dtype=float)
+    g = np.exp(-0.5 * (x / sigma)**2)
+    if not second:
+        return g / g.sum()
+    k = (1 - (x / sigma)**2) * g
+    return k - k.mean()
+
+def convolveRows(spectra: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """Convolves every row of the (n, bins) <spectra> with <kernel> (same size output, edges reflected)."""
+
+    half = len(kernel) // 2
+    padded = np.pad(np.asarray(spectra, dtype=float), ((0, 0), (half, half)), mode="reflect")
+    return sliding_window_view(padded, len(kernel), axis=1) @ kernel[::-1]
+
+def findPeaks(spectra: np.ndarray, sigma: float = 3.0, threshold: float = 5.0, minCounts: float = 10.0) -> tuple:
+    """Peak search on every row of the (n, bins) <spectra> at once.
+
+    The spectra are filtered with the negative second derivative of a gaussian of <sigma> bins,
+    which suppresses the smooth continuum. Local maxima of the filtered spectrum that exceed
+    <threshold> standard deviations of Poisson noise and <minCounts> counts are peaks.
+
+    Returns (rows, bins, significance) like np.nonzero, sorted by row then bin.
+    """
+
+    spectra = np.atleast_2d(spectra)
+    kernel = gaussianKernel(sigma, second=True)
+    filtered = convolveRows(spectra, kernel)
+    variance = convolveRows(np.maximum(spectra, 1), kernel**2)
+    significance = filtered / np.sqrt(variance)
+
+    inner = significance[:, 1:-1]
+    isPeak = (inner > significance[:, :-2]) & (inner >= significance[:, 2:]) & (inner > threshold)
+    isPeak &= spectra[:, 1:-1] >= minCounts
+    rows, bins = np.nonzero(isPeak)
+    bins = bins + 1
+    return rows, bins, significance[rows, bins]
+
+def fitGaussians(spectra: np.ndarray, centers, halfWidth: int = 8, background: bool = True) -> dict:
+    """Fits a gaussian to every peak of every spectrum at once.
+
+    <centers> are peak positions in bins, either (m,) shared by all spectra or (n, m) per
+    spectrum. A window of 2 * <halfWidth> + 1 bins is taken around every center; with
+    <background> a straight line through the window edges is subtracted first. The log of a
+    gaussian is a parabola, so each fit is a weighted linear least squares problem (Guo's
+    weighting), solved for all peaks in one batched call.
+
+    Returns arrays of shape (n, m): amplitude, centroid (bins), sigma (bins), fwhm (bins), area
+    (counts) and valid.
+    """
+
+    spectra = np.atleast_2d(np.asarray(spectra, dtype=float))
+    n, nbins = spectra.shape
+    centers = np.rint(np.broadcast_to(np.asarray(centers, dtype=float), (n, np.shape(centers)[-1]))).astype(int)
+    centers = np.clip(centers, halfWidth, nbins - halfWidth - 1)
+
+    offsets = np.arange(-halfWidth, halfWidth + 1)
+    index = centers[..., None] + offsets                                 # (n, m, w)
+    y = np.take_along_axis(spectra[:, None, :], index, axis=2)           # (n, m, w)
+    if background:
+        left, right = y[..., :1], y[..., -1:]
+        y = y - (left + (right - left) * (offsets + halfWidth) / (2 * halfWidth))
+    y = np.maximum(y, 0.0)
+
+    # weighted least squares of ln(y) = a + b x + c x^2 with weights y^2
+    x = offsets.astype(float)
+    w = y**2
+    logy = np.log(np.where(y > 0, y, 1.0))
+    powers = np.stack([np.ones_like(x), x, x**2, x**3, x**4])           # (5, w)
+    moments = w @ powers.T                                               # (n, m, 5)
+    A = np.empty(moments.shape[:-1] + (3, 3))
+    for i in range(3):
+        for j in range(3):
+            A[..., i, j] = moments[..., i + j]
+    rhs = (w * logy) @ powers[:3].T                                      # (n, m, 3)
+
+    singular = np.abs(np.linalg.det(A)) < 1e-12
+    A[singular] = np.eye(3)
+    a, b, c = np.moveaxis(np.linalg.solve(A, rhs[..., None])[..., 0], -1, 0)
+
+    valid = ~singular & (c < 0)
+    c = np.where(valid, c, -1.0)
+    sigma = np.sqrt(-1 / (2 * c))
+    shift = -b / (2 * c)
+    valid &= np.abs(shift) <= halfWidth
+    amplitude = np.exp(np.clip(a - b**2 / (4 * c), None, 700))
+    centroid = centers + shift
+    area = amplitude * sigma * np.sqrt(2 * np.pi)
+    return {
+        "amplitude": np.where(valid, amplitude, 0.0),
+        "centroid": np.where(valid, centroid, np.nan),
+        "sigma": np.where(valid, sigma, np.nan),
+        "fwhm": np.where(valid, 2.3548 * sigma, np.nan),
+        "area": np.where(valid, area, 0.0),
+        "valid": valid,
+    }
+
+def calibrate(spectrum: np.ndarray, lines: dict, binWidth: float, tolerance: float = 0.15, order: int = 1, sigma: float = 3.0) -> np.ndarray:
+    """Energy calibration from the known <lines> ({name: keV}) found in <spectrum>.
+
+    Peaks are searched, matched to the line whose nominal position (from <binWidth> in eV) is
+    within <tolerance> keV, refined with a gaussian fit and used for fitCalibration.
+    """
+
+    rows, bins, significance = findPeaks(spectrum, sigma=sigma)
+    nominal = energyAxis(len(np.ravel(spectrum)), binWidth)[bins]
+    peakBins, energies = [], []
+    for energy in lines.values():
+        distance = np.abs(nominal - energy)
+        if distance.size and distance.min() <= tolerance:
+            peakBins.append(bins[np.argmin(distance)])
+            energies.append(energy)
+    if len(peakBins) <= order:
+        raise ValueError(f"Only {len(peakBins)} of the given lines found, {order + 1} needed.")
+
+    fit = fitGaussians(spectrum, peakBins)
+    centroids = fit["centroid"][0]
+    ok = fit["valid"][0]
+    return fitCalibration(centroids[ok], np.asarray(energies)[ok], order)
+
+def snipBackground(spectra: np.ndarray, iterations: int = 20, smoothing: float = 0.0, decreasing: bool = True, lls: bool = True, out: np.ndarray = None) -> np.ndarray:
+    """Continuum of every row of the (n, bins) <spectra> by SNIP clipping.
+
+    Each pass replaces every bin by the mean of its neighbours <p> bins away where that is lower,
+    which cuts away peaks narrower than the window and leaves the slowly varying Bremsstrahlung.
+    The windows run from <iterations> down to 1 bin (up with <decreasing> False); <iterations>
+    should be about the FWHM of the peaks in bins or a bit more. With <lls> the clipping is done
+    on the log-log-sqrt transformed counts, which follows steep continua better. <smoothing> is
+    the sigma in bins of a gaussian applied to the spectra first, to keep noise from pulling the
+    background down. All rows are clipped at once; the result goes to <out> if given.
+    """
+
+    spectra = np.atleast_2d(spectra)
+    if out is None:
+        out = np.empty(spectra.shape)
+    v = out
+    if smoothing > 0:
+        v[...] = convolveRows(spectra, gaussianKernel(smoothing))
+    else:
+        v[...] = spectra
+    if lls:
+        np.maximum(v, 0, out=v)
+        np.log(np.log(np.sqrt(v + 1) + 1) + 1, out=v)
+
+    nbins = v.shape[1]
+    scratch = np.empty(v.shape)
+    windows = range(iterations, 0, -1) if decreasing else range(1, iterations + 1)
+    for p in windows:
+        if 2 * p >= nbins:
+            continue
+        mean = scratch[:, :nbins - 2 * p]
+        np.add(v[:, :-2 * p], v[:, 2 * p:], out=mean)
+        mean *= 0.5
+        np.minimum(v[:, p:-p], mean, out=v[:, p:-p])
+
+    if lls:
+        np.expm1(np.expm1(v, out=v), out=v)
+        v *= v
+        v -= 1
+        np.maximum(v, 0, out=v)
+    return v
+
+def stripContinuum(source, outPath: str = None, iterations: int = 20, smoothing: float = 0.0, chunkSize: int = 1024, background: bool = False, **snipKwargs) -> np.ndarray:
+    """Net counts (spectra minus SNIP continuum) of a whole dataset, computed chunk by chunk.
+
+    <source> is a thestore.SpectrumStore, read one stored chunk at a time, or any (n, bins) array
+    such as an np.load(..., mmap_mode="r") memmap, read <chunkSize> rows at a time. The result is
+    written to a float32 .npy memmap at <outPath> (or an in-memory array without one) and
+    returned, so a full scan never has to fit in memory. With <background> the continuum itself
+    is written instead of the net counts.
+    """
+
+    if hasattr(source, "iterChunks"):
+        shape = (len(source), source.nbins)
+        chunks = ((start, spectra) for start, spectra, _ in source.iterChunks())
+    else:
+        shape = np.shape(source)
+        chunks = ((start, source[start:start + chunkSize]) for start in range(0, shape[0], chunkSize))
+
+    if outPath is None:
+        out = np.empty(shape, dtype=np.float32)
+    else:
+        out = np.lib.format.open_memmap(outPath, mode="w+", dtype=np.float32, shape=shape)
+
+    work = None
+    for start, spectra in chunks:
+        if work is None or len(work) < len(spectra):
+            work = np.empty((len(spectra), shape[1]))
+        continuum = snipBackground(spectra, iterations, smoothing, out=work[:len(spectra)], **snipKwargs)
+        if background:
+            out[start:start + len(spectra)] = continuum
+        else:
+            out[start:start + len(spectra)] = spectra - continuum
+    if outPath is not None:
+        out.flush()
+    return out
+
+DEADTIME_METHODS = ("livetime", "icr")
+
+def deadTimeFactors(realtime, livetime, icr, ocr, method: str = "icr") -> np.ndarray:
+    """Per spectrum factor turning counts into dead-time corrected count rates (counts/s).
+
+    "livetime" divides by the livetime the board measured. "icr" scales the counts by ICR/OCR and
+    divides by the realtime, which also accounts for events lost to pile-up rejection. Spectra
+    without time or without output counts get a factor of 0.
+    """
+
+    realtime, livetime, icr, ocr = (np.asarray(a, dtype=float) for a in (realtime, livetime, icr, ocr))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if method == "livetime":
+            factors = 1 / livetime
+        elif method == "icr":
+            factors = icr / (ocr * realtime)
+        else:
+            raise ValueError(f"method must be one of {DEADTIME_METHODS}")
+    return np.where(np.isfinite(factors), factors, 0.0)
+
+def flagPileup(icr, ocr, maxRatio: float = 1.5) -> np.ndarray:
+    """True where ICR/OCR exceeds <maxRatio>, i.e. so many events are lost to dead time and pile-up
+    rejection that the spectrum shape is likely distorted by sum peaks. 1.5 is ~33% dead time."""
+
+    icr, ocr = np.asarray(icr, dtype=float), np.asarray(ocr, dtype=float)
+    return icr > maxRatio * ocr
+
+def correctDeadTime(spectra: np.ndarray, factors: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """Multiplies every row of the (n, bins) <spectra> with its factor from deadTimeFactors, in one pass."""
+
+    spectra = np.atleast_2d(spectra)
+    if out is None:
+        out = np.empty(spectra.shape, dtype=np.float32)
+    np.multiply(spectra, np.asarray(factors)[:, None], out=out, casting="unsafe")
+    return out
+
+def correctStore(store, outPath: str = None, method: str = "icr", maxRatio: float = 1.5) -> tuple:
+    """Dead-time corrected count rate spectra of a whole thestore.SpectrumStore, chunk by chunk.
+
+    The run statistics stored with every spectrum give the factors. The rates are written to a
+    float32 .npy memmap at <outPath> (or an in-memory array). Returns (rates, pileup flags).
+    """
+
+    shape = (len(store), store.nbins)
+    if outPath is None:
+        out = np.empty(shape, dtype=np.float32)
+    else:
+        out = np.lib.format.open_memmap(outPath, mode="w+", dtype=np.float32, shape=shape)
+    flags = np.zeros(len(store), dtype=bool)
+
+    for start, spectra, meta in store.iterChunks():
+        stop = start + len(spectra)
+        factors = deadTimeFactors(meta["realtime"], meta["livetime"], meta["input_count_rate"], meta["output_count_rate"], method)
+        correctDeadTime(spectra, factors, out=out[start:stop])
+        flags[start:stop] = flagPileup(meta["input_count_rate"], meta["output_count_rate"], maxRatio)
+    if outPath is not None:
+        out.flush()
+    return out, flags
@@ -0,0 +1,274 @@
+"""Hardware-free benchmarks of XMagix operations on top of the simulated Handel backend.
+
+Usage:
+    python thebenchmarks.py                         # all benchmarks, no simulated USB latency
+    python thebenchmarks.py --latency 200e-6        # 200us per Handel call
+    python thebenchmarks.py pullMcaData --repeat 1000
+    python thebenchmarks.py --lib /usr/local/lib/libhandel.so --ini microdxp_usb2.ini    # real board
+"""
+import argparse
+import json
+import time
+import tracemalloc
+import numpy as np
+from ctypes import *
+from rich.console import Console
+from rich.table import Table
+import xmagix
+from xmagix import XMagix
+from thesimhandel import SimHandel
+from therunstats import RunStatsHistory
+from theanalysis import findPeaks, fitGaussians, snipBackground
+from thereferencefit import ReferenceFit, lawsonHanson
+
+console = Console()
+
+def makeXMagix(latency: float = 0.0, libpath: str = None, inifile: str = "microdxp_usb2.ini", **simKwargs) -> XMagix:
+    """Returns a started XMagix instance with console output off. Runs on a SimHandel backend unless <libpath> is given."""
+
+    # the load message comes before the console sink can be removed
+    xmagix.console.quiet = True
+    try:
+        if libpath is None:
+            xm = XMagix("sim", lib=SimHandel(latency=latency, **simKwargs))
+        else:
+            xm = XMagix(libpath)
+    finally:
+        xmagix.console.quiet = False
+    # removing the sink keeps rich from formatting every event, muting it would not
+    xm.setConsoleLevel(None)
+    xm.setLogging(0)
+    xm.init(inifile)
+    xm.startSystem()
+    return xm
+
+# -------------------------------------------------------------------------------------------------
+# Benchmark cases. Each takes a started XMagix and returns the operation to time.
+# -------------------------------------------------------------------------------------------------
+
+def benchPullMcaData(xm):
+    xm.startRun()
+    return xm.pullMcaData
+
+def benchPullMcaDataPool(xm):
+    xm.startRun()
+    xm.setMcaPool(4)
+    return lambda: xm.pullMcaData(fixedWidth=True)
+
+def benchGetAllAcquisitionValues(xm):
+    return lambda: xm.getAcquisitionValues("all")
+
+def benchSetParams(xm):
+    params = {"gain": 5.0, "energy_threshold": 0.0, "mca_bin_width": 20.0}
+    return lambda: xm.setParams(params)
+
+def benchSetParamsShadow(xm):
+    xm.enableShadow()
+    params = {"gain": 5.0, "energy_threshold": 0.0, "mca_bin_width": 20.0}
+    return lambda: xm.setParams(params)
+
+def benchGetAllAcquisitionValuesShadow(xm):
+    xm.enableShadow()
+    return lambda: xm.getAcquisitionValues("all")
+
+def benchRunDataPoll(xm):
+    xm.startRun()
+    return xm.pollRunData
+
+def benchRunStats(xm):
+    xm.startRun()
+    history = RunStatsHistory()
+    return lambda: history.append(xm.getRunStats())
+
+def benchFixedRealtimeRun(xm):
+    # the simulated clock runs a million times faster, so the 1s preset is over at the first poll
+    xm._lib.timeScale = 1e6
+    return lambda: xm.fixedRealtimeRun(1)
+
+def benchRunDataLegacy(xm):
+    # call path before the binding layer: encode the name, allocate the out-parameter, no prototypes.
+    # XMagix declared the prototypes on its CDLL, so a real library is loaded a second time without them.
+    lib = CDLL(xm.libpath) if isinstance(xm._lib, CDLL) else xm._lib
+    def op():
+        cvalue = c_double(0)
+        lib.xiaGetRunData(xm.cdetChan, "output_count_rate".encode('ascii'), byref(cvalue))
+        return cvalue.value
+    return op
+
+def benchRunDataBound(xm):
+    getRunDataDouble = xm._handel.getRunDataDouble
+    return lambda: getRunDataDouble(0, "output_count_rate")
+
+def simulatedStack(xm, n: int) -> np.ndarray:
+    """<n> simulated spectra with the board's number of bins, from a standalone SimHandel so any backend works."""
+
+    nbins = xm.getMcaLayout()[0]
+    shape = SimHandel().spectrumShape(nbins, 20.0)
+    return np.random.default_rng(0).poisson(shape * 2e5, (n, nbins)).astype(np.uint32)
+
+def benchPeakSearch(xm):
+    # one operation analyses a stack of 1000 simulated spectra
+    stack = simulatedStack(xm, 1000)
+    def op():
+        rows, bins, _ = findPeaks(stack)
+        return fitGaussians(stack, np.unique(bins))
+    return op
+
+def benchSnipBackground(xm):
+    stack = simulatedStack(xm, 1000)
+    out = np.empty(stack.shape)
+    return lambda: snipBackground(stack, smoothing=1.0, out=out)
+
+def referenceFitData(xm, n: int) -> tuple:
+    """Brass, steel and lead like references and <n> random non-negative mixes of them."""
+
+    nbins = xm.getMcaLayout()[0]
+    lines = [{8.048: 1.0, 8.905: 0.14, 8.639: 0.5, 9.572: 0.07},
+             {6.404: 1.0, 7.058: 0.13, 5.415: 0.2, 7.478: 0.1},
+             {10.551: 1.0, 12.614: 0.8}]
+    references = np.stack([SimHandel(lines=l, continuumFraction=0.0).spectrumShape(nbins, 20.0) for l in lines])
+    rng = np.random.default_rng(0)
+    weights = rng.uniform(0, 1e5, (n, len(references)))
+    return ReferenceFit(references, ["brass", "steel", "lead"]), rng.poisson(weights @ references).astype(np.uint32)
+
+def perPixel(op, pixels: int):
+    """Marks <op> as processing <pixels> spectra, so the rate is reported in pixels/s as well."""
+    op.pixels = pixels
+    return op
+
+def closing(op, close):
+    """Marks <op> as holding resources that runBenchmark releases with close() when done."""
+    op.close = close
+    return op
+
+def benchNnlsNaive(xm):
+    fit, spectra = referenceFitData(xm, 100)
+    A = fit.references.T
+    return perPixel(lambda: [lawsonHanson(A, s) for s in spectra], len(spectra))
+
+def benchNnlsBatch(xm):
+    fit, spectra = referenceFitData(xm, 1000)
+    out = np.empty((len(spectra), fit.k))
+    return perPixel(lambda: fit.fit(spectra, out=out), len(spectra))
+
+def benchNnlsBatchLarge(xm):
+    fit, spectra = referenceFitData(xm, 20000)
+    out = np.empty((len(spectra), fit.k))
+    return perPixel(lambda: fit.fit(spectra, out=out), len(spectra))
+
+def benchNnlsParallel(xm):
+    # pool started once as in a long analysis session, its startup is not timed
+    fit, spectra = referenceFitData(xm, 20000)
+    fit.startPool()
+    return closing(perPixel(lambda: fit.fitParallel(spectra), len(spectra)), fit.close)
+
+BENCHMARKS = {
+    "pullMcaData": benchPullMcaData,
+    "pullMcaData(pool)": benchPullMcaDataPool,
+    "getAcquisitionValues(all)": benchGetAllAcquisitionValues,
+    "setParams": benchSetParams,
+    "setParams(shadow)": benchSetParamsShadow,
+    "getAcquisitionValues(all, shadow)": benchGetAllAcquisitionValuesShadow,
+    "runDataPoll": benchRunDataPoll,
+    "getRunStats+history": benchRunStats,
+    "fixedRealtimeRun": benchFixedRealtimeRun,
+    "getRunData(legacy)": benchRunDataLegacy,
+    "getRunData(bound)": benchRunDataBound,
+    "findPeaks+fitGaussians(1000 spectra)": benchPeakSearch,
+    "snipBackground(1000 spectra)": benchSnipBackground,
+    "lawsonHanson loop(100 pixels)": benchNnlsNaive,
+    "ReferenceFit.fit(1000 pixels)": benchNnlsBatch,
+    "ReferenceFit.fit(20000 pixels)": benchNnlsBatchLarge,
+    "ReferenceFit.fitParallel(20000 pixels)": benchNnlsParallel,
+}
+
+def runBenchmark(setup, latency: float = 0.0, repeat: int = 200, warmup: int = 5, libpath: str = None, inifile: str = "microdxp_usb2.ini") -> dict:
+    """Times the operation returned by <setup> and reports rate, latency, Handel calls and allocations per operation."""
+
+    xm = makeXMagix(latency, libpath, inifile)
+    op = setup(xm)
+    try:
+        sim = xm._lib if isinstance(xm._lib, SimHandel) else None
+        if sim is not None:
+            sim.paused = True # keep the backend's spectrum generation out of the figures
+        for _ in range(warmup):
+            op()
+
+        callsBefore = sum(sim.calls.values()) if sim is not None else 0
+        times = np.empty(repeat)
+        for k in range(repeat):
+            t0 = time.perf_counter()
+            op()
+            times[k] = time.perf_counter() - t0
+        ffiCalls = (sum(sim.calls.values()) - callsBefore) / repeat if sim is not None else float("nan")
+
+        # transient allocations per operation
+        tracemalloc.start()
+        peaks = []
+        blocks = []
+        for _ in range(min(repeat, 20)):
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            op()
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+            after = tracemalloc.take_snapshot()
+            blocks.append(sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0))
+        tracemalloc.stop()
+    finally:
+        close = getattr(op, "close", None)
+        if close is not None:
+            close()
+
+    pixels = getattr(op, "pixels", None)
+    return {
+        "ops_per_s": 1 / times.mean(),
+        "pixels_per_s": pixels / times.mean() if pixels else float("nan"),
+        "mean_us": times.mean() * 1e6,
+        "p50_us": np.percentile(times, 50) * 1e6,
+        "p99_us": np.percentile(times, 99) * 1e6,
+        "ffi_calls": ffiCalls,
+        "peak_alloc_bytes": float(np.median(peaks)),
+        "retained_blocks": float(np.median(blocks)),
+    }
+
+def printResults(results: dict, title: str) -> None:
+    table = Table(title=title)
+    table.add_column("Operation", style="bold")
+    for column in ("ops/s", "pixels/s", "mean [us]", "p50 [us]", "p99 [us]", "FFI calls/op", "peak alloc [B]", "retained blocks"):
+        table.add_column(column, justify="right")
+    for name, r in results.items():
+        table.add_row(name,
+                      f"{r['ops_per_s']:.0f}",
+                      f"{r['pixels_per_s']:.0f}" if r['pixels_per_s'] == r['pixels_per_s'] else "",
+                      f"{r['mean_us']:.1f}",
+                      f"{r['p50_us']:.1f}",
+                      f"{r['p99_us']:.1f}",
+                      f"{r['ffi_calls']:.1f}",
+                      f"{r['peak_alloc_bytes']:.0f}",
+                      f"{r['retained_blocks']:.0f}")
+    console.print(table)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark XMagix against the simulated Handel backend.")
+    parser.add_argument("benchmarks", nargs="*", help=f"subset of {', '.join(BENCHMARKS)}")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated latency per Handel call in s")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--lib", help="benchmark a real libhandel instead of the simulation")
+    parser.add_argument("--ini", default="microdxp_usb2.ini", help="ini file used with --lib")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    names = args.benchmarks or list(BENCHMARKS)
+    results = {}
+    for name in names:
+        results[name] = runBenchmark(BENCHMARKS[name], latency=args.latency, repeat=args.repeat, libpath=args.lib, inifile=args.ini)
+
+    backend = args.lib or f"SimHandel, latency {args.latency*1e6:.0f}us/call"
+    printResults(results, f"XMagix on {backend}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
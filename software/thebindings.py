@@ -0,0 +1,116 @@
+from ctypes import *
+from theacquisition_values import *
+from theboardoperations import *
+from therundata import *
+
+# Handel prototypes as (restype, argtypes). Value arguments are void* since their type depends on the name.
+HANDEL_PROTOTYPES = {
+    "xiaInit":                 (c_int, [c_char_p]),
+    "xiaStartSystem":          (c_int, []),
+    "xiaExit":                 (c_int, []),
+    "xiaSetLogLevel":          (c_int, [c_int]),
+    "xiaSetLogOutput":         (c_int, [c_char_p]),
+    "xiaGetNumDetectors":      (c_int, [c_void_p]),
+    "xiaGetNumModules":        (c_int, [c_void_p]),
+    "xiaGetNumFirmwareSets":   (c_int, [c_void_p]),
+    "xiaSetAcquisitionValues": (c_int, [c_int, c_char_p, c_void_p]),
+    "xiaGetAcquisitionValues": (c_int, [c_int, c_char_p, c_void_p]),
+    "xiaBoardOperation":       (c_int, [c_int, c_char_p, c_void_p]),
+    "xiaStartRun":             (c_int, [c_int, c_ushort]),
+    "xiaStopRun":              (c_int, [c_int]),
+    "xiaGetRunData":           (c_int, [c_int, c_char_p, c_void_p]),
+}
+
+# Every name Handel knows about, encoded once
+NAMES = {name: name.encode("ascii") for name in [*acquisition_values, *board_operations_all, *run_data]}
+
+def encodeName(name: str) -> bytes:
+    """Returns the byte string for <name>, encoding and caching it on first use."""
+    try:
+        return NAMES[name]
+    except KeyError:
+        NAMES[name] = name.encode("ascii")
+        return NAMES[name]
+
+def bindHandel(lib) -> None:
+    """Declares argtypes/restype of every Handel function on <lib>. Python backends (e.g. SimHandel) are left untouched."""
+
+    for fname, (restype, argtypes) in HANDEL_PROTOTYPES.items():
+        func = getattr(lib, fname, None)
+        if func is None or not hasattr(func, "argtypes"):
+            continue
+        func.restype = restype
+        func.argtypes = argtypes
+
+
+class HandelBindings:
+    """Precompiled call table for the Handel functions XMagix uses in hot paths.
+
+    Function pointers are looked up once, names are taken from the pre-encoded NAMES table and the
+    scalar out-parameters (and their byref pointers) are allocated once and reused for every call.
+    The status of the last call is kept in <status>. Since the out-parameters are shared, one
+    instance must not be used from several threads at the same time; create one per thread instead.
+    """
+
+    def __init__(self, lib):
+        bindHandel(lib)
+        self.lib = lib
+        self.status = 0
+
+        self._getAcquisitionValues = lib.xiaGetAcquisitionValues
+        self._setAcquisitionValues = lib.xiaSetAcquisitionValues
+        self._boardOperation = lib.xiaBoardOperation
+        self._getRunData = lib.xiaGetRunData
+        self._startRun = lib.xiaStartRun
+        self._stopRun = lib.xiaStopRun
+
+        self.cdouble = c_double(0)
+        self.cshort = c_short(0)
+        self.culong = c_ulong(0)
+        self.pdouble = byref(self.cdouble)
+        self.pshort = byref(self.cshort)
+        self.pulong = byref(self.culong)
+
+    def getAcquisitionValue(self, detChan: int, name: str) -> float:
+        self.status = self._getAcquisitionValues(detChan, encodeName(name), self.pdouble)
+        return self.cdouble.value
+
+    def setAcquisitionValue(self, detChan: int, name: str, value: float) -> float:
+        """Writes <value> and returns the value actually set by the hardware."""
+        self.cdouble.value = value
+        self.status = self._setAcquisitionValues(detChan, encodeName(name), self.pdouble)
+        return self.cdouble.value
+
+    def boardOperation(self, detChan: int, name: str, value=None) -> int:
+        self.status = self._boardOperation(detChan, encodeName(name), self.pdouble if value is None else value)
+        return self.status
+
+    def apply(self, detChan: int, mask: int) -> int:
+        self.cshort.value = mask
+        self.status = self._boardOperation(detChan, NAMES["apply"], self.pshort)
+        return self.status
+
+    def getRunDataDouble(self, detChan: int, name: str) -> float:
+        self.status = self._getRunData(detChan, NAMES[name], self.pdouble)
+        return self.cdouble.value
+
+    def getRunDataShort(self, detChan: int, name: str) -> int:
+        self.status = self._getRunData(detChan, NAMES[name], self.pshort)
+        return self.cshort.value
+
+    def getRunDataULong(self, detChan: int, name: str) -> int:
+        self.status = self._getRunData(detChan, NAMES[name], self.pulong)
+        return self.culong.value
+
+    def getRunDataArray(self, detChan: int, name: str, buffer) -> int:
+        """Reads array run data (e.g. "mca") into <buffer>, a ctypes array or numpy array."""
+        self.status = self._getRunData(detChan, NAMES[name], buffer.ctypes.data if hasattr(buffer, "ctypes") else byref(buffer))
+        return self.status
+
+    def startRun(self, detChan: int, resume: int) -> int:
+        self.status = self._startRun(detChan, resume)
+        return self.status
+
+    def stopRun(self, detChan: int) -> int:
+        self.status = self._stopRun(detChan)
+        return self.status
@@ -0,0 +1,156 @@
+import sys
+import threading
+import time
+from typing import NamedTuple
+from rich.console import Console
+from theapp_errors import *
+
+# Levels as in the logging module
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+
+class HandelError(Exception):
+    """A Handel call returned a non-zero status. Every code of ERRORS has its own subclass, named as in ERRORS."""
+
+    status = None
+
+    def __init__(self, status: int, message: str = ""):
+        self.status = status
+        self.name = ERRORS.get(status, "unknown")
+        self.message = message
+        super().__init__(f"{status}, {self.name}" + (f" ({message})" if message else ""))
+
+
+# XIA_NOT_IDLE, DXP_LOG_LEVEL, ... as exception classes, by code
+HANDEL_ERRORS = {status: type(name, (HandelError,), {"status": status}) for status, name in ERRORS.items() if status != 0}
+globals().update({cls.__name__: cls for cls in HANDEL_ERRORS.values()})
+
+def handelError(status: int, message: str = "") -> HandelError:
+    """The typed exception for <status>, HandelError itself for unknown codes."""
+    return HANDEL_ERRORS.get(status, HandelError)(status, message)
+
+
+# code objects of functions that record events on behalf of their caller, see eventWrapper
+_WRAPPERS = set()
+
+def eventWrapper(func):
+    """Marks <func> as recording events for its caller (like XMagix.log), so ConsoleSink shows the caller's line."""
+    _WRAPPERS.add(func.__code__)
+    return func
+
+
+class Event(NamedTuple):
+    time: float         # time.monotonic()
+    level: int
+    source: str         # e.g. "handel", "tube", "interlock"
+    code: int           # Handel status, 0 if not applicable
+    message: str
+
+
+class EventLog:
+    """Preallocated ring of the last <capacity> events with pluggable sinks.
+
+    record() stores an event in the ring and hands it to every sink registered at or below its
+    level. Sinks are callables taking an Event: ConsoleSink and FileSink here, or anything a UI
+    wants to receive. Events below the lowest sink level cost one ring write, so hot loops can
+    keep recording with the console at WARNING or removed altogether. The ring keeps everything
+    for later inspection through events().
+
+    Usage:
+        log = EventLog()
+        log.addSink(ConsoleSink(), WARNING)
+        log.addSink(FileSink("/tmp/xmagix_events.log"), DEBUG)
+        log.record(INFO, "HV set to 40kV", source="tube")
+        log.events(level=WARNING)
+    """
+
+    def __init__(self, capacity: int = 4096):
+        self.capacity = capacity
+        self._ring = [None] * capacity    # Event per slot
+        self.written = 0
+        self.counts = {level: 0 for level in LEVEL_NAMES}
+        self._sinks = {}            # sink -> level
+        self._minLevel = ERROR + 1  # lowest level any sink wants
+        self._lock = threading.Lock()
+
+    def addSink(self, sink, level: int = INFO) -> None:
+        """Registers <sink> for events at <level> and above, or changes the level of a registered one."""
+        self._sinks[sink] = level
+        self._minLevel = min(self._sinks.values())
+
+    def removeSink(self, sink) -> None:
+        self._sinks.pop(sink, None)
+        self._minLevel = min(self._sinks.values(), default=ERROR + 1)
+
+    def record(self, level: int, message: str, code: int = 0, source: str = "") -> None:
+        event = Event(time.monotonic(), level, source, code, message)
+        with self._lock:
+            self._ring[self.written % self.capacity] = event
+            self.written += 1
+            self.counts[level] = self.counts.get(level, 0) + 1
+        if level >= self._minLevel:
+            for sink, sinkLevel in list(self._sinks.items()):
+                if level >= sinkLevel:
+                    sink(event)
+
+    def events(self, count: int = None, level: int = 0, source: str = None) -> list:
+        """The newest <count> buffered events (all by default) at <level> and above, oldest first."""
+
+        with self._lock:
+            end = self.written
+            start = max(0, end - min(self.capacity if count is None else count, self.capacity))
+            events = [self._ring[k % self.capacity] for k in range(start, end)]
+        return [e for e in events if e.level >= level and (source is None or e.source == source)]
+
+    def clear(self) -> None:
+        with self._lock:
+            self.written = 0
+            self.counts = {level: 0 for level in LEVEL_NAMES}
+
+
+class ConsoleSink:
+    """Renders events with rich, warnings and errors highlighted as XMagix always did.
+
+    The log path shown is the line that recorded the event, past EventLog.record and any
+    eventWrapper helpers in between.
+    """
+
+    STYLES = {WARNING: "[dark_orange] :warning: ", ERROR: "[red] :warning: "}
+
+    def __init__(self, console: Console = None):
+        self.console = console or Console()
+
+    def __call__(self, event: Event) -> None:
+        self.console.log(self.STYLES.get(event.level, "") + event.message, justify="left", _stack_offset=self._origin())
+
+    @staticmethod
+    def _origin() -> int:
+        """_stack_offset of console.log in __call__ that points at the code that recorded the event."""
+
+        frame = sys._getframe(2) # EventLog.record, or whoever called the sink
+        offset = 2
+        while frame.f_back is not None and (frame.f_code in _WRAPPERS or frame.f_code is EventLog.record.__code__):
+            frame = frame.f_back
+            offset += 1
+        return offset
+
+
+class FileSink:
+    """Appends one line per event to <path>."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def __call__(self, event: Event) -> None:
+        line = f"{event.time:.6f} {LEVEL_NAMES.get(event.level, event.level)} {event.source} {event.code} {event.message}\n"
+        with self._lock:
+            self._file.write(line)
+
+    def close(self) -> None:
+        self._file.close()
@@ -0,0 +1,146 @@
+import threading
+import time
+from dataclasses import dataclass
+import numpy as np
+from theevents import WARNING
+try:
+    import pigpio
+except ImportError:
+    pigpio = None
+import thesimpigpio
+
+gpio = pigpio or thesimpigpio # constants
+
+@dataclass
+class TripEvent:
+    """An interlock input went to its trip level. Ticks are pigpio microsecond ticks (32 bit, wrapping)."""
+    name: str
+    gpio: int
+    level: int
+    tick: int           # edge, as reported to the callback
+    offTick: int        # after the enable pin was written low
+    timestamp: float    # time.monotonic() of the handling, the clock of RunStats
+
+    @property
+    def latency(self) -> float:
+        """Edge to enable pin low, in seconds."""
+        return ((self.offTick - self.tick) & 0xffffffff) / 1e6
+
+
+class InterlockMonitor:
+    """Watches the filament ready line and interlock inputs of a Tube through pigpio edge callbacks.
+
+    <interlocks> maps a name to (gpio, trip level), e.g. {"door": (23, 0)}. When an interlock
+    reaches its trip level the enable pin is written low directly in the callback, before anything
+    else, so the emergency off takes one GPIO write after the edge is delivered. The latency from
+    the edge tick to that write is kept per event, see latency(). Afterwards a running regulator
+    is set to 0, and with <xm> the trip is logged on the XMagix instance, whose acquisition loops
+    then stop their run if <stopRun>. Until reset() Tube.enable() refuses to switch the supply on.
+
+    With <tripOnFilament> a falling filament ready line while the supply is enabled trips as well.
+    Either way filamentReady follows the line and waitFilament() blocks on the edge instead of
+    polling.
+
+    Usage:
+        monitor = tube.startMonitor({"door": (23, 0)}, xm=xm)
+        tube.enable(); tube.setI(250)
+        monitor.waitFilament(timeout=5)
+        ...
+        print(monitor.latency())
+    """
+
+    def __init__(self, tube, interlocks: dict = None, xm=None, stopRun: bool = True, tripOnFilament: bool = False, pullUp: bool = True):
+        self.tube = tube
+        self.pi = tube.pi
+        self.interlocks = dict(interlocks or {})
+        self.xm = xm
+        self.stopRun = stopRun
+        self.tripOnFilament = tripOnFilament
+        self.pullUp = pullUp
+        self.events = []
+        self.tripped = False
+        self._filament = threading.Event()
+        self._callbacks = []
+
+    @property
+    def filamentReady(self) -> bool:
+        return self._filament.is_set()
+
+    def start(self) -> None:
+        pi = self.pi
+        for name, (pin, level) in self.interlocks.items():
+            pi.set_mode(pin, gpio.INPUT)
+            pi.set_pull_up_down(pin, gpio.PUD_UP if self.pullUp else gpio.PUD_DOWN)
+            edge = gpio.RISING_EDGE if level else gpio.FALLING_EDGE
+            self._callbacks.append(pi.callback(pin, edge, self._interlockCallback(name, level)))
+            if pi.read(pin) == level:
+                self.trip(name, pin, level, pi.get_current_tick())
+
+        if pi.read(self.tube.filrdypin):
+            self._filament.set()
+        self._callbacks.append(pi.callback(self.tube.filrdypin, gpio.EITHER_EDGE, self._filamentCallback))
+
+    def stop(self) -> None:
+        for cb in self._callbacks:
+            cb.cancel()
+        self._callbacks = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _interlockCallback(self, name: str, tripLevel: int):
+        def callback(gpio: int, level: int, tick: int) -> None:
+            if level == tripLevel:
+                self.trip(name, gpio, level, tick)
+        return callback
+
+    def _filamentCallback(self, gpio: int, level: int, tick: int) -> None:
+        if level == 1:
+            self._filament.set()
+        elif level == 0:
+            self._filament.clear()
+            if self.tripOnFilament and self.tube.enabled:
+                self.trip("filament", gpio, level, tick)
+
+    def trip(self, name: str, gpio: int, level: int, tick: int) -> TripEvent:
+        """Emergency off: enable pin low first, then bookkeeping."""
+
+        self.pi.write(self.tube.enpin, 0)
+        offTick = self.pi.get_current_tick()
+        self.tube.enabled = False
+        self.tripped = True
+        event = TripEvent(name, gpio, level, tick, offTick, time.monotonic())
+        self.events.append(event)
+
+        if self.tube.regulator is not None:
+            self.tube.regulator.setpoints(0, 0)
+        if self.xm is not None:
+            # logging doesn't belong in the pigpio callback thread; interlockTripped leaves stopping the run to the acquisition thread
+            threading.Thread(target=self.xm.interlockTripped, args=(event, self.stopRun), name="InterlockMonitor-Trip", daemon=True).start()
+        return event
+
+    def reset(self) -> bool:
+        """Rearms after a trip once no interlock is at its trip level any more. The supply stays off."""
+
+        active = [name for name, (pin, level) in self.interlocks.items() if self.pi.read(pin) == level]
+        if active:
+            self.tube.log(WARNING, f"Interlock(s) {', '.join(active)} still active!")
+            return False
+        self.tripped = False
+        return True
+
+    def waitFilament(self, timeout: float = None) -> bool:
+        """Blocks until the filament ready line is high. False on timeout."""
+        return self._filament.wait(timeout)
+
+    def latency(self) -> dict:
+        """Edge to enable pin low over all trips, in seconds."""
+
+        latencies = np.array([event.latency for event in self.events])
+        if not len(latencies):
+            return {"trips": 0}
+        return {"trips": len(latencies), "mean": float(latencies.mean()), "max": float(latencies.max())}
@@ -0,0 +1,87 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from thebindings import *
+from thereadout import *
+from therunstats import *
+
+class MultiChannelSession:
+    """Starts, polls and reads out several detector channels together.
+
+    Per-channel Handel calls are spread across a pool of <workers> threads, each with its own
+    HandelBindings. Readouts land in a rotating set of <depth> preallocated (channels, bins)
+    arrays; channels with fewer bins than the widest one are zero padded.
+
+    Usage:
+        with MultiChannelSession(xm) as session:
+            session.start()
+            while session.isActive():
+                stats = session.poll()
+            spectra = session.read()
+    """
+
+    def __init__(self, xm, channels=None, workers: int = None, depth: int = 2):
+        self.xm = xm
+        if channels is None:
+            channels = range(xm.getNumDetectors())
+        self.channels = list(channels)
+        self.status = [0] * len(self.channels)
+
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=workers or len(self.channels), thread_name_prefix="XMagix-Channel")
+
+        handel = HandelBindings(xm._lib)
+        self.nbins = np.array([int(handel.getAcquisitionValue(chan, "number_mca_channels")) for chan in self.channels])
+        self.buffers = np.zeros((depth, len(self.channels), self.nbins.max()), dtype=MCA_DTYPE)
+        self._index = 0
+
+    def _handel(self) -> HandelBindings:
+        handel = getattr(self._local, "handel", None)
+        if handel is None:
+            handel = self._local.handel = HandelBindings(self.xm._lib)
+        return handel
+
+    def _map(self, func) -> list:
+        """Calls func(i, detChan) for every channel on the worker pool."""
+        return list(self._pool.map(func, range(len(self.channels)), self.channels))
+
+    def start(self, clearMca: bool = True) -> None:
+        def startChannel(i, detChan):
+            self.status[i] = self._handel().startRun(detChan, int(not clearMca))
+        self._map(startChannel)
+
+    def stop(self) -> None:
+        def stopChannel(i, detChan):
+            self.status[i] = self._handel().stopRun(detChan)
+        self._map(stopChannel)
+
+    def poll(self) -> list:
+        """Returns the RunStats of every channel."""
+        return self._map(lambda i, detChan: readRunStats(self._handel(), detChan))
+
+    def isActive(self) -> bool:
+        """True while a run is active on any channel."""
+        return any(self._map(lambda i, detChan: self._handel().getRunDataShort(detChan, "run_active")))
+
+    def read(self, out: np.ndarray = None) -> np.ndarray:
+        """Reads the MCA of every channel into <out> or the next buffer of the rotation and returns it as (channels, bins)."""
+
+        if out is None:
+            out = self.buffers[self._index]
+            self._index = (self._index + 1) % len(self.buffers)
+        elif out.shape != self.buffers.shape[1:] or out.dtype != MCA_DTYPE or not out.flags.c_contiguous:
+            raise ValueError(f"out must be a C-contiguous {MCA_DTYPE} array of shape {self.buffers.shape[1:]}.")
+
+        def readChannel(i, detChan):
+            self.status[i] = self._handel().getRunDataArray(detChan, "mca", out[i])
+        self._map(readChannel)
+        return out
+
+    def close(self) -> None:
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
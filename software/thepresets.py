@@ -0,0 +1,238 @@
+import json
+from ctypes import c_ushort, byref
+from dataclasses import dataclass, field, asdict
+from theapp_constants import *
+from theacquisition_values import *
+from theevents import WARNING
+from theshadow import changesMcaLayout, memoryMask
+
+PRESET_MEMORIES = ("parset", "genset")
+
+def presetMemory(name: str) -> str:
+    """"parset" or "genset" if the board saves acquisition value <name> in that memory, else None."""
+
+    memory = acquisition_value_memory.get(name)
+    if memory == "AV_MEM_PARSET":
+        return "parset"
+    if memory == "AV_MEM_GENSET" or isScaLimit(name):
+        return "genset"
+    return None
+
+
+@dataclass
+class Preset:
+    """A named set of acquisition values, split by the memory the board keeps them in."""
+    name: str
+    parset: dict = field(default_factory=dict)  # complete PARSET content
+    genset: dict = field(default_factory=dict)  # complete GENSET content
+    extra: dict = field(default_factory=dict)   # everything else (clock_speed, preset_type, ...), always written by diff
+    slots: dict = field(default_factory=dict)   # "parset"/"genset" -> slot holding that part, missing if none was free
+
+
+class PresetLibrary:
+    """Named measurement setups kept in the PARSETs and GENSETs of the board.
+
+    record() completes the given values with the rest of the current PARSET/GENSET (only the
+    memories the values touch), writes them into a free slot and saves it with save_parset /
+    save_genset. use() then switches by writing "parset" and/or "genset" alone, one value write per
+    memory, and updates the shadow from what the library knows the slot holds. Identical contents
+    share a slot. When all slots are taken a preset keeps no slot and use() falls back to diff
+    writes through the shadow, done in the <scratch> slot so no recorded slot is overwritten.
+
+    Slot 0 of each memory is the scratch slot by default, leaving the board's own setup alone.
+    save()/load() keep the slot assignment across sessions, the board keeps the slots themselves.
+
+    Usage:
+        presets = xm.enablePresets()
+        presets.record("fast", {"energy_gap_time": 0.15, "peak_interval": 0.6, "trigger_threshold": 40})
+        presets.record("fine", {"energy_gap_time": 0.3, "peak_interval": 4.8, "gain": 6.5})
+        presets.use("fast")
+    """
+
+    def __init__(self, xm, parsets: int = None, gensets: int = 2, scratch: int = 0):
+        self.xm = xm
+        self.shadow = xm.shadow or xm.enableShadow()
+        self.scratch = scratch
+        if parsets is None:
+            # one PARSET per peaking time of the FiPPI
+            count = c_ushort(0)
+            self.shadow.handel.boardOperation(xm.detChan, "get_number_pt_per_fippi", byref(count))
+            parsets = count.value or 1
+        self.counts = {"parset": parsets, "genset": gensets}
+        self.contents = {memory: {} for memory in PRESET_MEMORIES}     # slot -> values saved there
+        self.presets = {}
+        self.current = None
+        self.valueWrites = 0 # acquisition values written by use(), to see what switching costs
+
+    def freeSlot(self, memory: str) -> int:
+        for slot in range(self.counts[memory]):
+            if slot != self.scratch and slot not in self.contents[memory]:
+                return slot
+        return None
+
+    def _select(self, memory: str, slot: int, write: bool = True) -> None:
+        """Makes <slot> current and updates the shadow from its known content."""
+
+        shadow = self.shadow
+        if write:
+            shadow.handel.setAcquisitionValue(self.xm.detChan, memory, slot)
+            self.xm.status = shadow.status = shadow.handel.status
+            self.valueWrites += 1
+        content = self.contents[memory].get(slot)
+        if content is None:
+            # scratch slot, read back what the board loaded
+            content = {name: shadow.get(name, refresh=True) for name in list(shadow.values) if presetMemory(name) == memory}
+        if memory == "genset":
+            for name in [name for name in shadow.values if isScaLimit(name)]:
+                del shadow.values[name]
+        shadow.update({**content, memory: float(slot)})
+        self.xm._mcaLayout = None
+
+    def _changedLayout(self, changed: dict) -> None:
+        """Forgets the MCA layout of XMagix if <changed> touches it, as setParams does."""
+        if changesMcaLayout(changed):
+            self.xm._mcaLayout = None
+
+    def _same(self, content: dict, other: dict) -> bool:
+        """True if <content> written to the board gives the saved values <other>."""
+
+        shadow = self.shadow
+        return content.keys() == other.keys() and all(
+            abs(shadow.boardValue(name, value) - other[name]) <= shadow.tolerance * max(1.0, abs(other[name])) for name, value in content.items())
+
+    def _matches(self, memory: str, content: dict) -> bool:
+        """True if the board's current <memory> holds <content>, according to the shadow."""
+
+        values = self.shadow.values
+        return all(name in values and not self.shadow.differs(name, value) for name, value in content.items())
+
+    def record(self, name: str, params: dict) -> Preset:
+        """Stores <params> as preset <name> and leaves it active.
+
+        If writing, applying or saving a slot fails, nothing is recorded and None is returned.
+        """
+
+        shadow = self.shadow
+        handel = shadow.handel
+        detChan = self.xm.detChan
+        preset = Preset(name)
+        parts = {memory: {} for memory in PRESET_MEMORIES}
+        for key, value in params.items():
+            memory = presetMemory(key)
+            if memory is None:
+                preset.extra[key] = value
+            else:
+                parts[memory][key] = value
+
+        for memory, part in parts.items():
+            if not part:
+                continue
+            base = {key: value for key, value in shadow.values.items() if presetMemory(key) == memory}
+            if memory == "genset" and "number_of_scas" in part:
+                base = {key: value for key, value in base.items() if not isScaLimit(key)}
+            wanted = {**base, **part}
+            setattr(preset, memory, wanted)
+
+            shared = [slot for slot, content in self.contents[memory].items() if self._same(wanted, content)]
+            slot = shared[0] if shared else self.freeSlot(memory)
+            if slot is None:
+                self.xm.events.record(WARNING, f"No free {memory.upper()} for preset {name}, it is switched by diff writes.", 0, "presets")
+                continue
+            preset.slots[memory] = slot
+            if shared:
+                continue
+
+            # load the slot, write the whole content, apply and save it, stopping at the first error
+            handel.setAcquisitionValue(detChan, memory, slot)
+            failed = handel.status
+            content = {}
+            keys = list(wanted)
+            if memory == "genset" and "number_of_scas" in wanted:
+                keys.insert(0, keys.pop(keys.index("number_of_scas")))
+            for key in keys:
+                if failed:
+                    break
+                content[key] = handel.setAcquisitionValue(detChan, key, wanted[key])
+                failed = handel.status
+            if not failed:
+                failed = handel.apply(detChan, memoryMask(content))
+            if not failed:
+                slotValue = c_ushort(slot)
+                failed = handel.boardOperation(detChan, f"save_{memory}", byref(slotValue))
+            if failed:
+                # the slot stays free, the shadow reads back whatever the board holds now
+                self._select(memory, slot, write=False)
+                self.xm.status = failed
+                self.xm.CHECK_ERROR(f"Preset {name}: saving {memory.upper()} {slot} failed, preset not recorded...")
+                return None
+            self.xm.status = failed
+            self.contents[memory][slot] = content
+            self._select(memory, slot, write=False)
+            self.xm.CHECK_ERROR(f"Preset {name}: {len(content)} values saved in {memory.upper()} {slot}...")
+
+        self.presets[name] = preset
+        self.use(name)
+        return preset
+
+    def use(self, name: str) -> dict:
+        """Switches to preset <name>. Returns {memory: slot or "diff"} of what was done, empty if it was already set."""
+
+        preset = self.presets[name]
+        shadow = self.shadow
+        done = {}
+        for memory in PRESET_MEMORIES:
+            part = getattr(preset, memory)
+            if not part:
+                continue
+            slot = preset.slots.get(memory)
+            if slot is not None:
+                if shadow.values.get(memory) != slot or not self._matches(memory, self.contents[memory][slot]):
+                    self._select(memory, slot)
+                    done[memory] = slot
+            elif not self._matches(memory, part):
+                # never apply into a slot another preset owns
+                if shadow.values.get(memory) != self.scratch:
+                    self._select(memory, self.scratch)
+                changed = shadow.write(part)
+                self.valueWrites += len(changed)
+                self._changedLayout(changed)
+                done[memory] = "diff"
+        if preset.extra:
+            changed = shadow.write(preset.extra)
+            self.valueWrites += len(changed)
+            self._changedLayout(changed)
+            if changed:
+                done["extra"] = "diff"
+
+        self.xm.status = shadow.status
+        self.current = name
+        self.xm.CHECK_ERROR(f"Preset {name} active ({', '.join(f'{m} {s}' for m, s in done.items()) or 'unchanged'})...")
+        return done
+
+    def remove(self, name: str) -> None:
+        """Forgets preset <name>. Its slots become free unless another preset shares them."""
+
+        preset = self.presets.pop(name)
+        for memory, slot in preset.slots.items():
+            if not any(other.slots.get(memory) == slot for other in self.presets.values()):
+                self.contents[memory].pop(slot, None)
+        if self.current == name:
+            self.current = None
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump({"counts": self.counts,
+                       "scratch": self.scratch,
+                       "contents": {memory: {str(slot): content for slot, content in slots.items()} for memory, slots in self.contents.items()},
+                       "presets": [asdict(preset) for preset in self.presets.values()]}, f, indent=2)
+
+    def load(self, path: str) -> None:
+        """Restores the slot assignment saved by save(). The board must not have been reprogrammed in between."""
+
+        with open(path) as f:
+            d = json.load(f)
+        self.counts = d["counts"]
+        self.scratch = d["scratch"]
+        self.contents = {memory: {int(slot): content for slot, content in slots.items()} for memory, slots in d["contents"].items()}
+        self.presets = {p["name"]: Preset(**p) for p in d["presets"]}
+        self.current = None
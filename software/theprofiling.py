@@ -0,0 +1,221 @@
+import json
+import os
+import threading
+import time
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+console = Console()
+
+# Handel functions whose second argument is a name worth telling apart ("xiaBoardOperation(apply)")
+NAMED_CALLS = ("xiaSetAcquisitionValues", "xiaGetAcquisitionValues", "xiaBoardOperation", "xiaGetRunData")
+
+
+class LatencyHistogram:
+    """HDR-style histogram of latencies in nanoseconds.
+
+    Below 2 * 2**<subBits> ns every value has its own bucket; above, every power of two is split
+    into 2**<subBits> buckets, so any recorded value is known to 1 / 2**<subBits> (3% for 5 bits)
+    over the whole range while the histogram stays a few hundred counters.
+    """
+
+    def __init__(self, subBits: int = 5, maxBits: int = 40):
+        self.subBits = subBits
+        self.sub = 1 << subBits
+        self.counts = [0] * ((maxBits - subBits + 1) * self.sub)
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+
+    def index(self, ns: int) -> int:
+        if ns < 2 * self.sub:
+            return ns
+        e = ns.bit_length() - self.subBits - 1
+        return (e + 1) * self.sub + (ns >> e) - self.sub
+
+    def lowerBound(self, index: int) -> int:
+        """Smallest value counted in bucket <index>."""
+        if index < 2 * self.sub:
+            return index
+        e = index // self.sub - 1
+        return (index % self.sub + self.sub) << e
+
+    def record(self, ns: int) -> None:
+        index = self.index(ns)
+        if index >= len(self.counts):
+            index = len(self.counts) - 1
+        self.counts[index] += 1
+        self.total += 1
+        self.sum += ns
+        if ns > self.max:
+            self.max = ns
+        if self.min is None or ns < self.min:
+            self.min = ns
+
+    def percentile(self, q: float) -> int:
+        """Value below which <q> percent of the recordings lie, to the resolution of the buckets."""
+
+        if not self.total:
+            return 0
+        counts = np.cumsum(self.counts)
+        index = int(np.searchsorted(counts, q / 100 * self.total))
+        return min(self.lowerBound(index), self.max)
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.total if self.total else 0.0
+
+    def merge(self, other) -> None:
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+
+
+class Profiler:
+    """Call counts and latency histograms per function, optionally with a timeline.
+
+    XMagix.enableProfiling() and Tube.enableProfiling() route every Handel call and every SPI
+    transfer through a Profiler; disabling puts the original objects back, so there is no cost
+    at all when it is off. With <trace> the last <traceCapacity> calls are kept with start time,
+    duration and thread for exportChromeTrace() (chrome://tracing, Perfetto).
+
+    Usage:
+        profiler = xm.enableProfiling(trace=True)
+        tube.enableProfiling(profiler)
+        scan.run()
+        profiler.print()
+        profiler.exportChromeTrace("/tmp/scan_trace.json")
+    """
+
+    def __init__(self, trace: bool = False, traceCapacity: int = 100000, subBits: int = 5):
+        self.histograms = {}
+        self.trace = trace
+        self.traceCapacity = traceCapacity
+        self.subBits = subBits
+        self._trace = [None] * traceCapacity if trace else None
+        self.traced = 0
+        self.t0 = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def record(self, name: str, start: int, end: int) -> None:
+        """Books one call of <name> from <start> to <end> (time.perf_counter_ns())."""
+
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram(self.subBits)
+            histogram.record(end - start)
+            if self._trace is not None:
+                self._trace[self.traced % self.traceCapacity] = (name, start, end - start, threading.get_ident())
+                self.traced += 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self.histograms = {}
+            self.traced = 0
+            self.t0 = time.perf_counter_ns()
+
+    def summary(self) -> dict:
+        """Per function: calls, total/mean/p50/p99/max in seconds, sorted by total time."""
+
+        with self._lock:
+            items = list(self.histograms.items())
+        rows = {}
+        for name, h in sorted(items, key=lambda item: -item[1].sum):
+            rows[name] = {"calls": h.total, "total": h.sum / 1e9, "mean": h.mean / 1e9,
+                          "p50": h.percentile(50) / 1e9, "p99": h.percentile(99) / 1e9, "max": h.max / 1e9}
+        return rows
+
+    def print(self) -> None:
+        summary = self.summary()
+        elapsed = (time.perf_counter_ns() - self.t0) / 1e9
+        table = Table(title=f"{sum(row['calls'] for row in summary.values())} calls in {elapsed:.1f}s")
+        table.add_column("Function", style="bold", overflow="fold")
+        for column in ("Calls", "Total [s]", "Share", "Mean [us]", "p50 [us]", "p99 [us]", "Max [us]"):
+            table.add_column(column, justify="right")
+        for name, row in summary.items():
+            table.add_row(name, str(row["calls"]), f"{row['total']:.3f}", f"{100 * row['total'] / (elapsed or 1):.1f}%",
+                          *(f"{1e6 * row[key]:.1f}" for key in ("mean", "p50", "p99", "max")))
+        console.print(table)
+
+    def exportChromeTrace(self, path: str) -> int:
+        """Writes the traced calls as Chrome trace events to <path>. Returns the number of events."""
+
+        if self._trace is None:
+            raise ValueError("Profiler was created without trace=True.")
+        with self._lock:
+            start = max(0, self.traced - self.traceCapacity)
+            calls = [self._trace[k % self.traceCapacity] for k in range(start, self.traced)]
+        pid = os.getpid()
+        events = [{"name": name, "cat": name.split("(")[0], "ph": "X", "ts": (begin - self.t0) / 1e3, "dur": duration / 1e3,
+                   "pid": pid, "tid": tid} for name, begin, duration, tid in calls]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return len(events)
+
+
+class _Profiled:
+    """Proxy of <target> that times the calls of the functions <wrap>(name) selects; everything else passes through."""
+
+    def __init__(self, target, profiler: Profiler):
+        self._target = target
+        self._profiler = profiler
+
+    def _wrap(self, name: str) -> bool:
+        return False
+
+    def _label(self, name: str, args: tuple) -> str:
+        return name
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._target, name)
+        if not callable(attr) or not self._wrap(name):
+            return attr
+        profiler = self._profiler
+        label = self._label
+        counter = time.perf_counter_ns
+
+        def timed(*args, **kwargs):
+            start = counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                profiler.record(label(name, args), start, counter())
+
+        timed.__name__ = name
+        setattr(self, name, timed) # later lookups skip __getattr__
+        return timed
+
+
+class ProfiledLib(_Profiled):
+    """Handel library (ctypes or SimHandel) with every xia* call timed. Calls taking a name are booked as "xiaGetRunData(mca)"."""
+
+    def __init__(self, lib, profiler: Profiler):
+        super().__init__(lib, profiler)
+        self._labels = {}
+
+    def _wrap(self, name: str) -> bool:
+        return name.startswith("xia")
+
+    def _label(self, name: str, args: tuple) -> str:
+        if name not in NAMED_CALLS or len(args) < 2:
+            return name
+        key = (name, args[1])
+        label = self._labels.get(key)
+        if label is None:
+            value = args[1]
+            label = self._labels[key] = f"{name}({value.decode() if isinstance(value, bytes) else value})"
+        return label
+
+
+class ProfiledPi(_Profiled):
+    """pigpio.pi (or thesimpigpio.pi) with the SPI transfers timed."""
+
+    def _wrap(self, name: str) -> bool:
+        return name.startswith("spi_")
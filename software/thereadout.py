@@ -0,0 +1,60 @@
+import sys
+from ctypes import c_ulong
+import numpy as np
+
+# Handel returns MCA bins as unsigned long, whatever the wire format (bytes_per_bin) is
+MCA_DTYPE = np.dtype(c_ulong)
+
+# Acquisition values that change size or wire format of the MCA
+MCA_LAYOUT_VALUES = ("number_mca_channels", "bytes_per_bin")
+
+# Narrowest unsigned integer holding a bin transferred with <bytes_per_bin> bytes
+BIN_DTYPES = {
+    1: np.dtype(np.uint8),
+    2: np.dtype(np.uint16),
+    3: np.dtype(np.uint32),
+}
+
+def checkMcaBuffer(buffer: np.ndarray, nbins: int) -> None:
+    """Raises ValueError if Handel can not safely write <nbins> bins into <buffer>."""
+
+    if not isinstance(buffer, np.ndarray) or buffer.dtype != MCA_DTYPE:
+        raise ValueError(f"MCA buffer must be a numpy array of dtype {MCA_DTYPE}.")
+    if not buffer.flags.c_contiguous or not buffer.flags.writeable:
+        raise ValueError("MCA buffer must be C-contiguous and writeable.")
+    if buffer.size < nbins:
+        raise ValueError(f"MCA buffer holds {buffer.size} bins but {nbins} are read out.")
+
+def binView(buffer: np.ndarray, bytesPerBin: int) -> np.ndarray:
+    """Zero-copy view of the MCA <buffer> with the fixed width dtype matching <bytesPerBin>.
+
+    Bins never exceed what fits into <bytesPerBin> bytes, so the view just skips the zero
+    high-order bytes of every unsigned long instead of converting the array.
+    """
+
+    dtype = BIN_DTYPES[int(bytesPerBin)]
+    ratio = MCA_DTYPE.itemsize // dtype.itemsize
+    if ratio == 1:
+        return buffer
+    start = 0 if sys.byteorder == "little" else ratio - 1
+    return buffer.view(dtype)[start::ratio]
+
+
+class McaBufferPool:
+    """Rotating set of preallocated MCA buffers.
+
+    A buffer is only handed out again after <depth> - 1 further readouts, so consumers may keep
+    references to up to <depth> - 1 older spectra without copying them.
+    """
+
+    def __init__(self, nbins: int, depth: int = 4):
+        self.nbins = nbins
+        self.depth = depth
+        self.buffers = np.zeros((depth, nbins), dtype=MCA_DTYPE)
+        self.index = 0
+
+    def next(self) -> np.ndarray:
+        """Returns the next buffer of the rotation."""
+        buffer = self.buffers[self.index]
+        self.index = (self.index + 1) % self.depth
+        return buffer
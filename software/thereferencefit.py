@@ -0,0 +1,233 @@
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+def lawsonHanson(A: np.ndarray, b: np.ndarray, maxIter: int = None, tol: float = 1e-10) -> np.ndarray:
+    """Non-negative least squares min ||A x - b|| with x >= 0 for a single <b> (Lawson-Hanson active set).
+
+    The straightforward per-spectrum solver; ReferenceFit.fit gives the same result for whole batches.
+    """
+
+    A = np.asarray(A, dtype=float)
+    b = np.asarray(b, dtype=float)
+    k = A.shape[1]
+    x = np.zeros(k)
+    passive = np.zeros(k, dtype=bool)
+    for _ in range(maxIter or 3 * k):
+        gradient = A.T @ (b - A @ x)
+        if passive.all() or gradient[~passive].max() <= tol:
+            break
+        passive[np.argmax(np.where(passive, -np.inf, gradient))] = True
+        while True:
+            z = np.zeros(k)
+            z[passive] = np.linalg.lstsq(A[:, passive], b, rcond=None)[0]
+            if z[passive].min() > 0:
+                x = z
+                break
+            shrinking = passive & (z <= 0)
+            alpha = np.min(x[shrinking] / (x[shrinking] - z[shrinking]))
+            x = x + alpha * (z - x)
+            passive &= x > tol
+    return x
+
+
+class ReferenceFit:
+    """Fits every spectrum as a non-negative mix of reference spectra.
+
+    <references> is (k, bins), e.g. measured brass, steel and lead spectra (background stripped
+    or with a continuum reference added as one more row). The Gram matrix of the references is
+    computed once; a batch of spectra then only costs one (n, bins) x (bins, k) product plus
+    cheap k-dimensional work. NNLS is solved by projected coordinate descent on all spectra at
+    once, and the result is polished by an exact solve on the set of references each spectrum
+    uses, with one factorization per distinct set.
+
+    fitParallel spreads chunks over a process pool. Starting the pool and handing every worker
+    this object takes about 0.1s, so for repeated fits start it once with startPool() (or use the
+    object as a context manager); the pool and its shared memory then stay up until close(). The
+    spectra are still copied into shared memory on every call, about a third of what fit() costs
+    per pixel, so the pool pays off from two cores on and some 10^4 pixels per call. On a single
+    core fit() on chunks of about 1000 pixels is faster.
+
+    Usage:
+        fit = ReferenceFit(np.stack([brass, steel, lead]), names=["brass", "steel", "lead"])
+        weights = fit.fit(spectra)                  # (n, 3)
+        with fit.startPool():
+            for store in stores:
+                weights = fit.fitParallel(store)    # chunks spread over the process pool
+    """
+
+    def __init__(self, references: np.ndarray, names=None, sweeps: int = 50, tol: float = 1e-9):
+        self.references = np.atleast_2d(np.asarray(references, dtype=float))
+        self.k, self.nbins = self.references.shape
+        self.names = list(names) if names is not None else [f"ref{i}" for i in range(self.k)]
+        self.sweeps = sweeps
+        self.tol = tol
+
+        self.gram = self.references @ self.references.T
+        if np.any(np.diag(self.gram) <= 0):
+            raise ValueError("References must not be all zero.")
+        self._inverses = {} # support pattern -> inverse of the Gram sub-matrix
+        self._pool = None   # {"pool": ProcessPoolExecutor, "shm": [in, out]} while startPool() is active
+        self._finalizer = None
+
+    def __getstate__(self):
+        # workers get the references, not the pool
+        state = dict(self.__dict__)
+        state["_pool"] = state["_finalizer"] = None
+        return state
+
+    def startPool(self, workers: int = None):
+        """Starts a process pool of <workers> that fitParallel reuses until close()."""
+
+        self.close()
+        workers = workers or os.cpu_count() or 1
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_attachWorker, initargs=(self,))
+        self._pool = {"pool": pool, "shm": []}
+        self._finalizer = weakref.finalize(self, _release, self._pool)
+        return self
+
+    def close(self) -> None:
+        """Shuts the pool of startPool() down and frees its shared memory."""
+
+        if self._finalizer is not None:
+            self._finalizer()
+        self._pool = self._finalizer = None
+
+    def __enter__(self):
+        if self._pool is None:
+            self.startPool()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _sharedBlocks(self, resources: dict, inSize: int, outSize: int) -> list:
+        """Shared memory blocks of at least <inSize> and <outSize> bytes, grown as needed."""
+
+        blocks = resources["shm"]
+        for i, size in enumerate((inSize, outSize)):
+            if len(blocks) <= i:
+                blocks.append(shared_memory.SharedMemory(create=True, size=max(1, size)))
+            elif blocks[i].size < size:
+                blocks[i].close()
+                blocks[i].unlink()
+                blocks[i] = shared_memory.SharedMemory(create=True, size=size)
+        return blocks
+
+    def _inverse(self, support: tuple) -> np.ndarray:
+        inverse = self._inverses.get(support)
+        if inverse is None:
+            index = np.flatnonzero(support)
+            inverse = self._inverses[support] = np.linalg.inv(self.gram[np.ix_(index, index)])
+        return inverse
+
+    def fit(self, spectra: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """Returns the (n, k) non-negative weights of the references for the (n, bins) <spectra>."""
+
+        spectra = np.atleast_2d(spectra)
+        rhs = np.asarray(spectra, dtype=float) @ self.references.T
+        n = len(rhs)
+        x = np.zeros((n, self.k)) if out is None else out
+        x[...] = 0
+        gram = self.gram
+        diag = np.diag(gram)
+
+        # projected coordinate descent, all spectra per coordinate step
+        scale = np.abs(rhs).max() or 1.0
+        for _ in range(self.sweeps):
+            change = 0.0
+            for j in range(self.k):
+                old = x[:, j].copy()
+                x[:, j] = np.maximum(0.0, old + (rhs[:, j] - x @ gram[:, j]) / diag[j])
+                change = max(change, np.abs(x[:, j] - old).max() * diag[j])
+            if change <= self.tol * scale:
+                break
+
+        # exact solve on the support found, grouped by support pattern
+        support = x > 0
+        patterns, inverse = np.unique(support, axis=0, return_inverse=True)
+        for p, pattern in enumerate(patterns):
+            if not pattern.any():
+                continue
+            rows = np.flatnonzero(inverse.ravel() == p)
+            index = np.flatnonzero(pattern)
+            solved = rhs[np.ix_(rows, index)] @ self._inverse(tuple(pattern)).T
+            ok = (solved >= 0).all(axis=1)
+            x[np.ix_(rows[ok], index)] = solved[ok]
+        return x
+
+    def residual(self, spectra: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """Returns the sum of squared residuals of every spectrum."""
+        return ((np.atleast_2d(spectra) - weights @ self.references)**2).sum(axis=1)
+
+    def fitParallel(self, source, workers: int = None, chunkSize: int = 2048) -> np.ndarray:
+        """Fits a whole dataset on a pool of <workers> processes.
+
+        <source> is an (n, bins) array (memmaps work) or a thestore.SpectrumStore. The spectra are
+        copied once (in their own dtype) into a shared memory block, every worker solves row ranges of <chunkSize>
+        straight from it and writes its weights into a shared output block, so no spectra or
+        results are pickled. Uses the pool of startPool() if there is one, otherwise a pool is
+        started and shut down for this call.
+        """
+
+        n = len(source)
+        dtype = np.dtype(source.dtype)
+        resources = self._pool
+        temporary = resources is None
+        if temporary:
+            workers = workers or os.cpu_count() or 1
+            resources = {"pool": ProcessPoolExecutor(max_workers=workers, initializer=_attachWorker, initargs=(self,)), "shm": []}
+        try:
+            shmIn, shmOut = self._sharedBlocks(resources, n * self.nbins * dtype.itemsize, n * self.k * 8)
+            spectra = np.ndarray((n, self.nbins), dtype=dtype, buffer=shmIn.buf)
+            if hasattr(source, "iterChunks"):
+                for start, chunk, _ in source.iterChunks():
+                    spectra[start:start + len(chunk)] = chunk
+            else:
+                spectra[...] = source
+
+            tasks = [(shmIn.name, shmOut.name, n, dtype.str, start, min(start + chunkSize, n)) for start in range(0, n, chunkSize)]
+            for _ in resources["pool"].map(_fitRange, tasks):
+                pass
+            result = np.array(np.ndarray((n, self.k), dtype=float, buffer=shmOut.buf))
+            del spectra
+        finally:
+            if temporary:
+                _release(resources)
+        return result
+
+    def maps(self, weights: np.ndarray, shape: tuple) -> dict:
+        """Returns {name: weight map of <shape>} for the (n, k) <weights> of a raster scan."""
+        return {name: weights[:, i].reshape(shape) for i, name in enumerate(self.names)}
+
+
+# Per-process state of the fitParallel workers
+_worker = {}
+
+def _attachWorker(fit: ReferenceFit) -> None:
+    _worker.update(fit=fit, blocks=None)
+
+def _fitRange(task: tuple) -> None:
+    inName, outName, n, dtype, start, stop = task
+    # the blocks stay the same from call to call unless they had to grow
+    if _worker["blocks"] != (inName, outName, n, dtype):
+        for shm in _worker.get("shm", ()):
+            shm.close()
+        fit = _worker["fit"]
+        shmIn = shared_memory.SharedMemory(name=inName)
+        shmOut = shared_memory.SharedMemory(name=outName)
+        _worker.update(blocks=(inName, outName, n, dtype), shm=(shmIn, shmOut),
+                       spectra=np.ndarray((n, fit.nbins), dtype=np.dtype(dtype), buffer=shmIn.buf),
+                       weights=np.ndarray((n, fit.k), dtype=float, buffer=shmOut.buf))
+    _worker["fit"].fit(_worker["spectra"][start:stop], out=_worker["weights"][start:stop])
+
+def _release(resources: dict) -> None:
+    """Shuts down the pool and frees the shared memory of fitParallel."""
+
+    resources["pool"].shutdown()
+    for shm in resources["shm"]:
+        shm.close()
+        shm.unlink()
+    resources["shm"] = []
@@ -0,0 +1,165 @@
+import threading
+import time
+import numpy as np
+from thetubecal import *
+
+class TubeRegulator:
+    """Closed-loop regulation of HV and emission current of a Tube, in a background thread.
+
+    Every 1/<rate> seconds both ADC channels are read and the DAC codes are set to the calibrated
+    code of the command plus an integral correction (<ki> per second, in codes per code of error),
+    so drift of the supply against its calibration is taken out. Commands follow the setpoints at
+    no more than <hvRate> kV/s and <currentRate> uA/s, the integral is limited to <maxCorrection>
+    codes and the current code written never exceeds 12 W at the higher of commanded and measured
+    HV. Both codes go out in the same update (filament into the buffer, then HV), as in Tube.ramp.
+
+    While the supply is disabled the commands and the integral stay at 0, so enable() ramps up from
+    0 at the rates. The integral of a channel also holds until its command has been at the setpoint
+    for <holdTime> seconds, and while it measures less than <windupBand> of its command, so it only
+    corrects the settled output.
+
+    For every update the lateness against its schedule and the latency from ADC read to DAC write
+    are recorded, see timing().
+
+    Usage:
+        regulator = tube.regulate(rate=100)
+        tube.setHV(40)
+        tube.setI(250)
+        print(regulator.timing())
+        tube.stopRegulation()
+    """
+
+    def __init__(self,
+                 tube,
+                 rate: float = 100.0,
+                 ki: float = 5.0,
+                 hvRate: float = 10.0,
+                 currentRate: float = 200.0,
+                 maxCorrection: int = 400,
+                 holdTime: float = 0.5,
+                 windupBand: float = 0.5,
+                 history: int = 4096):
+        self.tube = tube
+        self.rate = rate
+        self.ki = ki
+        self.hvRate = hvRate
+        self.currentRate = currentRate
+        self.maxCorrection = maxCorrection
+        self.holdTime = holdTime
+        self.windupBand = windupBand
+
+        self.hvSet, self.currentSet = tube.hv, tube.i
+        self.command = np.array([tube.hv, tube.i], dtype=float)   # kV, uA, rate limited setpoints
+        self.correction = np.zeros(2)                               # codes
+        self.rested = np.zeros(2)                                   # seconds each command is at its setpoint
+        self.codes = np.zeros(2, dtype=np.int64)
+        self.measured = np.zeros(2)
+        # value of one code, for converting errors to codes
+        calibration = tube.calibration
+        self._perCode = np.array([calibration.hvDac.maxValue, calibration.iDac.maxValue]) / (DAC_CODES - 1)
+
+        self.updates = 0
+        self.overruns = 0
+        self._lateness = np.zeros(history)
+        self._latency = np.zeros(history)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def setpoints(self, hv: float, current: float) -> None:
+        """New targets in kV and uA, picked up by the next update."""
+        self.hvSet, self.currentSet = hv, current
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="TubeRegulator", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def update(self) -> None:
+        """One regulation step: read both channels, correct, write both codes."""
+
+        tube = self.tube
+        calibration = tube.calibration
+        period = 1.0 / self.rate
+        tRead = time.perf_counter()
+        hv = float(calibration.adcValue(tube.readRaw(False), False))
+        current = float(calibration.adcValue(tube.readRaw(True), True))
+        self.measured[:] = hv, current
+
+        command = self.command
+        if not tube.enabled:
+            # the output is off, switching on ramps up from 0 at the rates
+            command[:] = 0.0
+        hvSet = self.hvSet if self.hvSet >= 4 else 0.0
+        command[0] += np.clip(hvSet - command[0], -self.hvRate * period, self.hvRate * period)
+        cap = min(1000.0, MAX_POWER / max(command[0], hv, 1e-9))
+        currentSet = min(self.currentSet, cap)
+        command[1] += np.clip(currentSet - command[1], -self.currentRate * period, self.currentRate * period)
+        command[1] = min(command[1], cap)
+
+        active = command > 0
+        # the output lags a moving command, that error is no drift
+        self.rested = np.where(command == (hvSet, currentSet), self.rested + period, 0.0)
+        if tube.enabled:
+            integrate = active & (self.rested >= self.holdTime) & (self.measured >= self.windupBand * command)
+            self.correction += np.where(integrate, self.ki * period * (command - self.measured) / self._perCode, 0.0)
+            self.correction[~active] = 0.0
+            np.clip(self.correction, -self.maxCorrection, self.maxCorrection, out=self.correction)
+        else:
+            self.correction[:] = 0.0
+
+        codes = np.array([calibration.dacCode(command[0], 0), calibration.dacCode(command[1], 1)]) + np.rint(self.correction)
+        codes = np.where(active, np.clip(codes, 0, DAC_CODES - 1), 0).astype(np.int64)
+        codes[1] = min(codes[1], calibration.dacCode(cap, 1))
+        tube._dacWrite(DAC_BUFFER_BYTES[codes[1]].tobytes())
+        tube._dacWrite(DAC_BYTES[0, 0, codes[0]].tobytes())
+        self.codes = codes
+        self._latency[self.updates % len(self._latency)] = time.perf_counter() - tRead
+
+    def _loop(self) -> None:
+        period = 1.0 / self.rate
+        nextTick = time.perf_counter()
+        while not self._stop.is_set():
+            self._lateness[self.updates % len(self._lateness)] = time.perf_counter() - nextTick
+            self.update()
+            self.updates += 1
+
+            nextTick += period
+            now = time.perf_counter()
+            if nextTick < now:
+                missed = int((now - nextTick) / period) + 1
+                self.overruns += missed
+                nextTick += missed * period
+            self._stop.wait(nextTick - now)
+
+    def timing(self) -> dict:
+        """Update lateness (jitter) and read-to-write latency of the last updates, in seconds."""
+
+        n = min(self.updates, len(self._lateness))
+        if not n:
+            return {"updates": 0, "overruns": self.overruns}
+        lateness, latency = self._lateness[:n], self._latency[:n]
+        return {"updates": self.updates,
+                "overruns": self.overruns,
+                "jitterMean": float(lateness.mean()),
+                "jitterStd": float(lateness.std()),
+                "jitterP99": float(np.percentile(lateness, 99)),
+                "jitterMax": float(lateness.max()),
+                "latencyMean": float(latency.mean()),
+                "latencyMax": float(latency.max())}
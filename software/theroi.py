@@ -0,0 +1,205 @@
+import time
+from dataclasses import dataclass
+import numpy as np
+from theapp_constants import *
+from theanalysis import KNOWN_LINES
+from thebindings import *
+from thereadout import *
+from therunstats import *
+
+@dataclass(frozen=True)
+class Roi:
+    """Region of interest covering MCA bins lo..hi-1 (the same convention as SpectrumStore.roi)."""
+    name: str
+    lo: int
+    hi: int
+
+    @classmethod
+    def fromEnergy(cls, name: str, eLo: float, eHi: float, binWidth: float, offset: float = 0.0):
+        """ROI from energies in keV, for a <binWidth> in eV (mca_bin_width) and <offset> in keV."""
+        lo = int(np.floor((eLo - offset) * 1000.0 / binWidth))
+        hi = int(np.ceil((eHi - offset) * 1000.0 / binWidth))
+        return cls(name, max(lo, 0), max(hi, lo + 1))
+
+    @classmethod
+    def fromLine(cls, name: str, binWidth: float, width: float = 0.3, energy: float = None, offset: float = 0.0):
+        """ROI of <width> keV centered on the line <name> of KNOWN_LINES (or on <energy>)."""
+        energy = KNOWN_LINES[name] if energy is None else energy
+        return cls.fromEnergy(name, energy - width / 2, energy + width / 2, binWidth, offset)
+
+
+class RoiSet:
+    """A fixed set of ROIs, laid out for fast integration.
+
+    The bins of all ROIs are gathered into one index array, so integrating a spectrum (or a
+    delta of one) only touches the bins inside the ROIs, with a single np.add.reduceat.
+    Overlapping ROIs are fine.
+    """
+
+    def __init__(self, rois):
+        self.rois = list(rois)
+        if not self.rois:
+            raise ValueError("At least one ROI is needed.")
+        for roi in self.rois:
+            if not 0 <= roi.lo < roi.hi:
+                raise ValueError(f"ROI {roi.name} is empty or negative.")
+        self.names = [roi.name for roi in self.rois]
+        self.widths = np.array([roi.hi - roi.lo for roi in self.rois])
+        self._index = np.concatenate([np.arange(roi.lo, roi.hi) for roi in self.rois])
+        self._starts = np.concatenate([[0], np.cumsum(self.widths)[:-1]])
+
+    def __len__(self) -> int:
+        return len(self.rois)
+
+    def __iter__(self):
+        return iter(self.rois)
+
+    def integrate(self, spectra: np.ndarray) -> np.ndarray:
+        """Counts in every ROI of a spectrum (ROIs,) or of an (n, bins) stack (n, ROIs)."""
+        spectra = np.asarray(spectra)
+        return np.add.reduceat(spectra[..., self._index], self._starts, axis=-1)
+
+    def scaLimits(self) -> dict:
+        """Acquisition values that set up one hardware SCA per ROI (SCA limits are inclusive)."""
+
+        params = {"number_of_scas": float(len(self.rois))}
+        for n, roi in enumerate(self.rois):
+            params[f"sca{n}_lo"] = float(roi.lo)
+            params[f"sca{n}_hi"] = float(roi.hi - 1)
+        return params
+
+
+class RoiCounter:
+    """Live per-ROI counts and count rates of a running acquisition.
+
+    With <hardware> the board's SCA counters are read, which is one Handel call returning one
+    number per ROI. Otherwise every snapshot of a SpectrumStream is folded in from its delta,
+    which only sums the bins inside the ROIs. Either way an update costs O(ROIs), not O(bins).
+
+    Usage:
+        counter = xm.roiCounter()
+        for snapshot in xm.streamSpectra(interval=0.1):
+            counter.update(snapshot)
+            print(dict(zip(counter.names, counter.rates)))
+    """
+
+    def __init__(self, rois: RoiSet, xm=None, hardware: bool = False):
+        if hardware and xm is None:
+            raise ValueError("Reading the hardware SCAs needs an XMagix instance.")
+        self.rois = rois
+        self.names = rois.names
+        self.hardware = hardware
+        self.xm = xm
+        self._handel = HandelBindings(xm._lib) if hardware else None
+        self._sca = np.zeros(len(rois))
+        self.reset()
+
+    def reset(self) -> None:
+        self.counts = np.zeros(len(self.rois))     # since the start of the run
+        self.rates = np.zeros(len(self.rois))      # counts/s over the last update interval
+        self.timestamp = None
+        self.updates = 0
+
+    def update(self, snapshot=None) -> np.ndarray:
+        """Folds in the next SpectrumSnapshot (or reads the SCAs) and returns the counts per ROI."""
+
+        if self.hardware:
+            self._handel.getRunDataArray(self.xm.detChan, "sca", self._sca)
+            timestamp = time.monotonic()
+            added = self._sca - self.counts
+            self.counts[:] = self._sca
+        else:
+            if snapshot is None:
+                raise ValueError("Software ROIs are updated from SpectrumStream snapshots.")
+            timestamp = snapshot.timestamp
+            added = self.rois.integrate(snapshot.delta)
+            self.counts += added
+
+        if self.timestamp is not None and timestamp > self.timestamp:
+            self.rates[:] = added / (timestamp - self.timestamp)
+        self.timestamp = timestamp
+        self.updates += 1
+        return self.counts
+
+
+def relativeUncertainty(counts) -> np.ndarray:
+    """Relative 1 sigma Poisson uncertainty 1/sqrt(N) of ROI <counts>, inf for empty ROIs."""
+    counts = np.asarray(counts, dtype=float)
+    with np.errstate(divide="ignore"):
+        return np.where(counts > 0, 1 / np.sqrt(np.maximum(counts, 1)), np.inf)
+
+
+@dataclass
+class PrecisionResult:
+    """Outcome of a precision-targeted run."""
+    names: list                 # ROI names
+    targets: np.ndarray         # requested relative uncertainty per ROI, nan where none was given
+    counts: np.ndarray          # ROI counts at the end of the run
+    uncertainty: np.ndarray     # achieved relative uncertainty per ROI
+    realtime: float             # seconds the detector ran
+    met: bool                   # True if all targets were reached before the max time
+    stats: RunStats = None      # run statistics at the end of the run
+
+    def asDict(self) -> dict:
+        return {name: {"counts": float(n), "uncertainty": float(u), "target": float(t)}
+                for name, n, u, t in zip(self.names, self.counts, self.uncertainty, self.targets)}
+
+
+def runToPrecision(handel, detChan: int, rois: RoiSet, targets: dict, maxTime: float, pollInterval: float = 0.05,
+                   hardware: bool = False, clearMca: bool = True, buffer: np.ndarray = None, tripped=None) -> PrecisionResult:
+    """Runs until every ROI in <targets> ({name: relative uncertainty}) has enough counts, or for <maxTime> s.
+
+    The run is a preset realtime run of <maxTime>, so the board ends it by itself if the targets are
+    out of reach. In between the ROI counts are read (from the SCAs with <hardware>, else from the
+    MCA read into <buffer>) and the run is stopped as soon as 1/sqrt(N) <= target for all of them.
+    From the count rates seen so far the next poll is scheduled for when the slowest ROI should be
+    done, but at least every <pollInterval> seconds. The run also ends once <tripped>() is True, see
+    XMagix.tripWatch.
+    """
+
+    unknown = set(targets) - set(rois.names)
+    if unknown:
+        raise ValueError(f"No ROI named {', '.join(sorted(unknown))}.")
+    goal = np.array([targets.get(name, np.nan) for name in rois.names], dtype=float)
+    selected = ~np.isnan(goal)
+    needed = 1 / goal[selected]**2
+
+    if hardware:
+        sca = np.zeros(len(rois))
+        def read():
+            handel.getRunDataArray(detChan, "sca", sca)
+            return sca
+    else:
+        nbins = int(handel.getAcquisitionValue(detChan, "number_mca_channels"))
+        if buffer is None:
+            buffer = np.empty(nbins, dtype=MCA_DTYPE)
+        checkMcaBuffer(buffer, nbins)
+        def read():
+            handel.getRunDataArray(detChan, "mca", buffer)
+            return rois.integrate(buffer)
+
+    handel.setAcquisitionValue(detChan, "preset_type", CONSTANTS["XIA_PRESET_FIXED_REAL"])
+    handel.setAcquisitionValue(detChan, "preset_value", maxTime)
+    handel.startRun(detChan, int(not clearMca))
+    met = False
+    try:
+        while True:
+            counts = read()
+            realtime = handel.getRunDataDouble(detChan, "realtime")
+            if (counts[selected] >= needed).all():
+                met = True
+                handel.stopRun(detChan)
+                break
+            if not handel.getRunDataShort(detChan, "run_active") or (tripped is not None and tripped()):
+                break
+            rates = counts[selected] / realtime if realtime > 0 else np.zeros(len(needed))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                remaining = np.nanmax(np.where(rates > 0, (needed - counts[selected]) / rates, np.inf))
+            time.sleep(min(max(remaining, pollInterval / 10), pollInterval))
+    finally:
+        handel.setAcquisitionValue(detChan, "preset_type", CONSTANTS["XIA_PRESET_NONE"])
+
+    counts = np.array(read(), dtype=float)
+    stats = readRunStats(handel, detChan)
+    met = met or bool((counts[selected] >= needed).all())
+    return PrecisionResult(rois.names, goal, counts, relativeUncertainty(counts), stats.realtime, met, stats)
@@ -0,0 +1,17 @@
+run_data = {
+    # name: (C type of the returned value, description)
+    "mca_length": ("unsigned long", "The current size of the MCA data buffer for the specified channel."),
+    "mca": ("unsigned long[]", "The MCA data for the specified channel. Array of length mca_length."),
+    "baseline_length": ("unsigned long", "The current size of the baseline histogram for the specified channel."),
+    "baseline": ("unsigned long[]", "The baseline histogram for the specified channel. Array of length baseline_length."),
+    "runtime": ("double", "The runtime (realtime) in seconds of the current or last run."),
+    "realtime": ("double", "The realtime in seconds of the current or last run."),
+    "livetime": ("double", "The energy livetime in seconds of the current or last run."),
+    "trigger_livetime": ("double", "The trigger livetime in seconds of the current or last run."),
+    "input_count_rate": ("double", "The input count rate (ICR) in counts per second, triggers divided by trigger livetime."),
+    "output_count_rate": ("double", "The output count rate (OCR) in counts per second, events in run divided by realtime."),
+    "events_in_run": ("unsigned long", "The number of events that were binned into the MCA."),
+    "triggers": ("unsigned long", "The number of triggers seen by the trigger filter."),
+    "run_active": ("short", "Whether a run is currently active (0: idle)."),
+    "sca": ("double[]", "The SCA counters of the current run. Array of length number_of_scas."),
+}
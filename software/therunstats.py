@@ -0,0 +1,95 @@
+import time
+from dataclasses import dataclass
+import numpy as np
+
+# Column layout of a RunStatsHistory, in RunStats field order
+RUN_STATS_DTYPES = {
+    "timestamp": np.float64,
+    "runtime": np.float64,
+    "realtime": np.float64,
+    "livetime": np.float64,
+    "input_count_rate": np.float64,
+    "output_count_rate": np.float64,
+    "events_in_run": np.uint64,
+    "triggers": np.uint64,
+    "run_active": np.int16,
+}
+
+@dataclass
+class RunStats:
+    """Run statistics of one channel at <timestamp> (time.monotonic())."""
+    timestamp: float
+    runtime: float
+    realtime: float
+    livetime: float
+    input_count_rate: float
+    output_count_rate: float
+    events_in_run: int
+    triggers: int
+    run_active: int
+
+    @property
+    def deadTime(self) -> float:
+        """Fraction of input events lost, 1 - OCR/ICR."""
+        return 1 - self.output_count_rate / self.input_count_rate if self.input_count_rate else 0.0
+
+    def summary(self) -> str:
+        return (f"out cps: {self.output_count_rate:.2f}, in cps: {self.input_count_rate:.2f}, "
+                f"livetime: {self.livetime:.2f}/{self.realtime:.2f}s, dead time: {self.deadTime:.1%}, Events: {self.events_in_run}")
+
+def readRunStats(handel, detChan: int) -> RunStats:
+    """Reads all run statistics of <detChan> through the preallocated out-parameters of <handel> (a HandelBindings)."""
+
+    getDouble = handel.getRunDataDouble
+    getULong = handel.getRunDataULong
+    return RunStats(time.monotonic(),
+                    getDouble(detChan, "runtime"),
+                    getDouble(detChan, "realtime"),
+                    getDouble(detChan, "livetime"),
+                    getDouble(detChan, "input_count_rate"),
+                    getDouble(detChan, "output_count_rate"),
+                    getULong(detChan, "events_in_run"),
+                    getULong(detChan, "triggers"),
+                    handel.getRunDataShort(detChan, "run_active"))
+
+
+class RunStatsHistory:
+    """Columnar (struct-of-arrays) record of RunStats polls.
+
+    Columns are preallocated numpy arrays that grow by doubling, so appending a poll is a few
+    scalar stores. Use columns() for views of the recorded part and save() to write a .npz file.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.length = 0
+        self._columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in RUN_STATS_DTYPES.items()}
+        self._arrays = list(self._columns.values())
+
+    def __len__(self):
+        return self.length
+
+    def append(self, stats: RunStats) -> None:
+        if self.length == len(self._arrays[0]):
+            self._grow()
+        i = self.length
+        for array, value in zip(self._arrays, vars(stats).values()):
+            array[i] = value
+        self.length += 1
+
+    def _grow(self) -> None:
+        for name, array in self._columns.items():
+            grown = np.zeros(2 * len(array), dtype=array.dtype)
+            grown[:len(array)] = array
+            self._columns[name] = grown
+        self._arrays = list(self._columns.values())
+
+    def columns(self) -> dict:
+        """Returns {field: array} views of the recorded polls."""
+        return {name: array[:self.length] for name, array in self._columns.items()}
+
+    def last(self) -> RunStats:
+        return RunStats(*(array[self.length - 1].item() for array in self._arrays))
+
+    def save(self, path: str) -> None:
+        """Saves the recorded polls as .npz with one array per field."""
+        np.savez(path, **self.columns())
@@ -0,0 +1,265 @@
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+from theapp_constants import *
+from thebindings import *
+from thereadout import *
+from therunstats import *
+from theroi import *
+from thesettling import *
+from theevents import WARNING, ERROR
+
+console = Console()
+
+class KlipperStage:
+    """Sample stage driven by Klipper, talked to through the Moonraker HTTP API.
+
+    Positions are in mm, speeds in mm/s. moveTo() only queues the move, waitMoves() blocks until
+    the toolhead has stopped (M400).
+    """
+
+    def __init__(self, url: str = "http://localhost:7125", speed: float = 20.0, timeout: float = 60.0):
+        self.url = url.rstrip("/")
+        self.speed = speed
+        self.timeout = timeout
+
+    def _request(self, method: str, path: str) -> dict:
+        with urlopen(Request(self.url + path, method=method), timeout=self.timeout) as response:
+            return json.load(response)
+
+    def gcode(self, script: str) -> None:
+        self._request("POST", "/printer/gcode/script?script=" + quote(script))
+
+    def home(self, axes: str = "XY") -> None:
+        self.gcode("G28 " + " ".join(axes))
+
+    def _move(self, x, y, z, speed) -> str:
+        axes = " ".join(f"{axis}{value:.4f}" for axis, value in (("X", x), ("Y", y), ("Z", z)) if value is not None)
+        return f"G90\nG1 {axes} F{60 * (speed or self.speed):.0f}"
+
+    def moveTo(self, x: float = None, y: float = None, z: float = None, speed: float = None) -> None:
+        self.gcode(self._move(x, y, z, speed))
+
+    def waitMoves(self) -> None:
+        self.gcode("M400")
+
+    def moveAndWait(self, x: float = None, y: float = None, z: float = None, speed: float = None) -> None:
+        """Moves and returns once the toolhead stopped, in a single request."""
+        self.gcode(self._move(x, y, z, speed) + "\nM400")
+
+    def position(self) -> list:
+        """Returns the toolhead position [x, y, z, e]."""
+        return self._request("GET", "/printer/objects/query?toolhead")["result"]["status"]["toolhead"]["position"]
+
+
+def rasterGrid(x0: float, x1: float, nx: int, y0: float, y1: float, ny: int, serpentine: bool = True) -> np.ndarray:
+    """Returns the (nx * ny, 2) pixel positions of a raster. With <serpentine> every other row runs backwards."""
+
+    xs = np.linspace(x0, x1, nx)
+    ys = np.linspace(y0, y1, ny)
+    path = np.empty((nx * ny, 2))
+    for row, y in enumerate(ys):
+        path[row * nx:(row + 1) * nx, 0] = xs[::-1] if serpentine and row % 2 else xs
+        path[row * nx:(row + 1) * nx, 1] = y
+    return path
+
+
+@dataclass
+class ScanReport:
+    """Throughput and dead time of a scan. All times in seconds."""
+    pixels: int = 0
+    elapsed: float = 0.0
+    times: dict = field(default_factory=lambda: {"acquire": 0.0, "readout": 0.0, "move_wait": 0.0, "store_wait": 0.0, "settle": 0.0, "setup": 0.0})
+    results: list = field(default_factory=list) # PrecisionResult per pixel of a precision-targeted scan
+
+    @property
+    def pixelsPerHour(self) -> float:
+        return 3600 * self.pixels / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def deadTime(self) -> float:
+        return self.elapsed - self.times["acquire"]
+
+    def print(self) -> None:
+        table = Table(title=f"{self.pixels} pixels in {self.elapsed:.1f}s, {self.pixelsPerHour:.0f} pixels/h")
+        table.add_column("Phase", style="bold")
+        table.add_column("Time [s]", justify="right")
+        table.add_column("Share", justify="right")
+        table.add_column("Per pixel [ms]", justify="right")
+        for phase, t in self.times.items():
+            table.add_row(phase, f"{t:.2f}", f"{100 * t / (self.elapsed or 1):.1f}%", f"{1e3 * t / (self.pixels or 1):.1f}")
+        console.print(table)
+
+
+class RasterScan:
+    """Pipelined scan over a path of stage positions.
+
+    Per pixel the detector runs for <dwell> seconds of realtime. As soon as the run ends the move
+    to the next pixel is issued; the MCA readout of the current pixel overlaps with that move,
+    and storing it happens on a writer thread while the next pixel is acquired. Readouts go into
+    a pool of buffers that is deeper than the writer queue, so nothing is copied.
+
+    With <targets> ({ROI name: relative uncertainty}, ROIs from xm.setRois()) every pixel runs only
+    until the targets are met, with <dwell> as the maximum. The achieved uncertainties are kept in
+    report.results.
+
+    With a <tube> every acquisition waits for its output to settle first, see thesettling. Only
+    setpoint changes cost time; pass a configured SettlingDetector as <settling>, or False to skip.
+
+    An interlock trip reported to <xm> (see theinterlock) ends the scan before the next pixel.
+
+    With a running thetelemetry.TelemetrySampler as <telemetry> the kV/uA stored per pixel are
+    the means over its acquisition instead of single reads taken after it.
+
+    Usage:
+        scan = RasterScan(xm, KlipperStage(), store, rasterGrid(0, 10, 21, 0, 10, 21), dwell=1.0)
+        report = scan.run()
+        report.print()
+    """
+
+    def __init__(self, xm, stage, store, path, dwell: float, tube=None, pollInterval: float = 0.005, queueDepth: int = 8, targets: dict = None, telemetry=None, settling=None):
+        self.xm = xm
+        self.stage = stage
+        self.store = store
+        self.path = np.asarray(path, dtype=float)
+        self.dwell = dwell
+        self.tube = tube
+        self.pollInterval = pollInterval
+        self.queueDepth = queueDepth
+        self.targets = targets
+        self.telemetry = telemetry
+        if settling is None and tube is not None:
+            settling = SettlingDetector(tube, telemetry=telemetry)
+        self.settling = settling or None
+        if targets and xm.rois is None:
+            raise ValueError("Precision targets need ROIs, see XMagix.setRois().")
+        self.report = ScanReport()
+        self._stop = threading.Event()
+        self._writeError = None # exception of the writer thread, raised again by run()
+
+    def stop(self) -> None:
+        """Ends the scan after the current pixel."""
+        self._stop.set()
+
+    def _acquire(self, handel: HandelBindings) -> None:
+        """Runs one preset realtime acquisition to its end, or until the precision targets are met."""
+
+        detChan = self.xm.detChan
+        tripped = self.xm.tripWatch(handel)
+        if self.targets:
+            # ROI polls read the whole MCA unless SCAs are used, so don't poll more than ~20 times per pixel
+            result = runToPrecision(handel, detChan, self.xm.rois, self.targets, self.dwell, max(self.pollInterval, self.dwell / 20),
+                                    hardware=self.xm.scaRois, buffer=self._roiBuffer, tripped=tripped)
+            self.report.results.append(result)
+            return
+        handel.startRun(detChan, 0)
+        # sleep through most of the dwell, then poll for the end of the run
+        time.sleep(max(0.0, self.dwell - 2 * self.pollInterval))
+        while handel.getRunDataShort(detChan, "run_active") and not tripped():
+            time.sleep(self.pollInterval)
+
+    def _writer(self, pending: queue.Queue) -> None:
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            if self._writeError is not None:
+                continue # keep draining, so put() in run never blocks on a dead writer
+            try:
+                self.store.append(**item)
+            except Exception as e:
+                self._writeError = e
+
+    def _telemetry(self, t0: float, t1: float) -> tuple:
+        if self.telemetry is not None:
+            summary = self.telemetry.summary(t0, t1)
+            return summary["hv"][1], summary["current"][1]
+        if self.tube is None:
+            return np.nan, np.nan
+        return self.tube.read(False)[1], self.tube.read(True)[1]
+
+    def run(self) -> ScanReport:
+        report = self.report = ScanReport()
+        self._writeError = None
+        times = report.times
+        handel = HandelBindings(self.xm._lib)
+        detChan = self.xm.detChan
+        nbins = self.xm.getMcaLayout()[0]
+        pool = McaBufferPool(nbins, depth=self.queueDepth + 2)
+        self._roiBuffer = np.empty(nbins, dtype=MCA_DTYPE)
+        pending = queue.Queue(maxsize=self.queueDepth)
+        writer = threading.Thread(target=self._writer, args=(pending,), name="RasterScan-Store", daemon=True)
+        mover = ThreadPoolExecutor(max_workers=1, thread_name_prefix="RasterScan-Stage")
+
+        t0 = time.perf_counter()
+        handel.setAcquisitionValue(detChan, "preset_type", CONSTANTS["XIA_PRESET_FIXED_REAL"])
+        handel.setAcquisitionValue(detChan, "preset_value", self.dwell)
+        acquisitionValues = None
+        if self.xm.shadow is not None:
+            acquisitionValues = dict(self.xm.shadow.values, preset_type=CONSTANTS["XIA_PRESET_FIXED_REAL"], preset_value=self.dwell)
+        writer.start()
+        self.stage.moveAndWait(*self.path[0])
+        scanStart = time.perf_counter()
+        times["setup"] += scanStart - t0
+
+        trips = len(self.xm.interlockEvents)
+        try:
+            for i, position in enumerate(self.path):
+                if self._stop.is_set() or self._writeError is not None:
+                    break
+                if len(self.xm.interlockEvents) > trips:
+                    self.xm.log(ERROR, f"Scan paused at pixel {i} by interlock {self.xm.interlockEvents[-1].name}. Pixel {i - 1} may be incomplete.")
+                    break
+                if self.settling is not None:
+                    t = time.perf_counter()
+                    result = self.settling.wait()
+                    if not result.settled:
+                        self.xm.log(WARNING, f"Tube not settled after {result.elapsed:.1f}s at pixel {i} ({result.hv:.2f}kV, {result.current:.1f}uA).")
+                    times["settle"] += time.perf_counter() - t
+                t = time.perf_counter()
+                tRun = time.monotonic()
+                self._acquire(handel)
+                hv, current = self._telemetry(tRun, time.monotonic())
+                tAcquired = time.perf_counter()
+                times["acquire"] += tAcquired - t
+
+                move = None
+                if i + 1 < len(self.path):
+                    move = mover.submit(self.stage.moveAndWait, *self.path[i + 1])
+
+                spectrum = pool.next()
+                handel.getRunDataArray(detChan, "mca", spectrum)
+                stats = readRunStats(handel, detChan)
+                tRead = time.perf_counter()
+                times["readout"] += tRead - tAcquired
+
+                pending.put({"spectrum": spectrum, "position": (*position, np.nan) if len(position) == 2 else tuple(position),
+                             "hv": hv, "current": current, "stats": stats, "acquisitionValues": acquisitionValues})
+                tQueued = time.perf_counter()
+                times["store_wait"] += tQueued - tRead
+
+                if move is not None:
+                    move.result()
+                times["move_wait"] += time.perf_counter() - tQueued
+                report.pixels += 1
+        finally:
+            pending.put(None)
+            writer.join()
+            mover.shutdown()
+            if self._writeError is None:
+                self.store.flush()
+            handel.setAcquisitionValue(detChan, "preset_type", CONSTANTS["XIA_PRESET_NONE"])
+            if self.xm.shadow is not None:
+                self.xm.shadow.update({"preset_type": CONSTANTS["XIA_PRESET_NONE"], "preset_value": self.dwell})
+            report.elapsed = time.perf_counter() - t0
+        if self._writeError is not None:
+            raise self._writeError
+        return report
@@ -0,0 +1,119 @@
+import math
+import time
+from dataclasses import dataclass
+import numpy as np
+
+@dataclass
+class SettleResult:
+    settled: bool       # False if <maxWait> ran out first
+    elapsed: float      # seconds waited
+    hv: float           # mean kV over the last window
+    current: float      # mean uA over the last window
+
+
+class SettlingDetector:
+    """Decides when HV and emission current of a Tube have settled after a setpoint change.
+
+    Settled means that over the last <window> seconds the mean of each channel is within
+    <tolerance> (relative) of its setpoint and its peak-to-peak within <ripple> (relative), with
+    <hvFloor> kV and <currentFloor> uA as absolute lower bounds for both (for small setpoints and
+    ADC noise). A disabled supply has setpoints 0. With an InterlockMonitor on the tube the
+    filament ready line has to be high as well while the current is on.
+
+    wait() samples every <interval> seconds, from a running TelemetrySampler if given, otherwise by
+    reading the ADC itself, and returns as soon as the criterion holds or after <maxWait> seconds.
+    Once settled it returns at once until the setpoints or the enable state change.
+
+    Usage:
+        settling = SettlingDetector(tube)
+        tube.setHV(40); tube.setI(250)
+        result = settling.wait()
+    """
+
+    def __init__(self,
+                 tube,
+                 window: float = 0.1,
+                 interval: float = 0.005,
+                 tolerance: float = 0.01,
+                 ripple: float = 0.01,
+                 maxWait: float = 5.0,
+                 hvFloor: float = 0.2,
+                 currentFloor: float = 2.0,
+                 telemetry=None):
+        self.tube = tube
+        self.window = window
+        self.interval = interval
+        self.tolerance = tolerance
+        self.ripple = ripple
+        self.maxWait = maxWait
+        self.floors = np.array([hvFloor, currentFloor])
+        self.telemetry = telemetry
+        self.samples = max(2, math.ceil(window / interval))
+        self._buffer = np.zeros((self.samples, 2))
+        self._settledFor = None # (hv, current, enabled) of the last settled wait
+
+    def setpoints(self) -> np.ndarray:
+        tube = self.tube
+        return np.array([tube.hv, tube.i], dtype=float) if tube.enabled else np.zeros(2)
+
+    def isSettled(self, values: np.ndarray, setpoints: np.ndarray) -> bool:
+        """<values>: (samples, 2) kV and uA of one window."""
+
+        mean = values.mean(axis=0)
+        ptp = values.max(axis=0) - values.min(axis=0)
+        ok = np.all(np.abs(mean - setpoints) <= np.maximum(self.tolerance * setpoints, self.floors))
+        ok &= np.all(ptp <= np.maximum(self.ripple * setpoints, self.floors))
+        monitor = self.tube.monitor
+        if monitor is not None and setpoints[1] > 0:
+            ok &= monitor.filamentReady
+        return bool(ok)
+
+    def _window(self, count: int) -> np.ndarray:
+        """The last window of samples, None if there are not enough yet."""
+
+        if self.telemetry is not None:
+            _, hv, current = self.telemetry.window(time.monotonic() - self.window)
+            # a sampler slower than <interval> still needs a few samples
+            if len(hv) < min(self.samples, 3):
+                return None
+            return np.column_stack([hv, current])
+
+        tube = self.tube
+        calibration = tube.calibration
+        slot = count % self.samples
+        self._buffer[slot, 0] = calibration.adcValue(tube.readRaw(False), False)
+        self._buffer[slot, 1] = calibration.adcValue(tube.readRaw(True), True)
+        if count + 1 < self.samples:
+            return None
+        return self._buffer
+
+    def wait(self, force: bool = False) -> SettleResult:
+        """Blocks until settled or <maxWait> is over."""
+
+        key = (self.tube.hv, self.tube.i, self.tube.enabled)
+        if not force and key == self._settledFor:
+            return SettleResult(True, 0.0, self.tube.hv, self.tube.i)
+
+        t0 = time.perf_counter()
+        nextTick = t0
+        count = 0
+        values = None
+        while True:
+            setpoints = self.setpoints()
+            window = self._window(count)
+            count += 1
+            if window is not None:
+                values = window
+                if self.isSettled(window, setpoints):
+                    self._settledFor = key
+                    settled = True
+                    break
+            if time.perf_counter() - t0 >= self.maxWait:
+                self._settledFor = None
+                settled = False
+                break
+            nextTick += self.interval
+            time.sleep(max(0.0, nextTick - time.perf_counter()))
+
+        mean = values.mean(axis=0) if values is not None else (np.nan, np.nan)
+        return SettleResult(settled, time.perf_counter() - t0, float(mean[0]), float(mean[1]))
@@ -0,0 +1,119 @@
+from theapp_constants import *
+from theacquisition_values import *
+from thebindings import *
+from thereadout import MCA_LAYOUT_VALUES
+
+# Writing these makes the board reload or recompute other values, so the whole mirror is re-read
+RELOADING_VALUES = ("parset", "genset", "fippi", "clock_speed")
+
+def changesMcaLayout(names) -> bool:
+    """True if writing the acquisition values <names> can change size or wire format of the MCA."""
+    return any(name in MCA_LAYOUT_VALUES or name in RELOADING_VALUES for name in names)
+
+def memoryMask(names) -> int:
+    """ACQ_MEM_CONSTANTS mask "apply" needs to save the acquisition values <names>."""
+
+    mask = 0
+    for name in names:
+        if name.startswith("sca"):
+            mask |= ACQ_MEM_CONSTANTS["AV_MEM_GENSET"]
+        elif name in acquisition_value_memory:
+            mask |= ACQ_MEM_CONSTANTS[acquisition_value_memory[name]]
+    return mask or ACQ_MEM_CONSTANTS["AV_MEM_NONE"]
+
+
+class AcquisitionShadow:
+    """Mirror ("shadow registers") of the acquisition values of one detector channel.
+
+    The board is read once; afterwards reads are served from the mirror and write() only sends
+    values that differ from what the board holds, followed by a single "apply" with the memory
+    mask of the changed values. Since the board rounds some values (clock_speed, filter times), the
+    last requested value is remembered next to the value the board reported, and a request
+    matching either one is not sent again.
+    """
+
+    def __init__(self, lib, detChan: int = 0, tolerance: float = 1e-9):
+        self.handel = HandelBindings(lib)
+        self.detChan = detChan
+        self.tolerance = tolerance
+        self.values = {}
+        self.requested = {} # name -> last value written, before rounding by the board
+        self.status = 0
+
+    def refresh(self) -> dict:
+        """Reads all acquisition values from the board."""
+
+        getAcquisitionValue = self.handel.getAcquisitionValue
+        previous = self.values
+        self.values = {name: getAcquisitionValue(self.detChan, name) for name in acquisition_values}
+        # requests only stay valid for values the board did not change in the meantime
+        self.requested = {name: value for name, value in self.requested.items() if previous.get(name) == self.values.get(name)}
+        for n in range(int(self.values.get("number_of_scas", 0))):
+            for limit in ("lo", "hi"):
+                name = f"sca{n}_{limit}"
+                self.values[name] = getAcquisitionValue(self.detChan, name)
+        self.status = self.handel.status
+        return self.values
+
+    def get(self, name: str, refresh: bool = False) -> float:
+        """Returns <name> from the mirror, reading it from the board with <refresh> or when it was never read."""
+
+        if refresh or name not in self.values:
+            value = self.handel.getAcquisitionValue(self.detChan, name)
+            if self.values.get(name) != value:
+                self.requested.pop(name, None)
+            self.values[name] = value
+            self.status = self.handel.status
+        return self.values[name]
+
+    def update(self, values: dict) -> None:
+        """Takes over <values> written to the board past write(), their earlier requests no longer hold."""
+
+        self.values.update(values)
+        for name in values:
+            self.requested.pop(name, None)
+
+    def boardValue(self, name: str, value: float) -> float:
+        """<value> rounded the way the board stores <name>."""
+
+        if name == "clock_speed":
+            dspclk = BOARD_INFO["DSP Clock Speed"]
+            return min((dspclk / d for d in (1, 2, 4, 8)), key=lambda c: abs(c - value))
+        return value
+
+    def differs(self, name: str, value: float) -> bool:
+        if name not in self.values:
+            return True
+        if self.requested.get(name) == value:
+            return False
+        current = self.values[name]
+        return abs(self.boardValue(name, value) - current) > self.tolerance * max(1.0, abs(current))
+
+    def write(self, params: dict, apply: bool = True) -> dict:
+        """Writes the values of <params> that differ from the mirror and applies them at once.
+
+        Returns {name: value set by the board} of the values actually written.
+        """
+
+        changed = {}
+        failed = 0
+        for name, value in params.items():
+            if not self.differs(name, value):
+                continue
+            changed[name] = self.handel.setAcquisitionValue(self.detChan, name, value)
+            self.status = self.handel.status
+            if self.status != 0:
+                failed = self.status
+                changed.pop(name)
+                break
+            self.values[name] = changed[name]
+            self.requested[name] = value
+
+        # the values written before a failure are still applied, the failure stays the status
+        if changed and apply:
+            self.status = self.handel.apply(self.detChan, memoryMask(changed))
+        if any(name in RELOADING_VALUES for name in changed):
+            self.refresh()
+        if failed:
+            self.status = failed
+        return changed
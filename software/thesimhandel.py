@@ -0,0 +1,510 @@
+import threading
+import time
+from collections import Counter
+from ctypes import *
+import numpy as np
+from theapp_constants import *
+from theacquisition_values import *
+from thebindings import HANDEL_PROTOTYPES
+
+# Default acquisition values of a freshly started microDXP (values as read back from the board)
+SIM_ACQUISITION_DEFAULTS = {
+    "parset": 0.0,
+    "genset": 0.0,
+    "fippi": 0.0,
+    "clock_speed": 40.0,
+    "energy_gap_time": 0.15,
+    "trigger_peak_time": 0.2,
+    "trigger_gap_time": 0.0,
+    "baseline_length": 64.0,
+    "trigger_threshold": 20.0,
+    "baseline_threshold": 30.0,
+    "energy_threshold": 0.0,
+    "peak_interval_offset": 0.05,
+    "peak_sample_offset": 0.05,
+    "max_width": 1.0,
+    "peak_mode": 0.0,
+    "peak_interval": 1.2,
+    "peak_sample": 1.1,
+    "polarity": 1.0,
+    "preamp_value": 10.0,
+    "gain": 5.0,
+    "gain_trim": 1.0,
+    "preset_type": CONSTANTS["XIA_PRESET_NONE"],
+    "preset_value": 0.0,
+    "number_mca_channels": 2048.0,
+    "mca_bin_width": 20.0,
+    "bytes_per_bin": 3.0,
+    "adc_trace_wait": 0.0,
+    "auto_adjust_offset": 1.0,
+    "number_of_scas": 0.0,
+}
+
+SIM_MAX_SCAS = 16
+
+# Characteristic lines in keV -> relative area. Tungsten L lines of the tube target plus Fe K lines of a steel sample.
+SIM_DEFAULT_LINES = {
+    6.404: 1.0,     # Fe Ka
+    7.058: 0.13,    # Fe Kb
+    8.398: 0.35,    # W La
+    9.672: 0.25,    # W Lb
+}
+
+SIM_PEAKING_TIMES = [0.5, 1.0, 2.0, 4.0, 8.0]
+SIM_PARSETS = len(SIM_PEAKING_TIMES) # one PARSET per peaking time of the FiPPI
+SIM_GENSETS = 2
+SIM_SERIAL_NUMBER = b"SIMUDXP000000001"
+
+XIA_SUCCESS = 0
+XIA_BAD_VALUE = 304
+XIA_BAD_NAME = 306
+XIA_INVALID_DETCHAN = 316
+XIA_UNKNOWN_VALUE = 604
+
+def _int(arg) -> int:
+    """Value of a plain or ctypes integer argument."""
+    return int(getattr(arg, "value", arg))
+
+def _name(arg) -> str:
+    """Name argument as python string. Accepts bytes, str and c_char_p."""
+    arg = getattr(arg, "value", arg)
+    if isinstance(arg, bytes):
+        return arg.decode("ascii")
+    return str(arg)
+
+def _address(arg) -> int:
+    """Memory address behind a value argument (byref, ctypes object, pointer, numpy array or raw address)."""
+    obj = getattr(arg, "_obj", arg)
+    if isinstance(obj, int):
+        return obj
+    if isinstance(obj, c_void_p):
+        return obj.value
+    if isinstance(obj, np.ndarray):
+        return obj.ctypes.data
+    if hasattr(obj, "data_as"):
+        return obj.data
+    if hasattr(obj, "contents"):
+        return addressof(obj.contents)
+    return addressof(obj)
+
+def _write(arg, value, ctype=c_double) -> None:
+    """Writes a scalar into the out-parameter <arg>, interpreted as <ctype>."""
+    obj = getattr(arg, "_obj", arg)
+    if isinstance(obj, (c_double, c_float)):
+        obj.value = float(value)
+    elif isinstance(obj, (c_short, c_ushort, c_int, c_uint, c_long, c_ulong)):
+        obj.value = int(value)
+    else:
+        ctype.from_address(_address(arg)).value = value
+
+def _writeArray(arg, values, ctype) -> None:
+    """Copies <values> into the out-array <arg> holding elements of <ctype>."""
+    values = np.asarray(values)
+    dest = np.ctypeslib.as_array((ctype * len(values)).from_address(_address(arg)))
+    dest[:] = values
+
+def _read(arg, ctype=c_double):
+    """Reads a scalar from the in-parameter <arg>."""
+    obj = getattr(arg, "_obj", arg)
+    if hasattr(obj, "value") and not isinstance(obj, c_void_p):
+        return obj.value
+    return ctype.from_address(_address(arg)).value
+
+
+def _checked(func, argtypes: list):
+    """<func> behind the argument conversion ctypes does for a function with <argtypes>."""
+
+    def checked(*args):
+        if len(args) != len(argtypes):
+            raise TypeError(f"this function takes {len(argtypes)} argument{'s' if len(argtypes) != 1 else ''} ({len(args)} given)")
+        for i, (argtype, arg) in enumerate(zip(argtypes, args)):
+            try:
+                argtype.from_param(arg)
+            except TypeError as e:
+                raise ArgumentError(f"argument {i + 1}: TypeError: {e}") from None
+        return func(*args)
+
+    checked.__name__ = func.__name__
+    return checked
+
+
+class SimChannel:
+    """Run state of a single simulated detector channel."""
+
+    def __init__(self, values: dict):
+        self.values = dict(values)
+        self.running = False
+        self.tStart = 0.0
+        self.realtime = 0.0
+        self.mca = np.zeros(int(self.values["number_mca_channels"]), dtype=np.uint64)
+        # Board memory: values of every PARSET and GENSET as saved by save_parset/save_genset
+        self.parsets = [self.memory("AV_MEM_PARSET") for _ in range(SIM_PARSETS)]
+        self.gensets = [self.memory("AV_MEM_GENSET") for _ in range(SIM_GENSETS)]
+
+    def memory(self, kind: str) -> dict:
+        """Current values that are saved in a PARSET ("AV_MEM_PARSET") or GENSET ("AV_MEM_GENSET")."""
+        return {name: value for name, value in self.values.items()
+                if acquisition_value_memory.get(name) == kind or (kind == "AV_MEM_GENSET" and isScaLimit(name))}
+
+    def load(self, values: dict) -> None:
+        """Makes the saved <values> of a PARSET or GENSET current."""
+        if "number_of_scas" in values:
+            # SCA limits are part of the GENSET, drop those of the one loaded before
+            for name in [name for name in self.values if isScaLimit(name)]:
+                del self.values[name]
+        self.values.update(values)
+        if len(self.mca) != int(self.values["number_mca_channels"]):
+            self.mca = np.zeros(int(self.values["number_mca_channels"]), dtype=np.uint64)
+
+
+class SimHandel:
+    """Drop-in simulation of the microDXP Handel library.
+
+    Implements the xia* entry points XMagix calls with the same argument conventions as libhandel
+    (ctypes scalars passed by reference, byte string names, raw out-buffers). Every call can be
+    delayed by <latency> seconds to mimic the USB round trip. Spectra are generated from a
+    Kramers Bremsstrahlung continuum plus Gaussian characteristic lines at <countRate> input counts
+    per second with a paralyzable dead time of <deadTime> seconds. <timeScale> speeds up the
+    simulated clock, so a 10s preset run can finish in 10ms of wall time. Setting <paused> stops
+    counts from accumulating, which keeps the backend's own work out of benchmark figures.
+
+    With <checkArgs> every call converts its arguments with the HANDEL_PROTOTYPES argtypes as
+    ctypes does for the real library, so a call libhandel would refuse raises the same
+    ctypes.ArgumentError here.
+
+    Usage:
+        xm = XMagix("sim", lib=SimHandel(latency=200e-6))
+    """
+
+    def __init__(self,
+                 latency: float = 0.0,
+                 countRate: float = 20e3,
+                 tubeVoltage: float = 40.0,
+                 lines: dict = None,
+                 continuumFraction: float = 0.6,
+                 deadTime: float = 1.5e-6,
+                 nChannels: int = 1,
+                 timeScale: float = 1.0,
+                 seed: int = None,
+                 checkArgs: bool = True):
+
+        self.latency = latency
+        self.countRate = countRate
+        self.tubeVoltage = tubeVoltage
+        self.lines = SIM_DEFAULT_LINES if lines is None else lines
+        self.continuumFraction = continuumFraction
+        self.deadTime = deadTime
+        self.timeScale = timeScale
+        self.rng = np.random.default_rng(seed)
+        self.calls = Counter()
+        self.applyCount = 0
+        self.systemUp = False
+        self.logLevel = 0
+        self.logOutput = None
+        self.paused = False
+
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+        self._shapes = {}
+        self.channels = [SimChannel(SIM_ACQUISITION_DEFAULTS) for _ in range(nChannels)]
+        if checkArgs:
+            for fname, (_, argtypes) in HANDEL_PROTOTYPES.items():
+                setattr(self, fname, _checked(getattr(self, fname), argtypes))
+
+    # -------------------------------------------------------------------------------------------
+    # Model
+    # -------------------------------------------------------------------------------------------
+
+    def clock(self) -> float:
+        """Simulated time in seconds."""
+        return (time.perf_counter() - self._t0) * self.timeScale
+
+    def _delay(self, name):
+        self.calls[name] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def outputCountRate(self) -> float:
+        """Output count rate of the paralyzable dead time model."""
+        return self.countRate * np.exp(-self.countRate * self.deadTime)
+
+    def spectrumShape(self, nbins: int, binWidth: float) -> np.ndarray:
+        """Normalized expected spectrum (sums to 1) for <nbins> bins of <binWidth> eV."""
+
+        key = (nbins, binWidth, self.tubeVoltage, self.continuumFraction, tuple(self.lines.items()))
+        shape = self._shapes.get(key)
+        if shape is not None:
+            return shape
+
+        energy = (np.arange(nbins) + 0.5) * binWidth / 1000.0 # keV
+        # Kramers' law with a soft low energy cutoff from window and air absorption
+        continuum = np.clip(self.tubeVoltage - energy, 0, None) / energy
+        continuum *= 1.0 - np.exp(-(energy / 2.5)**3)
+        continuum /= continuum.sum() or 1.0
+
+        peaks = np.zeros(nbins)
+        for lineEnergy, area in self.lines.items():
+            # Fano limited resolution of a SDD plus electronic noise, as FWHM in keV
+            fwhm = np.sqrt(0.06**2 + 2.355**2 * 0.115 * 3.85e-3 * lineEnergy)
+            sigma = fwhm / 2.355
+            peaks += area * np.exp(-0.5 * ((energy - lineEnergy) / sigma)**2) / sigma
+        peaks /= peaks.sum() or 1.0
+
+        shape = self.continuumFraction * continuum + (1 - self.continuumFraction) * peaks
+        shape /= shape.sum()
+        self._shapes[key] = shape
+        return shape
+
+    def _presetRealtime(self, chan: SimChannel) -> float:
+        """Realtime at which the preset run of <chan> ends."""
+
+        presetType = chan.values["preset_type"]
+        preset = chan.values["preset_value"]
+        liveFraction = self.outputCountRate() / self.countRate if self.countRate else 1.0
+        if presetType == CONSTANTS["XIA_PRESET_FIXED_REAL"]:
+            return preset
+        if presetType == CONSTANTS["XIA_PRESET_FIXED_LIVE"]:
+            return preset / liveFraction
+        if presetType == CONSTANTS["XIA_PRESET_FIXED_EVENTS"] and self.countRate:
+            return preset / self.outputCountRate()
+        if presetType == CONSTANTS["XIA_PRESET_FIXED_TRIGGERS"] and self.countRate:
+            return preset / (self.countRate * liveFraction)
+        return np.inf
+
+    def _advance(self, chan: SimChannel) -> None:
+        """Accumulates counts of <chan> up to the current simulated time."""
+
+        if not chan.running:
+            return
+        now = self.clock()
+        end = self._presetRealtime(chan)
+        realtime = min(now - chan.tStart, end)
+        dt = realtime - chan.realtime
+        if dt > 0 and not self.paused:
+            shape = self.spectrumShape(len(chan.mca), chan.values["mca_bin_width"])
+            chan.mca += self.rng.poisson(shape * self.outputCountRate() * dt).astype(np.uint64)
+        chan.realtime = max(realtime, chan.realtime)
+        if realtime >= end:
+            chan.running = False
+
+    def _scaCounts(self, chan: SimChannel) -> list:
+        """Counts of the current run in the SCA windows, limits inclusive like on the board."""
+
+        counts = []
+        for n in range(int(chan.values["number_of_scas"])):
+            lo, hi = int(chan.values[f"sca{n}_lo"]), int(chan.values[f"sca{n}_hi"])
+            counts.append(float(chan.mca[lo:hi + 1].sum()) if hi >= lo else 0.0)
+        return counts
+
+    def _runData(self, chan: SimChannel, name: str):
+        liveFraction = self.outputCountRate() / self.countRate if self.countRate else 1.0
+        livetime = chan.realtime * liveFraction
+        scalars = {
+            "run_active": float(chan.running),
+            "runtime": chan.realtime,
+            "realtime": chan.realtime,
+            "livetime": livetime,
+            "trigger_livetime": livetime,
+            "input_count_rate": self.countRate,
+            "output_count_rate": self.outputCountRate() if chan.realtime else 0.0,
+            "events_in_run": float(chan.mca.sum()),
+            "triggers": self.countRate * livetime,
+            "mca_length": float(len(chan.mca)),
+        }
+        return scalars.get(name)
+
+    # -------------------------------------------------------------------------------------------
+    # Handel entry points
+    # -------------------------------------------------------------------------------------------
+
+    def _channel(self, detChan):
+        detChan = _int(detChan)
+        if 0 <= detChan < len(self.channels):
+            return self.channels[detChan]
+        return None
+
+    def xiaSetLogLevel(self, level):
+        self._delay("xiaSetLogLevel")
+        self.logLevel = _int(level)
+        return XIA_SUCCESS
+
+    def xiaSetLogOutput(self, path):
+        self._delay("xiaSetLogOutput")
+        self.logOutput = _name(path)
+        return XIA_SUCCESS
+
+    def xiaInit(self, inifile):
+        self._delay("xiaInit")
+        self.inifile = _name(inifile)
+        return XIA_SUCCESS
+
+    def xiaStartSystem(self):
+        self._delay("xiaStartSystem")
+        self.systemUp = True
+        return XIA_SUCCESS
+
+    def xiaExit(self):
+        self._delay("xiaExit")
+        self.systemUp = False
+        return XIA_SUCCESS
+
+    def xiaGetNumDetectors(self, value):
+        self._delay("xiaGetNumDetectors")
+        _write(value, len(self.channels), c_uint)
+        return XIA_SUCCESS
+
+    def xiaGetNumModules(self, value):
+        self._delay("xiaGetNumModules")
+        _write(value, len(self.channels), c_uint)
+        return XIA_SUCCESS
+
+    def xiaGetNumFirmwareSets(self, value):
+        self._delay("xiaGetNumFirmwareSets")
+        _write(value, 1, c_uint)
+        return XIA_SUCCESS
+
+    def xiaSetAcquisitionValues(self, detChan, name, value):
+        self._delay("xiaSetAcquisitionValues")
+        chan = self._channel(detChan)
+        if chan is None:
+            return XIA_INVALID_DETCHAN
+        name = _name(name)
+        if not isAcquisitionValue(name):
+            return XIA_UNKNOWN_VALUE
+        if isScaLimit(name) and int(name[3:-3]) >= chan.values["number_of_scas"]:
+            return XIA_BAD_VALUE
+
+        newValue = float(_read(value))
+        if name == "clock_speed":
+            # rounded to the nearest supported DSPCLK divider
+            dspclk = SIM_ACQUISITION_DEFAULTS["clock_speed"]
+            newValue = min((dspclk / d for d in (1, 2, 4, 8)), key=lambda c: abs(c - newValue))
+        elif name == "number_mca_channels":
+            if not 16 <= newValue <= 8192:
+                return XIA_BAD_VALUE
+            newValue = float(int(newValue))
+        elif name == "bytes_per_bin" and newValue not in (1, 2, 3):
+            return XIA_BAD_VALUE
+        elif name == "number_of_scas":
+            if not 0 <= newValue <= SIM_MAX_SCAS:
+                return XIA_BAD_VALUE
+            newValue = float(int(newValue))
+        elif isScaLimit(name):
+            newValue = float(int(newValue))
+        elif name in ("parset", "genset"):
+            slots = chan.parsets if name == "parset" else chan.gensets
+            if not 0 <= newValue < len(slots) or newValue != int(newValue):
+                return XIA_BAD_VALUE
+            with self._lock:
+                chan.load(slots[int(newValue)])
+                chan.values[name] = newValue
+            _write(value, newValue)
+            return XIA_SUCCESS
+
+        with self._lock:
+            chan.values[name] = newValue
+            if name == "number_mca_channels" and len(chan.mca) != int(newValue):
+                chan.mca = np.zeros(int(newValue), dtype=np.uint64)
+            if name == "number_of_scas":
+                for n in range(int(newValue)):
+                    chan.values.setdefault(f"sca{n}_lo", 0.0)
+                    chan.values.setdefault(f"sca{n}_hi", 0.0)
+        _write(value, newValue)
+        return XIA_SUCCESS
+
+    def xiaGetAcquisitionValues(self, detChan, name, value):
+        self._delay("xiaGetAcquisitionValues")
+        chan = self._channel(detChan)
+        if chan is None:
+            return XIA_INVALID_DETCHAN
+        name = _name(name)
+        if name not in chan.values:
+            return XIA_UNKNOWN_VALUE
+        _write(value, chan.values[name])
+        return XIA_SUCCESS
+
+    def xiaBoardOperation(self, detChan, name, value):
+        self._delay("xiaBoardOperation")
+        chan = self._channel(detChan)
+        if chan is None:
+            return XIA_INVALID_DETCHAN
+        name = _name(name)
+
+        if name == "apply":
+            self.applyCount += 1
+        elif name == "get_board_info":
+            _writeArray(value, list(BOARD_INFO.values()), c_ubyte)
+        elif name == "get_number_of_fippis":
+            _write(value, 1, c_ushort)
+        elif name == "get_number_pt_per_fippi":
+            _write(value, len(SIM_PEAKING_TIMES), c_ushort)
+        elif name in ("get_current_peaking_times", "get_peaking_times"):
+            _writeArray(value, SIM_PEAKING_TIMES, c_double)
+        elif name == "get_peaking_time_ranges":
+            _writeArray(value, [SIM_PEAKING_TIMES[0], SIM_PEAKING_TIMES[-1]], c_double)
+        elif name == "get_temperature":
+            _write(value, 31.0625, c_double)
+        elif name == "get_serial_number":
+            memmove(_address(value), SIM_SERIAL_NUMBER, len(SIM_SERIAL_NUMBER))
+        elif name == "get_preamp_type":
+            _write(value, 0, c_ushort)
+        elif name == "get_usb_version":
+            _write(value, (1 << 24) | (6 << 16), c_ulong)
+        elif name in ("save_parset", "save_genset"):
+            slot = int(_read(value, c_ushort))
+            slots = chan.parsets if name == "save_parset" else chan.gensets
+            if not 0 <= slot < len(slots):
+                return XIA_BAD_VALUE
+            with self._lock:
+                slots[slot] = chan.memory("AV_MEM_PARSET" if name == "save_parset" else "AV_MEM_GENSET")
+        else:
+            return XIA_BAD_NAME
+        return XIA_SUCCESS
+
+    def xiaStartRun(self, detChan, resume):
+        self._delay("xiaStartRun")
+        chan = self._channel(detChan)
+        if chan is None:
+            return XIA_INVALID_DETCHAN
+        with self._lock:
+            if not _int(resume):
+                chan.mca[:] = 0
+                chan.realtime = 0.0
+            chan.tStart = self.clock() - chan.realtime
+            chan.running = True
+        return XIA_SUCCESS
+
+    def xiaStopRun(self, detChan):
+        self._delay("xiaStopRun")
+        chan = self._channel(detChan)
+        if chan is None:
+            return XIA_INVALID_DETCHAN
+        with self._lock:
+            self._advance(chan)
+            chan.running = False
+        return XIA_SUCCESS
+
+    def xiaGetRunData(self, detChan, name, value):
+        self._delay("xiaGetRunData")
+        chan = self._channel(detChan)
+        if chan is None:
+            return XIA_INVALID_DETCHAN
+        name = _name(name)
+        with self._lock:
+            self._advance(chan)
+            if name == "mca":
+                _writeArray(value, chan.mca, c_ulong)
+                return XIA_SUCCESS
+            if name == "sca":
+                _writeArray(value, self._scaCounts(chan), c_double)
+                return XIA_SUCCESS
+            data = self._runData(chan, name)
+        if data is None:
+            return XIA_BAD_NAME
+        if name == "run_active":
+            _write(value, int(data), c_short)
+        elif name in ("events_in_run", "triggers", "mca_length"):
+            _write(value, int(data), c_ulong)
+        else:
+            _write(value, data, c_double)
+        return XIA_SUCCESS
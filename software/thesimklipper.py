@@ -0,0 +1,152 @@
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+class SimKlipper:
+    """Motion model of the Klipper driven sample stage (see klipper/printer.cfg).
+
+    Moves are queued like on the printer: each starts when the previous one is done and takes
+    distance / speed plus the time to accelerate and brake. <timeScale> speeds up the clock.
+    """
+
+    def __init__(self, maxVelocity: float = 20.0, maxAccel: float = 100.0, timeScale: float = 1.0):
+        self.maxVelocity = maxVelocity      # mm/s
+        self.maxAccel = maxAccel            # mm/s^2
+        self.timeScale = timeScale
+        self.position = [0.0, 0.0, 0.0]
+        self.absolute = True
+        self.feedrate = maxVelocity * 60    # mm/min
+        self.busyUntil = 0.0
+        self.commands = []
+        self._lock = threading.Lock()
+
+    def moveTime(self, distance: float, speed: float) -> float:
+        """Duration of a trapezoidal (or triangular) move in seconds."""
+
+        accelDistance = speed**2 / self.maxAccel
+        if distance >= accelDistance:
+            return distance / speed + speed / self.maxAccel
+        return 2 * math.sqrt(distance / self.maxAccel)
+
+    def _queueMove(self, target: list, speed: float) -> None:
+        distance = math.dist(self.position, target)
+        start = max(time.monotonic(), self.busyUntil)
+        self.busyUntil = start + self.moveTime(distance, speed) / self.timeScale if distance else start
+        self.position = target
+
+    def parse(self, words: list) -> dict:
+        """{letter: value} of the parameters of the command <words>, None for an axis without value ("G28 X Y")."""
+
+        args = {}
+        for word in words[1:]:
+            try:
+                args[word[0]] = float(word[1:]) if len(word) > 1 else None
+            except ValueError:
+                raise ValueError(f"Malformed command '{' '.join(words)}'") from None
+        return args
+
+    def gcode(self, script: str) -> None:
+        """Executes a G-code script. Returns once it is done, M400 waits for queued moves.
+
+        Raises ValueError on a malformed line, after executing the lines before it.
+        """
+
+        for line in script.splitlines():
+            words = line.split(";")[0].upper().split()
+            if not words:
+                continue
+            with self._lock:
+                self.commands.append(" ".join(words))
+                command, args = words[0], self.parse(words)
+                if command == "G90":
+                    self.absolute = True
+                elif command == "G91":
+                    self.absolute = False
+                elif command in ("G0", "G1"):
+                    if None in args.values():
+                        raise ValueError(f"Malformed command '{' '.join(words)}'")
+                    if "F" in args:
+                        self.feedrate = args["F"]
+                    target = list(self.position)
+                    for axis, i in (("X", 0), ("Y", 1), ("Z", 2)):
+                        if axis in args:
+                            target[i] = args[axis] if self.absolute else target[i] + args[axis]
+                    self._queueMove(target, min(self.feedrate / 60, self.maxVelocity))
+                elif command == "G28":
+                    # the named axes, X and Y without any
+                    axes = [axis for axis in "XYZ" if axis in args] or ["X", "Y"]
+                    target = [0.0 if axis in axes else value for axis, value in zip("XYZ", self.position)]
+                    self._queueMove(target, 10 / 60)
+                wait = self.busyUntil - time.monotonic() if command in ("M400", "G28") else 0
+            if wait > 0:
+                time.sleep(wait)
+
+    def toolhead(self) -> dict:
+        with self._lock:
+            return {"position": [*self.position, 0.0], "moving": time.monotonic() < self.busyUntil}
+
+
+class SimMoonraker:
+    """Local stand-in for the Moonraker HTTP API in front of a SimKlipper.
+
+    Serves POST /printer/gcode/script?script=... and GET /printer/objects/query?toolhead on
+    127.0.0.1, so KlipperStage can be tested without the printer board.
+
+    Usage:
+        with SimMoonraker(timeScale=10) as server:
+            stage = KlipperStage(server.url)
+    """
+
+    def __init__(self, port: int = 0, **klipperKwargs):
+        self.klipper = SimKlipper(**klipperKwargs)
+        klipper = self.klipper
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, code: int, payload: dict):
+                body = json.dumps(payload).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path != "/printer/gcode/script":
+                    return self._reply(404, {"error": {"code": 404, "message": "Not found"}})
+                try:
+                    klipper.gcode(parse_qs(url.query).get("script", [""])[0])
+                except ValueError as e:
+                    # as Moonraker reports a G-code error of Klipper
+                    return self._reply(400, {"error": {"code": 400, "message": str(e)}})
+                self._reply(200, {"result": "ok"})
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != "/printer/objects/query":
+                    return self._reply(404, {"error": {"code": 404, "message": "Not found"}})
+                self._reply(200, {"result": {"eventtime": time.monotonic(), "status": {"toolhead": klipper.toolhead()}}})
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, name="SimMoonraker", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,238 @@
+import math
+import threading
+import time
+import numpy as np
+
+# pigpio constants used by Tube (same values as in pigpio)
+INPUT = 0
+OUTPUT = 1
+PUD_OFF = 0
+PUD_DOWN = 1
+PUD_UP = 2
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+PI_BAD_HANDLE = -25
+
+# GPIOs and SPI channels of the tube controller board
+SIM_FILRDY_PIN = 24
+SIM_ENABLE_PIN = 25
+SIM_ADC_CHANNEL = 0
+SIM_DAC_CHANNEL = 1
+
+
+class SimTubeSupply:
+    """Model of the HV and filament supply behind the TLV5618A DAC and MCP3202 ADC.
+
+    Outputs follow their DAC setpoints with first-order lags of <hvTau> and <currentTau> seconds,
+    but only while the enable GPIO is high. Setpoints and read backs use the linear factors of the
+    uncalibrated Tube (kV and uA per code), scaled by <hvGain> and <currentGain> to mimic a
+    drifting supply. The filament ready line is high once the current is within <readyBand> of a
+    non-zero setpoint.
+    """
+
+    def __init__(self, hvTau: float = 0.15, currentTau: float = 0.3, noise: float = 1.0, readyBand: float = 0.02, seed: int = None,
+                 hvPerCode: float = 0.017, currentPerCode: float = 0.291, hvPerAdc: float = 0.018, currentPerAdc: float = 0.302,
+                 hvGain: float = 1.0, currentGain: float = 1.0):
+        self.hvTau = hvTau
+        self.currentTau = currentTau
+        self.noise = noise                  # ADC noise, codes rms
+        self.readyBand = readyBand
+        self.hvPerCode = hvPerCode
+        self.currentPerCode = currentPerCode
+        self.hvPerAdc = hvPerAdc
+        self.currentPerAdc = currentPerAdc
+        self.hvGain = hvGain
+        self.currentGain = currentGain
+        self.rng = np.random.default_rng(seed)
+
+        self.dacA = 0           # HV code
+        self.dacB = 0           # filament current code
+        self.buffer = 0         # TLV5618A double buffer for DAC B
+        self.poweredDown = False
+        self.enabled = False
+        self._hv = 0.0
+        self._current = 0.0
+        self._t = time.monotonic()
+
+    def targets(self) -> tuple:
+        if not self.enabled or self.poweredDown:
+            return 0.0, 0.0
+        return self.dacA * self.hvPerCode * self.hvGain, self.dacB * self.currentPerCode * self.currentGain
+
+    def advance(self, now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+        dt = now - self._t
+        if dt > 0:
+            hvTarget, currentTarget = self.targets()
+            self._hv = hvTarget + (self._hv - hvTarget) * math.exp(-dt / self.hvTau)
+            self._current = currentTarget + (self._current - currentTarget) * math.exp(-dt / self.currentTau)
+            self._t = now
+
+    def outputs(self) -> tuple:
+        """Actual (kV, uA) now."""
+        self.advance()
+        return self._hv, self._current
+
+    def filamentReady(self) -> bool:
+        _, target = self.targets()
+        _, current = self.outputs()
+        return target > 0 and abs(current - target) <= self.readyBand * target
+
+    def dacWrite(self, data: bytes) -> None:
+        """Decodes a TLV5618A word: R1 (bit 15), SPD (14), PWR (13), R0 (12), 12 bit code."""
+
+        self.advance()
+        word = (data[-2] << 8) | data[-1] # only the last 16 bits are latched
+        code = word & 0xfff
+        self.poweredDown = bool(word & 0x2000)
+        register = ((word >> 14) & 0b10) | ((word >> 12) & 0b01)
+        if register == 0b10:    # DAC A, DAC B from buffer
+            self.dacA = code
+            self.dacB = self.buffer
+        elif register == 0b00:  # DAC B and buffer
+            self.dacB = self.buffer = code
+        elif register == 0b01:  # buffer only
+            self.buffer = code
+
+    def adcRead(self, channel: int) -> int:
+        hv, current = self.outputs()
+        value = current / self.currentPerAdc if channel else hv / self.hvPerAdc
+        return int(np.clip(round(value + self.noise * self.rng.standard_normal()), 0, 4095))
+
+
+class _Callback:
+    def __init__(self, pi, gpio: int, edge: int, func):
+        self.pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+        self.tally = 0
+
+    def cancel(self) -> None:
+        with self.pi._lock:
+            if self in self.pi._callbacks:
+                self.pi._callbacks.remove(self)
+
+
+class pi:
+    """Stand-in for pigpio.pi() with the tube controller board attached.
+
+    Covers the calls Tube makes: GPIO mode/pull/read/write, SPI open/close/write/xfer and edge
+    callbacks. Every SPI write is logged with its time in <spiLog>. Interlock inputs are
+    driven with setLevel(); the filament ready line produces edges by itself (checked every
+    <edgeInterval> seconds while a callback watches it).
+
+    Usage:
+        tube = Tube(pi=thesimpigpio.pi())
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 8888, supply: SimTubeSupply = None, edgeInterval: float = 0.001, **supplyKwargs):
+        self.connected = True
+        self.supply = supply or SimTubeSupply(**supplyKwargs)
+        self.modes = {}
+        self.pulls = {}
+        self.levels = {}
+        self.spiLog = [] # (time.monotonic(), handle, bytes)
+        self._spi = {}
+        self._nextHandle = 0
+        self._callbacks = []
+        self._lock = threading.RLock()
+        self.edgeInterval = edgeInterval
+        self._edgeThread = None
+
+    def stop(self) -> None:
+        self.connected = False
+        if self._edgeThread is not None:
+            self._edgeThread.join()
+
+    def get_current_tick(self) -> int:
+        return int(time.monotonic() * 1e6) & 0xffffffff
+
+    # GPIO ----------------------------------------------------------------------------------------
+
+    def set_mode(self, gpio: int, mode: int) -> int:
+        self.modes[gpio] = mode
+        return 0
+
+    def set_pull_up_down(self, gpio: int, pud: int) -> int:
+        self.pulls[gpio] = pud
+        return 0
+
+    def read(self, gpio: int) -> int:
+        if gpio == SIM_FILRDY_PIN:
+            return int(self.supply.filamentReady())
+        return self.levels.get(gpio, int(self.pulls.get(gpio) == PUD_UP))
+
+    def write(self, gpio: int, level) -> int:
+        self.setLevel(gpio, int(bool(level)))
+        if gpio == SIM_ENABLE_PIN:
+            with self._lock:
+                self.supply.advance()
+                self.supply.enabled = bool(level)
+        return 0
+
+    def setLevel(self, gpio: int, level: int) -> None:
+        """Drives <gpio> from the outside (e.g. an interlock) and fires matching callbacks."""
+
+        with self._lock:
+            old = self.levels.get(gpio, int(self.pulls.get(gpio) == PUD_UP))
+            self.levels[gpio] = level
+            callbacks = [cb for cb in self._callbacks if cb.gpio == gpio] if old != level else []
+        tick = self.get_current_tick()
+        for cb in callbacks:
+            if cb.edge == EITHER_EDGE or cb.edge == (RISING_EDGE if level else FALLING_EDGE):
+                cb.tally += 1
+                if cb.func is not None:
+                    cb.func(gpio, level, tick)
+
+    def callback(self, user_gpio: int, edge: int = RISING_EDGE, func=None) -> _Callback:
+        cb = _Callback(self, user_gpio, edge, func)
+        with self._lock:
+            self._callbacks.append(cb)
+            if user_gpio == SIM_FILRDY_PIN and self._edgeThread is None:
+                self._edgeThread = threading.Thread(target=self._filamentEdges, name="SimPigpio-Edges", daemon=True)
+                self._edgeThread.start()
+        return cb
+
+    def _filamentEdges(self) -> None:
+        while self.connected:
+            with self._lock:
+                ready = int(self.supply.filamentReady())
+            if ready != self.levels.get(SIM_FILRDY_PIN, 0):
+                self.setLevel(SIM_FILRDY_PIN, ready)
+            time.sleep(self.edgeInterval)
+
+    # SPI -----------------------------------------------------------------------------------------
+
+    def spi_open(self, spi_channel: int, baud: int, spi_flags: int = 0) -> int:
+        with self._lock:
+            handle = self._nextHandle
+            self._nextHandle += 1
+            self._spi[handle] = (spi_channel, baud, spi_flags)
+        return handle
+
+    def spi_close(self, handle: int) -> int:
+        with self._lock:
+            return 0 if self._spi.pop(handle, None) is not None else PI_BAD_HANDLE
+
+    def spi_write(self, handle: int, data) -> int:
+        data = bytes(data)
+        with self._lock:
+            if handle not in self._spi:
+                return PI_BAD_HANDLE
+            self.spiLog.append((time.monotonic(), handle, data))
+            if self._spi[handle][0] == SIM_DAC_CHANNEL:
+                self.supply.dacWrite(data)
+        return len(data)
+
+    def spi_xfer(self, handle: int, data) -> tuple:
+        data = bytes(data)
+        with self._lock:
+            if handle not in self._spi:
+                return PI_BAD_HANDLE, bytearray()
+            if self._spi[handle][0] != SIM_ADC_CHANNEL:
+                return len(data), bytearray(len(data))
+            word = int.from_bytes(data, "big")
+            raw = self.supply.adcRead((word >> 14) & 1)
+        return len(data), bytearray([0, raw >> 8, raw & 0xff])
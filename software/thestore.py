@@ -0,0 +1,281 @@
+import json
+import os
+import time
+import numpy as np
+
+STORE_VERSION = 1
+
+# Per-spectrum metadata. Acquisition values are stored once per distinct set ("recipe") in the header.
+META_DTYPE = np.dtype([
+    ("timestamp", np.float64),
+    ("x", np.float64),
+    ("y", np.float64),
+    ("z", np.float64),
+    ("hv", np.float64),                 # kV, from Tube
+    ("current", np.float64),            # uA, from Tube
+    ("realtime", np.float64),
+    ("livetime", np.float64),
+    ("input_count_rate", np.float64),
+    ("output_count_rate", np.float64),
+    ("events_in_run", np.uint64),
+    ("triggers", np.uint64),
+    ("recipe", np.int32),               # index into the header's recipes, -1 if none
+])
+
+class SpectrumStore:
+    """Append-only, chunked on-disk store for the spectra of a scan.
+
+    A store is a directory holding header.json plus one spectra file (chunkSize x nbins) and one
+    metadata file per chunk. Uncompressed chunks are plain .npy files and are memory mapped for
+    reading; compressed chunks are .npz files decompressed one chunk at a time. Reading a pixel,
+    an ROI across all pixels or the sum spectrum never holds more than one chunk in memory.
+
+    Usage:
+        with SpectrumStore("scan.xms", nbins=2048, mode="w") as store:
+            store.append(mca, position=(x, y, 0), hv=40, current=100, stats=xm.getRunStats())
+        store = SpectrumStore("scan.xms")
+        leadMap = store.roi(520, 540)
+    """
+
+    def __init__(self, path: str, nbins: int = None, mode: str = "r", chunkSize: int = 1024, dtype=np.uint32, compress: bool = False):
+        self.path = path
+        self.mode = mode
+        headerPath = os.path.join(path, "header.json")
+
+        if mode == "w":
+            if nbins is None:
+                raise ValueError("nbins is needed to create a store.")
+            os.makedirs(path, exist_ok=False)
+            self.header = {
+                "version": STORE_VERSION,
+                "nbins": int(nbins),
+                "dtype": np.dtype(dtype).str,
+                "chunkSize": int(chunkSize),
+                "compress": bool(compress),
+                "chunks": [], # number of spectra per chunk
+                "recipes": [],
+            }
+            self._writeHeader()
+        elif mode in ("r", "a"):
+            with open(headerPath) as f:
+                self.header = json.load(f)
+        else:
+            raise ValueError("mode must be 'r', 'w' or 'a'.")
+
+        self.nbins = self.header["nbins"]
+        self.dtype = np.dtype(self.header["dtype"])
+        self.chunkSize = self.header["chunkSize"]
+        self.compress = self.header["compress"]
+        self._recipeIndex = {self._recipeKey(r): i for i, r in enumerate(self.header["recipes"])}
+        self._cache = (None, None, None) # (chunk, spectra, meta) of the last decompressed chunk
+
+        self._spectra = None
+        self._meta = None
+        self._fill = 0
+        if mode != "r":
+            self._spectra = np.zeros((self.chunkSize, self.nbins), dtype=self.dtype)
+            self._meta = np.zeros(self.chunkSize, dtype=META_DTYPE)
+            chunks = self.header["chunks"]
+            if chunks and chunks[-1] < self.chunkSize:
+                # continue filling the last, partial chunk
+                spectra, meta = self._loadChunk(len(chunks) - 1)
+                self._fill = chunks[-1]
+                self._spectra[:self._fill] = spectra
+                self._meta[:self._fill] = meta
+                chunks.pop()
+
+    # ---------------------------------------------------------------------------------------------
+    # Writing
+    # ---------------------------------------------------------------------------------------------
+
+    @staticmethod
+    def _recipeKey(acquisitionValues: dict) -> tuple:
+        return tuple(sorted(acquisitionValues.items()))
+
+    @staticmethod
+    def _replace(path: str, write) -> None:
+        """Writes <path> through write(file) into a temporary file and renames it over <path>.
+
+        A crash leaves the previous file, and readers that memory mapped it keep the old inode
+        instead of seeing it truncated.
+        """
+
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _writeHeader(self) -> None:
+        self._replace(os.path.join(self.path, "header.json"), lambda f: f.write(json.dumps(self.header).encode()))
+
+    def _chunkPath(self, chunk: int, kind: str) -> str:
+        return os.path.join(self.path, f"{kind}_{chunk:05d}.{'npz' if self.compress else 'npy'}")
+
+    def append(self,
+               spectrum: np.ndarray,
+               position: tuple = (np.nan, np.nan, np.nan),
+               hv: float = np.nan,
+               current: float = np.nan,
+               stats=None,
+               acquisitionValues: dict = None,
+               timestamp: float = None) -> int:
+        """Appends one spectrum with its metadata and returns its index. <stats> is a RunStats."""
+
+        if self._spectra is None:
+            raise ValueError("Store is opened read-only.")
+
+        recipe = -1
+        if acquisitionValues is not None:
+            key = self._recipeKey(acquisitionValues)
+            recipe = self._recipeIndex.get(key)
+            if recipe is None:
+                recipe = self._recipeIndex[key] = len(self.header["recipes"])
+                self.header["recipes"].append(dict(acquisitionValues))
+
+        index = sum(self.header["chunks"]) + self._fill
+        i = self._fill
+        self._spectra[i] = spectrum
+        meta = self._meta[i]
+        meta["timestamp"] = time.time() if timestamp is None else timestamp
+        meta["x"], meta["y"], meta["z"] = position
+        meta["hv"] = hv
+        meta["current"] = current
+        if stats is not None:
+            meta["realtime"] = stats.realtime
+            meta["livetime"] = stats.livetime
+            meta["input_count_rate"] = stats.input_count_rate
+            meta["output_count_rate"] = stats.output_count_rate
+            meta["events_in_run"] = stats.events_in_run
+            meta["triggers"] = stats.triggers
+        meta["recipe"] = recipe
+
+        self._fill += 1
+        if self._fill == self.chunkSize:
+            self.flush()
+        return index
+
+    def flush(self) -> None:
+        """Writes the chunk being filled to disk, then the header counting it.
+
+        A partial chunk is replaced by the next flush, never rewritten in place, so the spectra the
+        header counts stay readable whatever happens during a flush.
+        """
+
+        if self._spectra is None or self._fill == 0:
+            return
+        chunk = len(self.header["chunks"])
+        spectra = self._spectra[:self._fill]
+        meta = self._meta[:self._fill]
+        if self.compress:
+            self._replace(self._chunkPath(chunk, "spectra"), lambda f: np.savez_compressed(f, spectra=spectra))
+            self._replace(self._chunkPath(chunk, "meta"), lambda f: np.savez_compressed(f, meta=meta))
+        else:
+            self._replace(self._chunkPath(chunk, "spectra"), lambda f: np.save(f, spectra))
+            self._replace(self._chunkPath(chunk, "meta"), lambda f: np.save(f, meta))
+
+        if self._fill == self.chunkSize:
+            self.header["chunks"].append(self._fill)
+            self._fill = 0
+            self._writeHeader()
+        else:
+            # record the partial chunk, but keep filling it
+            self.header["chunks"].append(self._fill)
+            self._writeHeader()
+            self.header["chunks"].pop()
+        self._cache = (None, None, None)
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ---------------------------------------------------------------------------------------------
+    # Reading
+    # ---------------------------------------------------------------------------------------------
+
+    def _chunkCounts(self) -> list:
+        counts = list(self.header["chunks"])
+        if self._fill:
+            counts.append(self._fill)
+        return counts
+
+    def __len__(self) -> int:
+        return sum(self._chunkCounts())
+
+    def _loadChunk(self, chunk: int) -> tuple:
+        """Returns (spectra, meta) of <chunk>, memory mapped if uncompressed."""
+
+        if self._fill and chunk == len(self.header["chunks"]):
+            return self._spectra[:self._fill], self._meta[:self._fill]
+        if not self.compress:
+            return (np.load(self._chunkPath(chunk, "spectra"), mmap_mode="r"),
+                    np.load(self._chunkPath(chunk, "meta"), mmap_mode="r"))
+        cached, spectra, meta = self._cache
+        if cached != chunk:
+            with np.load(self._chunkPath(chunk, "spectra")) as f:
+                spectra = f["spectra"]
+            with np.load(self._chunkPath(chunk, "meta")) as f:
+                meta = f["meta"]
+            self._cache = (chunk, spectra, meta)
+        return spectra, meta
+
+    def iterChunks(self):
+        """Yields (start index, spectra, meta) for every chunk."""
+
+        start = 0
+        for chunk, count in enumerate(self._chunkCounts()):
+            spectra, meta = self._loadChunk(chunk)
+            yield start, spectra[:count], meta[:count]
+            start += count
+
+    def _locate(self, index: int) -> tuple:
+        """Returns (chunk, offset in chunk) of spectrum <index>."""
+
+        if index < 0:
+            index += len(self)
+        for chunk, count in enumerate(self._chunkCounts()):
+            if 0 <= index < count:
+                return chunk, index
+            index -= count
+        raise IndexError("spectrum index out of range")
+
+    def spectrum(self, index: int) -> np.ndarray:
+        """Returns the spectrum with <index>."""
+
+        chunk, offset = self._locate(index)
+        return np.array(self._loadChunk(chunk)[0][offset])
+
+    def metadata(self) -> np.ndarray:
+        """Returns the metadata of all spectra as one structured array."""
+
+        metas = [meta for _, _, meta in self.iterChunks()]
+        return np.concatenate(metas) if metas else np.zeros(0, dtype=META_DTYPE)
+
+    def recipe(self, index: int) -> dict:
+        """Returns the acquisition values recorded with spectrum <index>."""
+
+        chunk, offset = self._locate(index)
+        recipe = int(self._loadChunk(chunk)[1]["recipe"][offset])
+        return self.header["recipes"][recipe] if recipe >= 0 else None
+
+    def roi(self, lo: int, hi: int) -> np.ndarray:
+        """Returns the counts in bins lo..hi-1 of every spectrum."""
+
+        out = np.zeros(len(self), dtype=np.uint64)
+        for start, spectra, _ in self.iterChunks():
+            out[start:start + len(spectra)] = spectra[:, lo:hi].sum(axis=1, dtype=np.uint64)
+        return out
+
+    def sum(self) -> np.ndarray:
+        """Returns the sum of all spectra."""
+
+        total = np.zeros(self.nbins, dtype=np.uint64)
+        for _, spectra, _ in self.iterChunks():
+            total += spectra.sum(axis=0, dtype=np.uint64)
+        return total
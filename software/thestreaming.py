@@ -0,0 +1,160 @@
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+import numpy as np
+from thebindings import *
+from thereadout import *
+from therunstats import *
+
+STREAM_POLICIES = ("coalesce", "drop")
+
+@dataclass
+class SpectrumSnapshot:
+    """One sample of a running acquisition.
+
+    <spectrum> and <delta> live in buffers owned by the stream and are recycled once the next
+    snapshot is requested. Copy them to keep them longer.
+    """
+    index: int              # running number of the sampled frame
+    timestamp: float        # time.monotonic() when the MCA was read
+    spectrum: np.ndarray    # cumulative spectrum of the run
+    delta: np.ndarray       # counts added since the previously delivered snapshot
+    stats: RunStats         # run statistics at readout time
+    frames: int = 1         # sampled frames merged into this snapshot
+    dropped: int = 0        # frames dropped right before this snapshot
+    slot: int = field(default=-1, repr=False) # buffer slot in the stream
+
+
+class SpectrumStream:
+    """Samples the MCA of a running acquisition at a fixed cadence in a background thread.
+
+    Frames are handed to the consumer through a queue of at most <maxFrames> entries. All buffers
+    are preallocated, so memory stays bounded however slow the consumer is. When the queue is full
+    the "coalesce" policy merges the newest queued frame into the incoming one (deltas add up, no
+    counts are lost), the "drop" policy discards the oldest queued frame. The acquisition itself is
+    never stalled by the consumer.
+
+    The sampler thread uses its own HandelBindings. Don't issue other Handel calls while streaming.
+    """
+
+    def __init__(self, xm, interval: float = 0.5, maxFrames: int = 8, policy: str = "coalesce", clearMca: bool = False):
+        if policy not in STREAM_POLICIES:
+            raise ValueError(f"policy must be one of {STREAM_POLICIES}")
+
+        self.xm = xm
+        self.interval = interval
+        self.maxFrames = maxFrames
+        self.policy = policy
+        self.clearMca = clearMca
+        self.dropped = 0
+        self.coalesced = 0
+
+        nbins = xm.getMcaLayout()[0]
+        depth = maxFrames + 2 # queued frames + frame being sampled + frame held by the consumer
+        self._spectra = np.zeros((depth, nbins), dtype=MCA_DTYPE)
+        self._deltas = np.zeros((depth, nbins), dtype=np.int64)
+        self._last = np.zeros(nbins, dtype=MCA_DTYPE)
+        self._free = deque(range(depth))
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._done = False
+        self._thread = None
+
+    def start(self) -> None:
+        """Starts the run (unless one is active already) and the sampler thread."""
+
+        handel = self.xm._handel
+        runActive = handel.getRunDataShort(self.xm.detChan, "run_active")
+        if runActive or not self.clearMca:
+            # counts already in the MCA are not part of the first delta
+            handel.getRunDataArray(self.xm.detChan, "mca", self._last)
+        if not runActive:
+            self.xm.startRun(clearMca=self.clearMca)
+        self._thread = threading.Thread(target=self._sample, name="SpectrumStream", daemon=True)
+        self._thread.start()
+
+    def stop(self, stopRun: bool = True) -> None:
+        """Stops sampling and, with <stopRun>, the acquisition."""
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if stopRun:
+            self.xm.stopRun()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _sample(self) -> None:
+        handel = HandelBindings(self.xm._lib)
+        detChan = self.xm.detChan
+        tripped = self.xm.tripWatch(handel)
+        index = 0
+        nextTick = time.monotonic()
+        while not self._stop.is_set():
+            with self._cond:
+                slot = self._free.popleft()
+            spectrum = self._spectra[slot]
+            delta = self._deltas[slot]
+
+            stats = readRunStats(handel, detChan)
+            handel.getRunDataArray(detChan, "mca", spectrum)
+            timestamp = time.monotonic()
+            np.subtract(spectrum, self._last, out=delta, casting="unsafe")
+            np.copyto(self._last, spectrum)
+
+            self._push(SpectrumSnapshot(index, timestamp, spectrum, delta, stats, slot=slot))
+            index += 1
+            if not stats.run_active:
+                break
+            if tripped():
+                continue # sample the stopped run once more
+
+            nextTick += self.interval
+            now = time.monotonic()
+            if nextTick < now:
+                # fell behind, keep the cadence instead of bursting
+                nextTick = now + self.interval - (now - nextTick) % self.interval
+            self._stop.wait(nextTick - now)
+
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+    def _push(self, snapshot: SpectrumSnapshot) -> None:
+        with self._cond:
+            if len(self._queue) >= self.maxFrames:
+                if self.policy == "coalesce":
+                    merged = self._queue.pop()
+                    snapshot.delta += merged.delta
+                    snapshot.frames += merged.frames
+                    snapshot.dropped += merged.dropped
+                    self.coalesced += 1
+                else:
+                    merged = self._queue.popleft()
+                    successor = self._queue[0] if self._queue else snapshot
+                    successor.dropped += merged.frames
+                    self.dropped += merged.frames
+                self._free.append(merged.slot)
+            self._queue.append(snapshot)
+            self._cond.notify_all()
+
+    def __iter__(self):
+        held = None
+        while True:
+            with self._cond:
+                if held is not None:
+                    self._free.append(held.slot)
+                    held = None
+                while not self._queue and not self._done:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                held = self._queue.popleft()
+            yield held
@@ -0,0 +1,123 @@
+import threading
+import time
+import numpy as np
+
+class TelemetrySampler:
+    """Samples HV and emission current of a Tube at a fixed <rate> (Hz) in a background thread.
+
+    Raw ADC codes go into a preallocated ring buffer of <capacity> samples together with their
+    time.monotonic() timestamps, the clock RunStats uses, so traces line up with detector runs.
+    Readers never block the sampler: they copy what they need and drop any samples the sampler
+    overwrote meanwhile (the write counter is only advanced after a sample is complete). Values
+    are converted to kV and uA through the tube's calibration tables, on whole arrays.
+
+    Usage:
+        with TelemetrySampler(tube, rate=500) as sampler:
+            stats = xm.getRunStats()
+            ...
+            sampler.summary(t0, stats.timestamp)
+    """
+
+    def __init__(self, tube, rate: float = 500.0, capacity: int = 65536):
+        self.tube = tube
+        self.rate = rate
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.raw = np.zeros((capacity, 2), dtype=np.uint16) # HV, current
+        self.written = 0        # samples written since start, the newest is written - 1
+        self.overruns = 0       # sampling deadlines missed
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name="TelemetrySampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _sample(self) -> None:
+        readRaw = self.tube.readRaw
+        period = 1.0 / self.rate
+        nextTick = time.monotonic()
+        while not self._stop.is_set():
+            slot = self.written % self.capacity
+            self.raw[slot, 0] = readRaw(False)
+            self.raw[slot, 1] = readRaw(True)
+            self.times[slot] = time.monotonic()
+            self.written += 1
+
+            nextTick += period
+            now = time.monotonic()
+            if nextTick < now:
+                missed = int((now - nextTick) / period) + 1
+                self.overruns += missed
+                nextTick += missed * period
+            self._stop.wait(nextTick - now)
+
+    def _copy(self, count: int) -> tuple:
+        """Copies the newest <count> samples as (indices, times, raw) without locking."""
+
+        end = self.written
+        start = max(0, end - min(count, self.capacity))
+        index = np.arange(start, end)
+        times = self.times[index % self.capacity]
+        raw = self.raw[index % self.capacity]
+        # the slot of sample <written> may be half written, and everything before written - capacity is gone
+        valid = index >= self.written - self.capacity + 1
+        return index[valid], times[valid], raw[valid]
+
+    def snapshot(self, count: int = None) -> tuple:
+        """Returns (times, kV, uA) of the newest <count> samples (all buffered ones by default)."""
+
+        _, times, raw = self._copy(self.capacity if count is None else count)
+        calibration = self.tube.calibration
+        return times, calibration.adcValue(raw[:, 0], False), calibration.adcValue(raw[:, 1], True)
+
+    def window(self, t0: float, t1: float = None) -> tuple:
+        """Returns (times, kV, uA) of the samples taken between the monotonic times <t0> and <t1>."""
+
+        times, hv, current = self.snapshot()
+        mask = times >= t0
+        if t1 is not None:
+            mask &= times <= t1
+        return times[mask], hv[mask], current[mask]
+
+    def summary(self, t0: float, t1: float = None) -> dict:
+        """min/mean/max of kV and uA between <t0> and <t1>, e.g. the start and end of a run."""
+
+        _, hv, current = self.window(t0, t1)
+        if not len(hv):
+            return {"samples": 0, "hv": (np.nan,) * 3, "current": (np.nan,) * 3}
+        return {"samples": len(hv),
+                "hv": (hv.min(), hv.mean(), hv.max()),
+                "current": (current.min(), current.mean(), current.max())}
+
+    def decimate(self, interval: float, t0: float = None, t1: float = None) -> dict:
+        """Reduces the buffered trace to one min/mean/max per <interval> seconds.
+
+        Returns arrays: time (start of every interval), samples, hvMin, hvMean, hvMax, iMin, iMean, iMax.
+        """
+
+        times, hv, current = self.snapshot() if t0 is None else self.window(t0, t1)
+        if not len(times):
+            return {key: np.zeros(0) for key in ("time", "samples", "hvMin", "hvMean", "hvMax", "iMin", "iMean", "iMax")}
+        bins = ((times - times[0]) // interval).astype(np.int64)
+        starts = np.flatnonzero(np.diff(bins, prepend=-1))
+        samples = np.diff(np.append(starts, len(times)))
+        result = {"time": times[0] + bins[starts] * interval, "samples": samples}
+        for key, values in (("hv", hv), ("i", current)):
+            result[key + "Min"] = np.minimum.reduceat(values, starts)
+            result[key + "Mean"] = np.add.reduceat(values, starts) / samples
+            result[key + "Max"] = np.maximum.reduceat(values, starts)
+        return result
@@ -1,19 +1,67 @@
-import pigpio
-from time import sleep
+import math
+import threading
+from dataclasses import dataclass
+from time import sleep, perf_counter
+import numpy as np
+try:
+    import pigpio
+except ImportError: # not on the Pi, a thesimpigpio.pi() can be passed instead
+    pigpio = None
+import thesimpigpio
+from thetubecal import *
+from theregulation import TubeRegulator
+from theinterlock import InterlockMonitor
+from theevents import *
+from theprofiling import Profiler, ProfiledPi
+
+gpio = pigpio or thesimpigpio # constants
+
+@dataclass
+class RampPlan:
+    """Precomputed HV/current trajectory. Step k is applied at times[k] seconds after the start."""
+    times: np.ndarray
+    hv: np.ndarray          # kV
+    current: np.ndarray     # uA
+    hvCodes: np.ndarray
+    currentCodes: np.ndarray
+    payload: np.ndarray     # (steps, 4) two SPI words per step: filament code into the buffer, then HV
+    capped: bool = False    # True if the current was limited by the 12 W cap somewhere
+
+    def __len__(self):
+        return len(self.times)
+
 
 class Tube:
-    def __init__(self, spi_bus: int = 0):
+    def __init__(self, spi_bus: int = 0, calibration: TubeCalibration = None, pi=None, events: EventLog = None):
 
         self.spi_bus = spi_bus
+        # DAC/ADC transfer curves, see thetubecal. Defaults to the linear factors.
+        self.calibration = calibration or TubeCalibration.default()
+        self.hv = 0
+        self.i = 0
+        self.regulator = None # TubeRegulator while regulate() is active
+        self.monitor = None # InterlockMonitor, see startMonitor()
+        # Setpoint messages and range errors, see theevents. Pass xm.events to get one log for both.
+        if events is None:
+            events = EventLog()
+            events.addSink(ConsoleSink(), INFO)
+        self.events = events
+        self.profiler = None # Profiler while enableProfiling() is active
 
-        self.pi = pigpio.pi()
+        if pi is None:
+            if pigpio is None:
+                raise ImportError("pigpio is not installed. Pass pi=thesimpigpio.pi() to run on the simulated board.")
+            pi = pigpio.pi()
+        self.pi = pi
+        # SPI transfers from the control path and from samplers (thetelemetry) are serialized
+        self.spiLock = threading.Lock()
         self.filrdypin = 24
-        self.pi.set_pull_up_down(self.filrdypin, pigpio.PUD_DOWN)
-        self.pi.set_mode(self.filrdypin, pigpio.INPUT) # GPIO 24
+        self.pi.set_pull_up_down(self.filrdypin, gpio.PUD_DOWN)
+        self.pi.set_mode(self.filrdypin, gpio.INPUT) # GPIO 24
 
         self.enpin = 25
-        self.pi.set_pull_up_down(self.enpin, pigpio.PUD_DOWN)
-        self.pi.set_mode(self.enpin, pigpio.OUTPUT) # GPIO 25
+        self.pi.set_pull_up_down(self.enpin, gpio.PUD_DOWN)
+        self.pi.set_mode(self.enpin, gpio.OUTPUT) # GPIO 25
         self.pi.write(self.enpin, 0)
 
         self.dac = self.pi.spi_open(1, 20000000, 1) # device 0 at 20MHz using mode 1 (clk-polarity 0, clock-phase 1)
@@ -22,16 +70,26 @@ class Tube:
         # --> 0x4403
         self.adc = self.pi.spi_open(0, 100000, 0) # device 1 at 100kHz using mode 0 (clk-polarity 0, clock-phase 0)
         self.adc_read = 0x1Bfff # Single ended, ODD, channel 1
+        self.adc_bytes = [(self.adc_read | (channel << 14)).to_bytes(3, "big") for channel in (0, 1)]
 
         self.setHV(0)
         self.setI(0)
         self.disable()
 
+    @eventWrapper
+    def log(self, level: int, message: str) -> None:
+        self.events.record(level, message, source="tube")
+
     def toggle(self):
-        self.enabled = not self.enabled
-        self.pi.write(self.enpin, self.enabled)
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
 
     def enable(self):
+        if self.monitor is not None and self.monitor.tripped:
+            self.log(WARNING, "Interlock tripped, reset the monitor first!")
+            return
         self.enabled = True
         self.pi.write(self.enpin, True)
 
@@ -45,61 +103,55 @@ class Tube:
                         fast: bool = False,
                         pwr: bool = True) -> list:
 
-        channel = not channel
-
         if int(data) > 4095:
-            print("Data too large. Must be 0 < data <= 4095!")
+            self.log(WARNING, "Data too large. Must be 0 < data <= 4095!")
             pass
 
         if pwr == False:
-            payload = 0x2000
-            payload = payload.to_bytes(2, "big")
-            return [payload[0], payload[1]]
-        else:
-            payload = 0x4000 # fast mode default            
-            if not fast:
-                payload = 0x0000
+            return DAC_POWER_DOWN
+        # all words are precomputed, see thetubecal.DAC_BYTES
+        return DAC_BYTES[int(bool(channel)), int(fast), int(data) & 0xfff].tobytes()
 
-        payload = payload | (channel << 15)
-        payload = payload | data
-        payload = payload.to_bytes(2, "big")
-        return payload
+    def readRaw(self, channel: bool) -> int:
+        """Raw 12 bit code of the MCP3202s CH0 or CH1."""
+
+        with self.spiLock:
+            _, b = self.pi.spi_xfer(self.adc, self.adc_bytes[int(bool(channel))]) # 0b00000001 11011111 11111111
+        raw = (b[-2] << 8) | b[-1] # remove most significant byte
+        return raw & ~(0xf000) # set bits 12-15 zero
 
     def read(self,
              channel: bool) -> bytearray:
         """Reads analog signals on the MCP3202s CH0 or CH1."""
 
-        # preparations
-        adc_bytes = self.adc_read | (channel << 14)
-        adc_bytes = adc_bytes.to_bytes(3, "big") # 0b00000001 11011111 11111111
-
-        # ready to write/read
-        _, b = self.pi.spi_xfer(self.adc, adc_bytes)
-        raw = (b[-2] << 8) | b[-1] # remove most significant byte
-        raw = raw & ~(0xf000) # set bits 12-15 zero
-        if channel == False:
-            res = (raw*0.018)
-        else:
-            res = (raw*0.302)
+        raw = self.readRaw(channel)
+        res = float(self.calibration.adcValue(raw, channel))
         return [raw, res]
 
+    def _dacWrite(self, data) -> None:
+        with self.spiLock:
+            self.pi.spi_write(self.dac, data)
+
     def setHV(self, hv: float) -> None:
         """Set HV Output in kV."""
         self.hv = hv
         if 4 <= hv <= 60:
-            val = abs(int(hv/0.017))
+            val = int(self.calibration.dacCode(hv, 0))
             self.HVval = self.composeBytesDac(val, 0)
-            print(f"HV set to {hv}kV -> {val}. Ok.")
+            self.log(INFO, f"HV set to {hv}kV -> {val}. Ok.")
         elif 0 <= hv < 4:
             self.hv = 0
-            print(f"HV set to 0. Ok.")
+            self.log(INFO, "HV set to 0. Ok.")
             self.HVval = self.composeBytesDac(0, 0)
         else:
             self.hv = 0
-            print("HV must be in range 4-60kV!")
+            self.log(WARNING, "HV must be in range 4-60kV!")
             self.HVval = self.composeBytesDac(0, 0)
 
-        self.pi.spi_write(self.dac, self.HVval)
+        if self.regulator is not None:
+            self.regulator.setpoints(self.hv, self.i)
+        else:
+            self._dacWrite(self.HVval)
     
     def setI(self, i: float) -> None:
         """Set Filament Current Output in uA. Output gets capped at 12 Watt."""
@@ -112,37 +164,172 @@ class Tube:
         if 0 <= i <= 1000:
             if i > imax:
                 i = imax
-                print(f"Did cap filament current at 12W/{self.hv:.3f}V = {(12e3/self.hv):.3f}uA.")
-            val = abs(int(i/0.291))
+                self.log(WARNING, f"Did cap filament current at 12W/{self.hv:.3f}kV = {imax:.3f}uA.")
+            val = int(self.calibration.dacCode(i, 1))
+            self.i = i
             self.Ival = self.composeBytesDac(val, 1)
-            print(f"Filament current set to {i}uA -> {val}. Ok.")
+            self.log(INFO, f"Filament current set to {i}uA -> {val}. Ok.")
         elif i < 0 or i > 1000:
+            self.i = 0
             self.Ival = self.composeBytesDac(0, 1)
-            print(f"Filament current must be in range 0-{(12/self.hv):.3f}uA but {i} given -> Did set to 0.")
+            self.log(WARNING, f"Filament current must be in range 0-{imax:.3f}uA but {i} given -> Did set to 0.")
 
-        self.pi.spi_write(self.dac, self.Ival)
+        if self.regulator is not None:
+            self.regulator.setpoints(self.hv, self.i)
+        else:
+            self._dacWrite(self.Ival)
 
     def setPercent(self, percent: float, channel: bool) -> None:
         """Set Output in percent on specified channel."""
         if 0 <= percent <= 100:
-            val = int(4095 * percent / 100)
-            val = self.composeBytesDac(val, channel)
+            code = int(4095 * percent / 100)
+            val = self.composeBytesDac(code, channel)
         else:
+            code = 0
             val = self.composeBytesDac(0, channel)
-            print("Percentage must be in range 0-100!")
+            self.log(WARNING, "Percentage must be in range 0-100!")
 
-        self.pi.spi_write(self.dac, val)
+        if self.regulator is not None:
+            self._regulatedCode(code, channel)
+        else:
+            self._dacWrite(val)
 
     def setVal(self, val, channel: bool):
         """Set Output as 0 <= integer <= 4095 on specified channel."""
         if 0 <= val <= 4095:
+            code = val
             val = self.composeBytesDac(val, channel)
         else:
+            code = 0
             val = self.composeBytesDac(0, channel)
-            print("Value must be in range 0-4095!")
+            self.log(WARNING, "Value must be in range 0-4095!")
+
+        if self.regulator is not None:
+            self._regulatedCode(code, channel)
+        else:
+            self._dacWrite(val)
+
+    def _regulatedCode(self, code: int, channel: bool) -> None:
+        """A raw DAC code while regulating: becomes the setpoint of the same value, the regulator would undo a direct write."""
+        if channel:
+            self.setI(float(self.calibration.iDac.toValue(code)))
+        else:
+            self.setHV(float(self.calibration.hvDac.toValue(code)))
+
+    def planRamp(self,
+                 hv: float,
+                 current: float,
+                 duration: float = None,
+                 hvRate: float = 10.0,
+                 currentRate: float = 200.0,
+                 stepTime: float = 0.01) -> RampPlan:
+        """Plans a ramp from the present setpoints to <hv> kV and <current> uA.
+
+        Both move linearly over <duration> seconds (by default as fast as <hvRate> kV/s and
+        <currentRate> uA/s allow) in steps of <stepTime>. HV below 4 kV is 0 as in setHV and the
+        current of every step is capped at 12 W for the HV of that step.
+        """
+
+        if not (0 <= hv <= 60 and 0 <= current <= 1000):
+            raise ValueError("Ramp target must be 0-60kV and 0-1000uA.")
+        if duration is None:
+            duration = max(abs(hv - self.hv) / hvRate, abs(current - self.i) / currentRate)
+        steps = max(1, math.ceil(duration / stepTime))
+        fraction = np.arange(1, steps + 1) / steps
+
+        hvs = self.hv + (hv - self.hv) * fraction
+        hvs[hvs < 4] = 0
+        currents = self.i + (current - self.i) * fraction
+        with np.errstate(divide="ignore"):
+            cap = np.minimum(np.where(hvs > 0, MAX_POWER / hvs, 1000), 1000)
+        capped = bool(np.any(currents > cap))
+        currents = np.minimum(currents, cap)
+
+        hvCodes = self.calibration.dacCode(hvs, 0)
+        currentCodes = self.calibration.dacCode(currents, 1)
+        payload = np.concatenate([DAC_BUFFER_BYTES[currentCodes], DAC_BYTES[0, 0, hvCodes]], axis=1)
+        return RampPlan(fraction * duration, hvs, currents, hvCodes, currentCodes, payload, capped)
+
+    def runRamp(self, plan: RampPlan) -> float:
+        """Sends <plan>, timed from Python against absolute deadlines so late steps don't shift the rest.
+
+        pigpio scripts have no SPI commands and the DAC sits on the hardware SPI, so the daemon
+        can't time the steps. Both words of a step go out under one spiLock. Returns the largest
+        lateness of a step in seconds.
+        """
+
+        if self.regulator is not None:
+            self.log(WARNING, "Regulating, the regulator ramps at its own rates: use setHV/setI or stopRegulation() first!")
+            return 0.0
+        payload = [(plan.payload[k, :2].tobytes(), plan.payload[k, 2:].tobytes()) for k in range(len(plan))]
+        deadlines = plan.times - plan.times[0]
+        lateness = 0.0
+        t0 = perf_counter()
+        for k, (buffered, hv) in enumerate(payload):
+            wait = t0 + deadlines[k] - perf_counter()
+            if wait > 0:
+                sleep(wait)
+            else:
+                lateness = max(lateness, -wait)
+            # two transfers, the DAC latches the last 16 bits when CS rises
+            with self.spiLock:
+                self.pi.spi_write(self.dac, buffered)
+                self.pi.spi_write(self.dac, hv)
+
+        self.hv, self.i = float(plan.hv[-1]), float(plan.current[-1])
+        self.HVval = plan.payload[-1, 2:].tobytes()
+        self.Ival = DAC_BYTES[1, 0, plan.currentCodes[-1]].tobytes()
+        self.log(INFO, f"Ramped to {self.hv:.2f}kV, {self.i:.1f}uA in {len(plan)} steps{' (capped at 12W)' if plan.capped else ''}. Ok.")
+        return lateness
+
+    def ramp(self, hv: float, current: float, duration: float = None, **planKwargs) -> RampPlan:
+        """Ramps HV and filament current to <hv> kV and <current> uA together, see planRamp."""
+
+        plan = self.planRamp(hv, current, duration, **planKwargs)
+        self.runRamp(plan)
+        return plan
+
+    def regulate(self, rate: float = 100.0, **regulatorKwargs) -> TubeRegulator:
+        """Starts closed-loop regulation at <rate> Hz, see theregulation. setHV/setI/setPercent/setVal then only change its setpoints, ramp() is refused."""
+
+        self.stopRegulation()
+        self.regulator = TubeRegulator(self, rate, **regulatorKwargs)
+        self.regulator.start()
+        self.log(INFO, f"Regulating at {rate:g}Hz. Ok.")
+        return self.regulator
+
+    def stopRegulation(self) -> None:
+        """Stops the regulator, the DACs keep their last codes."""
+
+        if self.regulator is not None:
+            self.regulator.stop()
+            self.regulator = None
+
+    def startMonitor(self, interlocks: dict = None, xm=None, **monitorKwargs) -> InterlockMonitor:
+        """Starts edge-triggered monitoring of the filament ready line and the <interlocks>, see theinterlock."""
+
+        if self.monitor is not None:
+            self.monitor.stop()
+        self.monitor = InterlockMonitor(self, interlocks, xm, **monitorKwargs)
+        self.monitor.start()
+        return self.monitor
+
+    def enableProfiling(self, profiler: Profiler = None, trace: bool = False) -> Profiler:
+        """Times every SPI transfer, see theprofiling. Pass xm.profiler for one timeline with Handel."""
+
+        self.disableProfiling()
+        self.profiler = profiler or Profiler(trace=trace)
+        self.pi = ProfiledPi(self.pi, self.profiler)
+        return self.profiler
 
-        self.pi.spi_write(self.dac, val)
+    def disableProfiling(self) -> None:
+        if isinstance(self.pi, ProfiledPi):
+            self.pi = self.pi._target
+        self.profiler = None
 
     def close(self):
+        if self.monitor is not None:
+            self.monitor.stop()
+        self.stopRegulation()
         self.pi.spi_close(self.dac)
         self.pi.spi_close(self.adc)
\ No newline at end of file
@@ -0,0 +1,138 @@
+import json
+import numpy as np
+
+DAC_CODES = 4096 # TLV5618A, 12 bit
+ADC_CODES = 4096 # MCP3202, 12 bit
+MAX_POWER = 12e3 # kV * uA, 12 W
+
+# Linear factors Tube used before it was calibrated (value per code)
+DEFAULT_FACTORS = {
+    "hvDac": 0.017,    # kV
+    "iDac": 0.291,     # uA
+    "hvAdc": 0.018,    # kV
+    "iAdc": 0.302,     # uA
+}
+
+def dacWordTable(channel: bool, fast: bool = False) -> np.ndarray:
+    """All 4096 TLV5618A words for <channel> (0: HV, 1: filament), as Tube.composeBytesDac builds them."""
+
+    words = np.arange(DAC_CODES, dtype=np.uint16)
+    words |= (not channel) << 15    # R1, selects DAC A or B
+    if fast:
+        words |= 0x4000             # SPD
+    return words
+
+# Big-endian 2-byte SPI payloads, indexed by [channel, fast, code]
+DAC_WORDS = np.stack([np.stack([dacWordTable(channel, fast) for fast in (False, True)]) for channel in (False, True)])
+DAC_BYTES = DAC_WORDS.astype(">u2").view(np.uint8).reshape(2, 2, DAC_CODES, 2)
+DAC_POWER_DOWN = bytes([0x20, 0x00])
+# Words that only load the double buffer (R1 = 0, R0 = 1); the next DAC A write moves it to DAC B,
+# so HV and filament current change at the same instant
+DAC_BUFFER_BYTES = (np.arange(DAC_CODES, dtype=np.uint16) | 0x1000).astype(">u2").view(np.uint8).reshape(DAC_CODES, 2)
+
+
+class TransferCurve:
+    """Transfer function between the codes of a 12 bit converter and a physical value (kV or uA).
+
+    The curve is a polynomial fitted to measured (code, value) pairs and is evaluated once for
+    every code into a lookup table. Converting codes to values is then table[codes], values to
+    codes a binary search in the table; both take scalars or whole numpy arrays.
+    """
+
+    def __init__(self, coefficients, codes: int = DAC_CODES, points=None):
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.codes = codes
+        self.points = points # measured (codes, values) the curve was fitted to, if any
+        self.table = np.polyval(self.coefficients, np.arange(codes, dtype=float))
+        if np.any(np.diff(self.table) < 0):
+            raise ValueError("Transfer curve must rise monotonically over all codes.")
+
+    @classmethod
+    def linear(cls, factor: float, codes: int = DAC_CODES):
+        return cls([factor, 0.0], codes)
+
+    @classmethod
+    def fit(cls, codes, values, order: int = 3, nCodes: int = DAC_CODES):
+        """Fits a polynomial of <order> to measured <codes> and <values>."""
+
+        codes = np.asarray(codes, dtype=float)
+        values = np.asarray(values, dtype=float)
+        if len(codes) <= order:
+            raise ValueError(f"At least {order + 1} points are needed for order {order}.")
+        return cls(np.polyfit(codes, values, order), nCodes, (codes.tolist(), values.tolist()))
+
+    @property
+    def maxValue(self) -> float:
+        return float(self.table[-1])
+
+    def toValue(self, codes):
+        """Value of every code in <codes>."""
+        return self.table[np.asarray(codes, dtype=np.intp) & (self.codes - 1)]
+
+    def toCode(self, values):
+        """Highest code whose value does not exceed <values>, 0 below the curve."""
+        codes = np.searchsorted(self.table, values, side="right") - 1
+        return np.clip(codes, 0, self.codes - 1)
+
+    def residuals(self) -> np.ndarray:
+        """Measured minus fitted value of the points the curve was fitted to."""
+        if self.points is None:
+            return np.zeros(0)
+        codes, values = self.points
+        return np.asarray(values) - np.polyval(self.coefficients, codes)
+
+    def asDict(self) -> dict:
+        return {"coefficients": self.coefficients.tolist(), "codes": self.codes, "points": self.points}
+
+    @classmethod
+    def fromDict(cls, d: dict):
+        return cls(d["coefficients"], d["codes"], d.get("points"))
+
+
+class TubeCalibration:
+    """DAC and ADC transfer curves of the tube controller.
+
+    hvDac/iDac: DAC code -> set HV in kV / filament current in uA.
+    hvAdc/iAdc: ADC code -> measured HV in kV / current in uA.
+
+    Usage:
+        cal = TubeCalibration.default()
+        cal.hvDac = TransferCurve.fit(codes, measuredKV)
+        cal.save("tube_calibration.json")
+        tube = Tube(calibration=TubeCalibration.load("tube_calibration.json"))
+    """
+
+    CURVES = ("hvDac", "iDac", "hvAdc", "iAdc")
+
+    def __init__(self, hvDac: TransferCurve, iDac: TransferCurve, hvAdc: TransferCurve, iAdc: TransferCurve):
+        self.hvDac = hvDac
+        self.iDac = iDac
+        self.hvAdc = hvAdc
+        self.iAdc = iAdc
+
+    @classmethod
+    def default(cls):
+        """The linear conversion factors used before calibration."""
+        return cls(*(TransferCurve.linear(DEFAULT_FACTORS[name], DAC_CODES if name.endswith("Dac") else ADC_CODES) for name in cls.CURVES))
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump({name: getattr(self, name).asDict() for name in self.CURVES}, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as f:
+            d = json.load(f)
+        return cls(*(TransferCurve.fromDict(d[name]) for name in cls.CURVES))
+
+    def dacCode(self, value, channel: bool):
+        """DAC code(s) for HV in kV (channel 0) or current in uA (channel 1)."""
+        return (self.iDac if channel else self.hvDac).toCode(value)
+
+    def dacBytes(self, value, channel: bool, fast: bool = False) -> np.ndarray:
+        """SPI payload(s) setting <value> on <channel>, shape (..., 2)."""
+        return DAC_BYTES[int(bool(channel)), int(fast), self.dacCode(value, channel)]
+
+    def adcValue(self, raw, channel: bool):
+        """HV in kV (channel 0) or current in uA (channel 1) of raw ADC code(s)."""
+        return (self.iAdc if channel else self.hvAdc).toValue(raw)
@@ -1,5 +1,8 @@
 from timeit import default_timer as timer
 import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from rich.console import Console
 import numpy as np
 from ctypes import *
@@ -7,52 +10,131 @@ from theapp_errors import *
 from theapp_constants import *
 from theacquisition_values import *
 from theboardoperations import *
+from thebindings import *
+from thereadout import *
+from thestreaming import *
+from therunstats import *
+from theshadow import *
+from themultichannel import *
+from theanalysis import *
+from theroi import *
+from theevents import *
+from theprofiling import *
+from thepresets import *
 
 console = Console()
 
 class XMagix:
     """Wrapper class to expose handel API functions."""
 
-    def __init__(self, libpath):
+    def __init__(self, libpath, lib=None):
+        """Loads libhandel from <libpath>. An already loaded library object (e.g. thesimhandel.SimHandel) can be passed as <lib> instead."""
         self.systemUp = False
         self._lib = None
         self.libpath = libpath
-        self.cdetChan = c_int(0)
-        try:
-            self._lib = cdll.LoadLibrary(self.libpath)
-        except Exception:
-            # Return traceback on error
-            console.log("[red]Aw naw :disappointed: wrong file/path?[red]")
+        self.detChan = 0
+        self.cdetChan = c_int(self.detChan)
+        self.mcaPool = None
+        self._executor = None # single worker thread for the async API
+        self.runHistory = None # RunStatsHistory of the last fixed run
+        self.lastRunStats = None # final RunStats (ICR, OCR, livetime, realtime) of the last run
+        self.shadow = None # AcquisitionShadow, see enableShadow()
+        self._mcaLayout = None # cached (number_mca_channels, bytes_per_bin)
+        self.rois = None # RoiSet, see setRois()
+        self.scaRois = False # True if the ROIs are counted by the board's SCAs
+        self.precisionResult = None # PrecisionResult of the last precisionRun()
+        self.interlockEvents = [] # theinterlock.TripEvents reported by a tube InterlockMonitor
+        self.tripStops = 0 # interlock trips that asked to stop the run, see tripWatch()
+        # Status messages and errors go through an EventLog (see theevents); the console is one sink of it
+        self.events = EventLog()
+        self.consoleSink = ConsoleSink(console)
+        self.consoleLevel = INFO
+        self.events.addSink(self.consoleSink, self.consoleLevel)
+        self.raiseErrors = False # raise the typed HandelError in CHECK_ERROR instead of only logging it
+        self.profiler = None # Profiler while enableProfiling() is active
+        self.presets = None # PresetLibrary, see enablePresets()
+        if lib is not None:
+            self._lib = lib
+            self.log(INFO, f"Using {type(lib).__name__} as Handel backend :robot:")
         else:
-            console.log("[green]Library loaded successfully :smile:[/green]")
+            try:
+                self._lib = cdll.LoadLibrary(self.libpath)
+            except Exception:
+                # Return traceback on error
+                self.log(ERROR, "Aw naw :disappointed: wrong file/path?")
+                return
+            else:
+                self.log(INFO, "Library loaded successfully :smile:")
+        # Prototypes, pre-encoded names and out-parameters for the hot paths
+        self._handel = HandelBindings(self._lib)
+
+
+    def enableProfiling(self, profiler: Profiler = None, trace: bool = False) -> Profiler:
+        """Times every Handel call from here on, see theprofiling. HandelBindings created before (e.g. by running
+        MultiChannelSessions or RoiCounters) keep calling the library directly."""
+
+        self.disableProfiling()
+        self.profiler = profiler or Profiler(trace=trace)
+        self._lib = ProfiledLib(self._lib, self.profiler)
+        self._rebind()
+        return self.profiler
+
+    def disableProfiling(self) -> None:
+        """Puts the library itself back, so calls cost nothing extra."""
+
+        if isinstance(self._lib, ProfiledLib):
+            self._lib = self._lib._target
+            self._rebind()
+        self.profiler = None
 
+    def _rebind(self) -> None:
+        self._handel = HandelBindings(self._lib)
+        if self.shadow is not None:
+            self.shadow.handel = HandelBindings(self._lib)
 
     def stringToBytes(self, mystring):
         """Converts python string to C/C++ byte stream"""
-        return mystring.encode('ascii')
+        return encodeName(mystring)
 
-    def CHECK_ERROR(self, message):
-        try:
-            self.errmessage = ERRORS[self.status]
-        except:
-            console.log(f"Errorcode {self.status} unknown :rolleyes:")
-        else:
-            if self.status != 0:
-                console.log(f"[dark_orange] :warning: {self.status}, {self.errmessage}")
-            else:
-                console.log(f"{message}", justify="left")
+    @eventWrapper
+    def CHECK_ERROR(self, message=""):
+        status = self.status
         self.status = None
+        if not status:
+            self.events.record(INFO, message, 0, "handel")
+            return
+        self.errmessage = ERRORS.get(status)
+        if self.errmessage is None:
+            self.events.record(ERROR, f"Errorcode {status} unknown :rolleyes: {message}", status, "handel")
+        else:
+            self.events.record(WARNING, f"{status}, {self.errmessage} ({message})", status, "handel")
+        if self.raiseErrors:
+            raise handelError(status, message)
+
+    @eventWrapper
+    def log(self, level: int, message: str) -> None:
+        self.events.record(level, message, source="xmagix")
+
+    def setConsoleLevel(self, level: int = WARNING) -> None:
+        """Only events at <level> and above are rendered on the console, e.g. WARNING for hot loops. None turns it off."""
+
+        self.consoleLevel = level
+        if level is None:
+            self.events.removeSink(self.consoleSink)
+        else:
+            self.events.addSink(self.consoleSink, level)
 
     def getAllowedAcquisitionParams(self, verbose=False):
         """Prints a list of allowed acquisition parameters to the console."""
 
+        if verbose not in (True, False):
+            self.log(WARNING, "<verbose> expects boolean values.")
+            return
         for key, item in acquisition_values.items():
-            if verbose == False:
-                console.console.log(f"[bold]{key}[/bold]")
-            if verbose == True:
-                console.console.log(f"[bold]{key}:[/bold] {item}")
+            if verbose:
+                self.log(INFO, f"[bold]{key}:[/bold] {item}")
             else:
-                console.console.log(f"[dark_orange] :warning: <verbose> expects boolean values.")
+                self.log(INFO, f"[bold]{key}[/bold]")
 
     def setLogging(self, level, logpath="/tmp/xmagix.log"):
         """Sets the logging level, logfile output path and filename."""
@@ -62,7 +144,7 @@ class XMagix:
 
         self._lib.xiaSetLogLevel(self.level)
         self._lib.xiaSetLogOutput(self.stringToBytes(self.logpath))
-        console.log(f"Logfile set to {logpath}")
+        self.log(INFO, f"Logfile set to {logpath}")
 
     def init(self, inifile):
         """Initializes the Handel library and loads in an .ini file."""
@@ -84,7 +166,7 @@ class XMagix:
             self.status = self._lib.xiaStartSystem()
             self.CHECK_ERROR("Starting system...")
         else:
-            console.log("Set <logpath> and specify <inifile> first.")
+            self.log(WARNING, "Set <logpath> and specify <inifile> first.")
         
     def boardOperation(self, name, value):
         """Performs product-specific queries and operations."""
@@ -92,41 +174,69 @@ class XMagix:
         self.boardOpName = self.stringToBytes(name)
         self.boardOpValue = c_double(value)
 
-        self.status = self._lib.xiaBoardOperation(self.cdetChan, self.boardOpName, self.boardOpValue)
-        self.CHECK_ERROR()
+        # the value is passed by reference, as the void* prototype expects
+        self.status = self._handel.boardOperation(self.detChan, name, byref(self.boardOpValue))
+        self.CHECK_ERROR(f"Board operation {name}...")
 
     def setAcquisitionValues(self, name, value):
         """Translates a high-level acquisition value into the appropriate DSP parameter(s) in the hardware."""
 
-        if name not in acquisition_values:
-            console.log(f"[dark_orange] :warning: Parameter \"{name}\" unknown.")
+        if not isAcquisitionValue(name):
+            self.log(WARNING, f"Parameter \"{name}\" unknown.")
         else:
-            cname = self.stringToBytes(name)
-            cvalue = c_double(value)
-
-            self.status = self._lib.xiaSetAcquisitionValues(self.cdetChan, cname, byref(cvalue))
+            actual = self._handel.setAcquisitionValue(self.detChan, name, value)
+            self.status = self._handel.status
+            if changesMcaLayout([name]):
+                self._mcaLayout = None
+            if self.shadow is not None and self.status == 0:
+                self.shadow.update({name: actual})
+                if name in RELOADING_VALUES:
+                    self.shadow.refresh()
             self.CHECK_ERROR(f"Setting '{name}' to {value}...")
 
-    def getAcquisitionValues(self, name) -> dict:
-        """Retrieves the current setting of an acquisition value. This routine returns the same value as xiaSetAcquisitionValues() in the value parameters."""
+    def enableShadow(self) -> AcquisitionShadow:
+        """Mirrors the acquisition values of the board. Reads are served from the mirror and setParams only writes what differs."""
+
+        self.shadow = AcquisitionShadow(self._lib, self.detChan)
+        self.shadow.refresh()
+        self.status = self.shadow.status
+        self.CHECK_ERROR("Acquisition values mirrored...")
+        return self.shadow
+
+    def enablePresets(self, **libraryKwargs) -> PresetLibrary:
+        """Named setups saved in the board's PARSETs/GENSETs, switched by a single value write. Enables the shadow."""
 
-        cvalue = c_double(0)
+        self.presets = PresetLibrary(self, **libraryKwargs)
+        return self.presets
+
+    def getAcquisitionValues(self, name, refresh=False) -> dict:
+        """Retrieves the current setting of an acquisition value. This routine returns the same value as xiaSetAcquisitionValues() in the value parameters.
+
+        With the shadow enabled values come from the mirror unless <refresh> is given.
+        """
+
+        if self.shadow is not None:
+            if name == "all" and refresh:
+                self.shadow.refresh()
+            readValue = lambda key: self.shadow.get(key, refresh and name != "all")
+            handel = self.shadow
+        else:
+            readValue = lambda key: self._handel.getAcquisitionValue(self.detChan, key)
+            handel = self._handel
 
-        self.acquisitionParams = []
-        self.acquisitionValues = []
         if name == "all":
-            for key in acquisition_values:
-                self.status = self._lib.xiaGetAcquisitionValues(self.cdetChan, self.stringToBytes(key), byref(cvalue))
-                self.acquisitionParams.append(key)
-                self.acquisitionValues.append(cvalue.value)
-            self.acquisitionValuesDict = dict(zip(self.acquisitionParams, self.acquisitionValues))
+            self.acquisitionValuesDict = {key: readValue(key) for key in acquisition_values}
+            self.acquisitionParams = list(self.acquisitionValuesDict)
+            self.acquisitionValues = list(self.acquisitionValuesDict.values())
+            self.status = handel.status
         else:
-            if name in acquisition_values:
-                self.status = self._lib.xiaGetAcquisitionValues(self.cdetChan, self.stringToBytes(name), byref(cvalue))
-                console.log(f"{name}: {cvalue.value}")
-                return {name: cvalue.value}
+            if isAcquisitionValue(name):
+                value = readValue(name)
+                self.status = handel.status
+                self.log(DEBUG, f"{name}: {value}")
+                return {name: value}
             else:
-                console.log(f"[dark_orange] :warning: Parameter <name> unknown.")
+                self.log(WARNING, f"Parameter \"{name}\" unknown.")
                 pass
                 
         return self.acquisitionValuesDict
@@ -165,72 +275,169 @@ class XMagix:
     def setParams(self, params, verbose = False):
         """Setting parameters. Defaults taken from XIAs Programmer Guide"""
 
-        cparsetAndGenset = c_short(ACQ_MEM_CONSTANTS["AV_MEM_PARSET"] | ACQ_MEM_CONSTANTS["AV_MEM_GENSET"])
         for key in params:
-            if key not in acquisition_values:
-                console.log(f"[dark_orange] :warning: Bad key given.")
+            if not isAcquisitionValue(key):
+                self.log(WARNING, "Bad key given.")
                 return None
 
+        if self.shadow is not None:
+            changed = self.shadow.write(params)
+            self.status = self.shadow.status
+            if changesMcaLayout(changed):
+                self._mcaLayout = None
+            if verbose == True:
+                for key, value in changed.items():
+                    self.log(INFO, f"Set {key}: {value}")
+            self.CHECK_ERROR(f"Applying {len(changed)} changed values...")
+            return None
+
         for key, value in params.items():
-            self.cvalue = c_double(value)
             if verbose == True:
-                console.log(f"Setting {key}: {self.cvalue.value}")
-            self.status = self._lib.xiaSetAcquisitionValues(self.cdetChan, self.stringToBytes(key), byref(self.cvalue))
+                self.log(INFO, f"Setting {key}: {value}")
+            self._handel.setAcquisitionValue(self.detChan, key, value)
+            if changesMcaLayout([key]):
+                self._mcaLayout = None
         # Need to call "apply" after setting acquisition values. */
-        self.status = self._lib.xiaBoardOperation(self.cdetChan, self.stringToBytes("apply"), byref(cparsetAndGenset))
+        self.status = self._handel.apply(self.detChan, ACQ_MEM_CONSTANTS["AV_MEM_PARSET"] | ACQ_MEM_CONSTANTS["AV_MEM_GENSET"])
         self.CHECK_ERROR("Applying changes...")
 
     def applyParams(self):
 
-        self.cparsetAndGenset = c_short(ACQ_MEM_CONSTANTS["AV_MEM_PARSET"] | ACQ_MEM_CONSTANTS["AV_MEM_GENSET"])
         # Need to call "apply" after setting acquisition values. */
-        console.log("Applying changes...")
-        self.status = self._lib.xiaBoardOperation(self.cdetChan, self.stringToBytes("apply"), byref(self.cparsetAndGenset))
+        self.log(DEBUG, "Applying changes...")
+        self.status = self._handel.apply(self.detChan, ACQ_MEM_CONSTANTS["AV_MEM_PARSET"] | ACQ_MEM_CONSTANTS["AV_MEM_GENSET"])
         self.CHECK_ERROR("Applying changes...")
 
     def startRun(self, clearMca: bool=True):
 
-        clearMca = not clearMca
-        cclearMca = c_short(clearMca) # 0: DO clear MCA, 1: do NOT clear MCA
-
-        self.status = self._lib.xiaStartRun(self.cdetChan, cclearMca)
+        # 0: DO clear MCA, 1: do NOT clear MCA
+        self.status = self._handel.startRun(self.detChan, int(not clearMca))
         runtype = self.getAcquisitionValues("preset_type")
         runtype = [key for key, val in CONSTANTS.items() if val == runtype]
         self.CHECK_ERROR(f"Run type {runtype} started ...")
         self.isRunning = True
 
-    def fixedRealtimeRun(self, realtime, clearMca=True):
-        """Start fixed length run. Four types of fixed length run are supported"""
+    def fixedRealtimeRun(self, realtime, clearMca=True, pollInterval=1.0):
+        """Start fixed length run. Four types of fixed length run are supported
+
+        The run statistics are polled every <pollInterval> seconds and recorded in self.runHistory.
+        """
 
         if type(realtime) == str:
             realtime = float(realtime)
-        clearMca = not clearMca
-        cclearMca = c_short(clearMca) # 0: DO clear MCA, 1: do NOT clear MCA
-        crunActive = c_short(0)
-        coutputCountRate = c_double(0)
-        ceventsInRun = c_ulong(0)
-        cruntime = c_double(0)
-
         self.status = self.setAcquisitionValues("preset_type", CONSTANTS["XIA_PRESET_FIXED_REAL"])
         self.status = self.setAcquisitionValues("preset_value", realtime)
 
-        self.status = self._lib.xiaStartRun(self.cdetChan, cclearMca)
-
-        console.clear()
-        with console.status(":satellite: out cps: 0, Events: 0") as status:
-            for _ in range(10*int(realtime)):
-                self._lib.xiaGetRunData(self.cdetChan, self.stringToBytes("output_count_rate"), byref(coutputCountRate))
-                self._lib.xiaGetRunData(self.cdetChan, self.stringToBytes("events_in_run"), byref(ceventsInRun))
-                self._lib.xiaGetRunData(self.cdetChan, self.stringToBytes("run_active"), byref(crunActive))
-                self._lib.xiaGetRunData(self.cdetChan, self.stringToBytes("runtime"), byref(cruntime))
-                status.update(f":satellite: Time: {cruntime.value:.1f}/{realtime:.1f}, OCR: {coutputCountRate.value:.2f}, EIR: {ceventsInRun.value}")
-                if crunActive.value == 0:
+        trips = len(self.interlockEvents)
+        tripped = self.tripWatch(self._handel)
+        self.status = self._handel.startRun(self.detChan, int(not clearMca)) # 0: DO clear MCA, 1: do NOT clear MCA
+
+        self.runHistory = history = RunStatsHistory(capacity=int(realtime/pollInterval) + 2)
+        # the live status line is console output too, only shown where INFO events are
+        showStatus = self.consoleLevel is not None and self.consoleLevel <= INFO
+        if showStatus:
+            console.clear()
+        with console.status(":satellite: out cps: 0, Events: 0") if showStatus else nullcontext() as status:
+            for _ in range(max(1, int(10*realtime/pollInterval))):
+                stats = self.getRunStats()
+                history.append(stats)
+                if showStatus:
+                    status.update(f":satellite: Time: {stats.runtime:.1f}/{realtime:.1f}, OCR: {stats.output_count_rate:.2f}, EIR: {stats.events_in_run}")
+                if stats.run_active == 0:
                     break
-                time.sleep(1)
-        console.clear()
-        console.log(f"Done. Run statistics: out cps: {coutputCountRate.value:.2f}, Events: {ceventsInRun.value}")
+                if tripped():
+                    stats = self.getRunStats()
+                    history.append(stats)
+                    break
+                time.sleep(pollInterval)
+        if showStatus:
+            console.clear()
+        self.lastRunStats = stats
+        self.log(INFO, f"Done. Run statistics: {stats.summary()}")
+        if len(self.interlockEvents) > trips:
+            self.log(WARNING, f"Interlock tripped during the run ({', '.join(e.name for e in self.interlockEvents[trips:])}), spectrum is incomplete.")
         self.status = self.setAcquisitionValues("preset_type", CONSTANTS["XIA_PRESET_NONE"])
+
+    def getRunStats(self) -> RunStats:
+        """Returns a RunStats snapshot of the current run."""
+        return readRunStats(self._handel, self.detChan)
+
+    def pollRunData(self) -> tuple:
+        """Returns output count rate, events in run, run active flag and runtime of the current run."""
+
+        handel = self._handel
+        detChan = self.detChan
+        return (handel.getRunDataDouble(detChan, "output_count_rate"),
+                handel.getRunDataULong(detChan, "events_in_run"),
+                handel.getRunDataShort(detChan, "run_active"),
+                handel.getRunDataDouble(detChan, "runtime"))
         
+    async def inExecutor(self, func, *args):
+        """Runs the blocking <func>(*args) on the Handel worker thread and awaits the result.
+
+        All async methods share this single thread, so Handel never sees concurrent calls from them.
+        """
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="XMagix-Handel")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def fixedRealtimeRunProgress(self, realtime: float, clearMca: bool = True, pollInterval: float = 0.5):
+        """Async counterpart of fixedRealtimeRun. Yields RunStats every <pollInterval> seconds until the run is done.
+
+        Cancelling the consuming task (or closing the generator early) stops the run.
+        """
+
+        realtime = float(realtime)
+        await self.inExecutor(self.setAcquisitionValues, "preset_type", CONSTANTS["XIA_PRESET_FIXED_REAL"])
+        await self.inExecutor(self.setAcquisitionValues, "preset_value", realtime)
+        tripped = self.tripWatch(self._handel)
+        self.status = await self.inExecutor(self._handel.startRun, self.detChan, int(not clearMca))
+
+        finished = False
+        try:
+            while True:
+                stats = await self.inExecutor(self.getRunStats)
+                yield stats
+                if stats.run_active == 0:
+                    finished = True
+                    break
+                if await self.inExecutor(tripped):
+                    finished = True
+                    yield await self.inExecutor(self.getRunStats)
+                    break
+                await asyncio.sleep(pollInterval)
+        finally:
+            if not finished:
+                await self.inExecutor(self.stopRun, "Run cancelled...")
+            await self.inExecutor(self.setAcquisitionValues, "preset_type", CONSTANTS["XIA_PRESET_NONE"])
+
+    async def fixedRealtimeRunAsync(self, realtime: float, clearMca: bool = True, pollInterval: float = 0.5) -> RunStats:
+        """Runs a fixed realtime acquisition without blocking the event loop and returns the final run statistics."""
+
+        stats = None
+        async for stats in self.fixedRealtimeRunProgress(realtime, clearMca, pollInterval):
+            pass
+        self.lastRunStats = stats
+        self.log(INFO, f"Done. Run statistics: {stats.summary()}")
+        return stats
+
+    async def pullMcaDataAsync(self, out: np.ndarray = None, fixedWidth: bool = False) -> np.ndarray:
+        """Async counterpart of pullMcaData."""
+        return await self.inExecutor(self.pullMcaData, out, fixedWidth)
+
+    def streamSpectra(self, interval: float = 0.5, maxFrames: int = 8, policy: str = "coalesce", clearMca: bool = False):
+        """Yields a SpectrumSnapshot of a long running acquisition every <interval> seconds.
+
+        Starts a run without clearing the MCA (unless <clearMca>) if none is active and stops it
+        when the generator is closed. Ends by itself when the run ends. See SpectrumStream for the
+        backpressure <policy>.
+        """
+
+        stream = SpectrumStream(self, interval, maxFrames, policy, clearMca)
+        with stream:
+            yield from stream
+
     def stopRun(self, stopmessage="Stopped..."):
         """Stops an active run."""
 
@@ -238,23 +445,139 @@ class XMagix:
         self.status = self._lib.xiaGetRunData(self.cdetChan, self.stringToBytes("run_active"), byref(crunActive))
 
         if crunActive.value != 0:
-            self.status = self._lib.xiaStopRun(0)
+            self.status = self._lib.xiaStopRun(self.cdetChan)
             self.CHECK_ERROR(f"{stopmessage}")
         else:
-            console.log(f"No run started. Nothing to do...")
-
-    def pullMcaData(self):
-        """Time to read out the MCA"""
-        
-        nmca = self.getAcquisitionValues(name="number_mca_channels")
-        cmca = (c_ulong * int(nmca["number_mca_channels"]))()
-
-        self.status = self._lib.xiaGetRunData(self.cdetChan, self.stringToBytes("mca"), byref(cmca))
+            self.log(INFO, "No run started. Nothing to do...")
+
+    def interlockTripped(self, event, stopRun: bool = True) -> None:
+        """Called by a tube InterlockMonitor after it switched the supply off. Records the trip and, with <stopRun>, asks
+        the acquisition loops to stop their run.
+
+        This runs on the monitor's thread, so it never calls Handel itself: the bindings are not thread safe and
+        libhandel is not reentrant. Every polling loop (fixedRealtimeRun, precisionRun, RasterScan, SpectrumStream)
+        stops the run from its own thread, see tripWatch(). A run started with startRun() alone keeps running until
+        stopRun(); the supply is off already.
+        """
+
+        self.interlockEvents.append(event)
+        if stopRun:
+            self.tripStops += 1
+        self.events.record(ERROR, f"Interlock {event.name} tripped, supply off after {1e3 * event.latency:.3f}ms.", 0, "interlock")
+
+    def tripWatch(self, handel: HandelBindings):
+        """Returns tripped(), which is True once an interlock asked to stop the run after this call. The first
+        True stops the run through <handel>, the bindings of the thread polling it."""
+
+        trips = self.tripStops
+        stopped = False
+        def tripped() -> bool:
+            nonlocal stopped
+            if self.tripStops == trips:
+                return False
+            if not stopped:
+                stopped = True
+                if handel.getRunDataShort(self.detChan, "run_active"):
+                    handel.stopRun(self.detChan)
+                    self.log(WARNING, f"Run stopped by interlock {self.interlockEvents[-1].name}.")
+            return True
+        return tripped
+
+    def getMcaLayout(self) -> tuple:
+        """Returns (number_mca_channels, bytes_per_bin). Cached until a value that can change them is written again."""
+
+        if self._mcaLayout is None:
+            nbins = int(self._handel.getAcquisitionValue(self.detChan, "number_mca_channels"))
+            bytesPerBin = int(self._handel.getAcquisitionValue(self.detChan, "bytes_per_bin"))
+            self._mcaLayout = (nbins, bytesPerBin)
+        return self._mcaLayout
+
+    def setMcaPool(self, depth: int = 4) -> None:
+        """Reads out the MCA into a rotating pool of <depth> buffers from now on. depth=0 disables the pool."""
+
+        self.mcaPool = McaBufferPool(self.getMcaLayout()[0], depth) if depth else None
+
+    def _poolBuffer(self, nbins: int) -> np.ndarray:
+        """Next buffer of the MCA pool, which is reallocated if the layout changed since setMcaPool."""
+
+        if self.mcaPool.nbins != nbins:
+            self.mcaPool = McaBufferPool(nbins, self.mcaPool.depth)
+        return self.mcaPool.next()
+
+    def pullMcaData(self, out: np.ndarray = None, fixedWidth: bool = False) -> np.ndarray:
+        """Time to read out the MCA
+
+        Handel writes straight into <out> if given, else into the next buffer of the MCA pool
+        (see setMcaPool) or a fresh array. With <fixedWidth> a zero-copy view with the dtype
+        matching bytes_per_bin is returned.
+        """
+
+        nbins, bytesPerBin = self.getMcaLayout()
+        if out is None:
+            out = self._poolBuffer(nbins) if self.mcaPool is not None else np.empty(nbins, dtype=MCA_DTYPE)
+        checkMcaBuffer(out, nbins)
+
+        self.status = self._handel.getRunDataArray(self.detChan, "mca", out)
         self.CHECK_ERROR("Pulling MCA...")
 
-        mca = np.ctypeslib.as_array(cmca)
+        mca = out[:nbins]
+        if fixedWidth:
+            return binView(mca, bytesPerBin)
         return mca
-    
+
+    def setRois(self, rois, hardware: bool = True) -> bool:
+        """Defines the regions of interest (a RoiSet or a list of Roi).
+
+        With <hardware> they are written to the board's SCAs as well. Returns True if the board
+        took them, else the ROIs are evaluated in software from the spectrum.
+        """
+
+        self.rois = rois if isinstance(rois, RoiSet) else RoiSet(rois)
+        self.scaRois = False
+        if hardware:
+            self.setParams(self.rois.scaLimits())
+            numScas = self._handel.getAcquisitionValue(self.detChan, "number_of_scas")
+            self.scaRois = self._handel.status == 0 and int(numScas) == len(self.rois)
+            if not self.scaRois:
+                self.log(WARNING, "SCAs not available, ROIs are counted in software.")
+        return self.scaRois
+
+    def roiCounter(self) -> RoiCounter:
+        """Returns a RoiCounter for the ROIs set with setRois(), reading the SCAs if the board counts them."""
+
+        if self.rois is None:
+            raise ValueError("No ROIs defined, see setRois().")
+        return RoiCounter(self.rois, self, hardware=self.scaRois)
+
+    def precisionRun(self, targets: dict, maxTime: float, pollInterval: float = 0.05, clearMca: bool = True) -> PrecisionResult:
+        """Runs until the ROIs in <targets> ({name: relative uncertainty}, e.g. {"Fe Ka": 0.01}) are
+        counted precisely enough, or for at most <maxTime> seconds. See theroi.runToPrecision.
+
+        The result, with the achieved uncertainties, is also kept in self.precisionResult.
+        """
+
+        if self.rois is None:
+            raise ValueError("No ROIs defined, see setRois().")
+        buffer = self._poolBuffer(self.getMcaLayout()[0]) if self.mcaPool is not None else None
+        result = runToPrecision(self._handel, self.detChan, self.rois, targets, maxTime, pollInterval,
+                                hardware=self.scaRois, clearMca=clearMca, buffer=buffer, tripped=self.tripWatch(self._handel))
+        self.status = self._handel.status
+        if self.shadow is not None:
+            self.shadow.update({"preset_type": CONSTANTS["XIA_PRESET_NONE"], "preset_value": maxTime})
+        self.precisionResult = result
+        self.lastRunStats = result.stats
+        achieved = ", ".join(f"{name}: {u:.2%}" for name, u in zip(result.names, result.uncertainty))
+        self.CHECK_ERROR(f"{'Targets met' if result.met else 'Targets missed'} after {result.realtime:.2f}s ({achieved})")
+        return result
+
+    def getEnergyAxis(self, calibration=None) -> np.ndarray:
+        """Energy in keV of every MCA bin, nominal from mca_bin_width or from fitted <calibration> coefficients (see theanalysis.calibrate)."""
+
+        nbins = self.getMcaLayout()[0]
+        if calibration is not None:
+            return calibratedAxis(calibration, nbins)
+        return energyAxis(nbins, self._handel.getAcquisitionValue(self.detChan, "mca_bin_width"))
+
     def getNumDetectors(self) -> int:
         """Returns the number of detectors currently defined in the system."""
 
@@ -267,6 +590,10 @@ class XMagix:
 
         return self.cnumDet.value
     
+    def openChannels(self, channels=None, workers: int = None) -> MultiChannelSession:
+        """Returns a MultiChannelSession acting on <channels> (default: all defined detector channels)."""
+        return MultiChannelSession(self, channels, workers)
+
     def getNumFirmwareSets(self) -> int:
         """Returns the number of firmware sets defined in the system."""
 